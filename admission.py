@@ -0,0 +1,286 @@
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import ipaddress
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# 成本单位: 1 表示一次普通的轻量请求(列表、下载链接等)
+# 解码每百万像素帧的成本
+DECODE_COST_PER_MEGAPIXEL = 0.01
+# 编码并上传每一帧的成本
+UPLOAD_COST_PER_FRAME = 0.05
+# 下载videoUrl前按视频大小预先扣除的成本(每MB)，是提取成本的保守下限:
+# 1MB的视频通常至少有几十帧需要解码
+DOWNLOAD_COST_PER_MEGABYTE = 1.0
+
+
+def probe_video(video_path):
+    """读取视频元数据(帧数、帧率、分辨率)，不解码任何帧"""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            return None
+        return {
+            'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            'fps': cap.get(cv2.CAP_PROP_FPS) or 0.0,
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        }
+    finally:
+        cap.release()
+
+
+def estimate_frames(meta, fps=1, start_time=None, end_time=None):
+    """
+    估算需要解码和需要输出的帧数
+
+    返回: (需要解码的帧数, 需要输出的帧数)
+    """
+    video_fps = meta.get('fps') or 0.0
+    frame_count = meta.get('frame_count') or 0
+    if video_fps <= 0 or frame_count <= 0:
+        return 0, 0
+
+    start_frame = int(start_time * video_fps) if start_time else 0
+    end_frame = frame_count
+    if end_time is not None:
+        end_frame = min(frame_count, int(end_time * video_fps))
+    frames_to_decode = max(0, end_frame - start_frame)
+
+    frame_interval = max(1, int(video_fps / fps)) if fps and fps > 0 else 1
+    frames_to_upload = -(-frames_to_decode // frame_interval)
+    return frames_to_decode, frames_to_upload
+
+
+def estimate_cost(meta, fps=1, start_time=None, end_time=None):
+    """
+    根据视频元数据估算一次帧提取的成本
+
+    成本 = 需要解码的帧数 × 分辨率(百万像素) × 解码系数
+         + 需要编码上传的帧数 × 上传系数
+    """
+    frames_to_decode, frames_to_upload = estimate_frames(meta, fps, start_time, end_time)
+    megapixels = meta.get('width', 0) * meta.get('height', 0) / 1e6
+    cost = (frames_to_decode * megapixels * DECODE_COST_PER_MEGAPIXEL
+            + frames_to_upload * UPLOAD_COST_PER_FRAME)
+    return max(1.0, cost)
+
+
+def estimate_download_cost(size):
+    """
+    下载前估算的最低成本，大小未知时按一次普通请求计算
+
+    下载完成、读取元数据后再按estimate_cost补扣差额
+    """
+    if not size:
+        return 1.0
+    return max(1.0, size / 1e6 * DOWNLOAD_COST_PER_MEGABYTE)
+
+
+class TokenBucketStore:
+    """
+    基于SQLite的令牌桶，同一台机器上的所有gunicorn worker共享
+
+    每个客户端一个桶，容量为capacity，每秒补充refill_rate个令牌。
+    """
+
+    # 每处理多少次请求清理一次长时间未使用的桶
+    PRUNE_EVERY = 1000
+
+    def __init__(self, db_path, capacity, refill_rate):
+        self.db_path = db_path
+        self.capacity = float(capacity)
+        self.refill_rate = float(refill_rate)
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        folder = os.path.dirname(self.db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def acquire(self, key, cost):
+        """
+        尝试从桶中取出cost个令牌
+
+        返回: (是否允许, 需要等待的秒数)
+        超过容量的大任务按容量计算，即需要等桶满才能执行。
+        """
+        cost = min(float(cost), self.capacity)
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                tokens = self.capacity
+            else:
+                tokens = min(self.capacity, row[0] + (now - row[1]) * self.refill_rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                allowed = True
+                retry_after = 0.0
+            else:
+                allowed = False
+                retry_after = (cost - tokens) / self.refill_rate if self.refill_rate > 0 else float('inf')
+
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            self._prune(now)
+        return allowed, retry_after
+
+    def _prune(self, now):
+        """删除早已回满的桶，避免表无限增长"""
+        if self.refill_rate <= 0:
+            return
+        idle = self.capacity / self.refill_rate
+        try:
+            self._connect().execute('DELETE FROM buckets WHERE updated < ?', (now - idle,))
+        except sqlite3.Error as e:
+            logger.warning(f"清理令牌桶失败: {str(e)}")
+
+
+class AdmissionController:
+    """
+    按任务成本进行准入控制，超出预算时拒绝(429 + Retry-After)
+
+    同步接口运行在worker线程中，不在线程里等待，立即拒绝；
+    异步接口在事件循环中排队，等待时间不超过max_wait时不占用线程地等待后重试。
+    """
+
+    def __init__(self, store, max_wait=0, api_keys=(), trusted_proxies=()):
+        self.store = store
+        self.max_wait = max_wait
+        # 只保存配置的API Key的哈希
+        self.api_keys = {self._digest(key) for key in api_keys if key}
+        self.trusted_proxies = [ipaddress.ip_network(net.strip(), strict=False)
+                                for net in trusted_proxies if net.strip()]
+
+    @staticmethod
+    def _digest(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+
+    def _trusted(self, addr):
+        try:
+            ip = ipaddress.ip_address(addr)
+        except ValueError:
+            return False
+        return any(ip in net for net in self.trusted_proxies)
+
+    def client_ip(self, request):
+        """
+        客户端的真实IP
+
+        直接连接的地址是受信任的代理(Cloudflare、负载均衡等)时，使用代理设置的 CF-Connecting-IP，
+        或 X-Forwarded-For 中从右往左第一个不是受信任代理的地址；否则代理头可以被客户端伪造，不使用。
+        """
+        addr = request.remote_addr or ''
+        if not self._trusted(addr):
+            return addr or 'unknown'
+        connecting = (request.headers.get('CF-Connecting-IP') or '').strip()
+        if connecting:
+            return connecting
+        forwarded = [a.strip() for a in (request.headers.get('X-Forwarded-For') or '').split(',') if a.strip()]
+        for a in reversed(forwarded):
+            if not self._trusted(a):
+                return a
+        return forwarded[0] if forwarded else addr
+
+    def client_key(self, request):
+        """
+        识别客户端: 配置的API Key各自一个桶，其余请求按客户端IP
+
+        未配置的API Key不单独计数，否则每次换一个随机的Key就能得到一个新的令牌桶
+        """
+        api_key = request.headers.get('X-API-Key')
+        if api_key:
+            digest = self._digest(api_key)
+            if digest in self.api_keys:
+                return 'key:' + digest
+        return 'ip:' + self.client_ip(request)
+
+    def admit(self, key, cost):
+        """
+        申请执行成本为cost的任务
+
+        返回: (是否允许, 建议的Retry-After秒数)
+        在请求线程中调用，不排队等待: 等待会占住worker线程，使其他客户端的请求也无法处理。
+        """
+        try:
+            allowed, retry_after = self.store.acquire(key, cost)
+        except sqlite3.Error as e:
+            # 共享存储不可用时放行，避免影响正常服务
+            logger.warning(f"准入控制存储不可用，直接放行: {str(e)}")
+            return True, 0
+        return allowed, max(1, int(min(retry_after, 86400) + 0.999))
+
+    async def admit_async(self, key, cost, executor=None):
+        """
+        admit的异步版本，供asgi_app中的异步接口使用
+
+        SQLite操作在executor中执行；等待时间不超过max_wait时在事件循环中排队，不占用线程
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            allowed, retry_after = await loop.run_in_executor(executor, self.store.acquire, key, cost)
+            if not allowed and retry_after <= self.max_wait:
+                logger.info(f"请求排队等待 {retry_after:.1f} 秒: {key}, 成本={cost:.1f}")
+                await asyncio.sleep(retry_after)
+                allowed, retry_after = await loop.run_in_executor(executor, self.store.acquire, key, cost)
+        except sqlite3.Error as e:
+            logger.warning(f"准入控制存储不可用，直接放行: {str(e)}")
+            return True, 0
+        return allowed, max(1, int(min(retry_after, 86400) + 0.999))
+
+    def limit(self, cost=1):
+        """Flask视图装饰器，按固定成本限流"""
+        def decorator(f):
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                from flask import request
+                allowed, retry_after = self.admit(self.client_key(request), cost)
+                if not allowed:
+                    return too_many_requests(retry_after)
+                return f(*args, **kwargs)
+            return wrapped
+        return decorator
+
+
+def too_many_requests(retry_after, message='请求过于频繁，请稍后再试'):
+    """生成带Retry-After头的429响应"""
+    from flask import jsonify
+
+    response = jsonify({'error': message, 'retryAfter': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
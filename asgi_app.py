@@ -0,0 +1,588 @@
+"""
+ASGI入口: gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker
+
+帧图片、帧列表、帧下载和图片代理这几个接口只是在等待R2或上游HTTP服务，
+在这里用异步的S3和HTTP客户端(带连接池)在事件循环中处理，等待期间不占用线程。
+其余请求(提取、上传、单帧解码等)交给Flask应用，在单独的线程池中执行；
+两类请求使用不同的线程池，大量缩略图请求不会占满提取任务的线程，反之亦然。
+
+本地存储后端和带X-Profile头(cProfile)的请求全部交给Flask处理；Flask用send_file返回的本地文件
+由WsgiBridge在事件循环中发送(见WsgiBridge)，不在Flask线程中逐块迭代。
+没有安装httpx时图片代理交给Flask，没有安装aiobotocore时R2请求在I/O线程池中执行。
+"""
+import io
+import os
+import re
+import sys
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.wsgi import FileWrapper, _RangeWrapper
+import web_app
+import tracing
+import async_storage
+from config import ASGI_WSGI_THREADS, ASGI_IO_THREADS, ASGI_MAX_CONNECTIONS, PROXY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# WSGI响应迭代结束的标记
+_END = object()
+# 读取请求体的缓冲区大小: 上传视频时每次跨线程读取尽量多的数据
+BODY_BUFFER_SIZE = 1024 * 1024
+# WSGI线程最多领先发送的响应块数
+WSGI_QUEUE_SIZE = 8
+# 服务器不支持http.response.pathsend时，发送本地文件每次读取的字节数
+FILE_BLOCK_SIZE = 1024 * 1024
+
+
+class AsyncRequest:
+    """异步接口使用的请求信息"""
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {}
+        # 与Flask的request.args.get一致，同名参数取第一个
+        for name, value in parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True):
+            self.args.setdefault(name, value)
+        # 与Flask的request.headers一样不区分大小写(例如限流使用的X-API-Key)
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+        client = scope.get('client')
+        self.remote_addr = client[0] if client else None
+        host = self.headers.get('host')
+        if not host:
+            server = scope.get('server') or ('localhost', 80)
+            host = f"{server[0]}:{server[1]}"
+        self.url_root = f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}/"
+
+    def int_arg(self, name):
+        """整数参数，缺少或无效时返回None(与Flask的type=int一致)"""
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return None
+
+    def if_none_match(self, etag):
+        return parse_etags(self.headers.get('if-none-match')).contains(etag)
+
+
+class AsyncResponse:
+    """
+    异步接口的响应: body为bytes，或stream为逐块返回内容的异步迭代器
+
+    close为发送结束后调用的协程函数(例如关闭上游连接)，HEAD请求、客户端断开或出错时同样调用
+    """
+
+    def __init__(self, body=b'', status=200, content_type=None, headers=None, stream=None, close=None):
+        self.body = body
+        self.status = status
+        self.headers = list(headers or [])
+        if content_type:
+            self.headers.append(('Content-Type', content_type))
+        self.stream = stream
+        self.close = close
+
+    async def send(self, send, head=False):
+        try:
+            headers = list(self.headers)
+            if self.stream is None:
+                headers.append(('Content-Length', str(len(self.body))))
+            await send({
+                'type': 'http.response.start',
+                'status': self.status,
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            })
+            if self.stream is not None and not head:
+                async for chunk in self.stream:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'' if head else self.body, 'more_body': False})
+        finally:
+            if self.close is not None:
+                await self.close()
+
+
+def json_response(data, status=200, headers=None):
+    # 与Flask的jsonify输出一致
+    body = (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+    return AsyncResponse(body, status, 'application/json', headers)
+
+
+def immutable_response(request, response, etag, immutable=True):
+    """
+    设置内容寻址响应的ETag和1年immutable缓存(与web_app.immutable_response一致)
+
+    immutable为False(地址不带?v=内容哈希)时只短期缓存。If-None-Match匹配时转为304，不返回内容
+    """
+    cache_control = web_app.CACHE_CONTROL if immutable else web_app.UNVERSIONED_CACHE_CONTROL
+    response.headers.append(('Cache-Control', cache_control))
+    if etag:
+        response.headers.append(('ETag', quote_etag(etag)))
+        if request.if_none_match(etag):
+            headers = [(k, v) for k, v in response.headers if k.lower() in ('etag', 'cache-control')]
+            return AsyncResponse(status=304, headers=headers)
+    return response
+
+
+def not_modified(request, version):
+    """地址带有内容哈希且浏览器缓存的ETag与之相同时返回304响应，否则返回None"""
+    if version and request.if_none_match(version):
+        return immutable_response(request, AsyncResponse(status=304), version)
+    return None
+
+
+class _RequestBody(io.RawIOBase):
+    """wsgi.input: 在Flask的线程中按需从ASGI的receive读取请求体"""
+
+    def __init__(self, receive, loop, empty=False):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        # 没有请求体时不需要读取
+        self.complete = empty
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self.complete:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                # 客户端已断开，按请求体结束处理(werkzeug会发现长度不足)
+                self.complete = True
+                break
+            self._buffer += message.get('body', b'')
+            self.complete = not message.get('more_body', False)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
+
+
+class _FileWrapper(FileWrapper):
+    """wsgi.file_wrapper: 标记send_file返回的文件，由WsgiBridge在事件循环中发送"""
+
+
+class WsgiBridge:
+    """
+    在线程池中执行WSGI应用
+
+    每个请求的调用、响应迭代和close都在同一个线程中完成；请求体按需读取，
+    响应逐块发送(流式的提取进度可以及时返回)。
+    发送响应期间客户端断开时在该线程中关闭响应迭代器，Flask的流式生成器收到GeneratorExit后取消任务。
+
+    send_file返回的本地文件(wsgi.file_wrapper，包括Range请求)不在Flask线程中迭代: 调用返回后线程即释放，
+    服务器支持 http.response.pathsend 时由服务器直接发送文件，否则在io_executor中按FILE_BLOCK_SIZE读取后发送。
+    uvicorn不支持pathsend，需要零拷贝时配置LOCAL_STORAGE_ACCEL_PREFIX由nginx发送。
+    """
+
+    def __init__(self, wsgi_app, executor, io_executor=None):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.io_executor = io_executor
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': _FileWrapper
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def _file_range(result):
+        """send_file返回的磁盘文件: (文件, 起始位置, 长度或None)，其他响应返回None"""
+        start, length = 0, None
+        if isinstance(result, _RangeWrapper):
+            start, length = result.start_byte, result.byte_range
+            result = result.iterable
+        if not isinstance(result, _FileWrapper):
+            return None
+        try:
+            result.file.fileno()
+        except (AttributeError, OSError, ValueError):
+            # 内存中的文件对象(BytesIO等)按普通响应迭代
+            return None
+        return result.file, start, length
+
+    def _run(self, environ, start_response, queue, loop, disconnected):
+        """
+        在一个线程中执行WSGI应用、迭代响应并关闭响应
+
+        Flask的请求/应用上下文(stream_with_context)和contextvars绑定在调用它的线程上，
+        整个响应必须在同一个线程中完成。每块内容放入queue，队列满时等待事件循环发送。
+        本地文件的响应不迭代，交给事件循环发送并关闭。
+        """
+        def put(kind, value=None):
+            asyncio.run_coroutine_threadsafe(queue.put((kind, value)), loop).result()
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            file_range = self._file_range(result)
+            if file_range is not None:
+                put('file', (result, *file_range))
+                return
+            try:
+                for chunk in result:
+                    if disconnected.is_set():
+                        break
+                    put('chunk', chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except BaseException as e:
+            put('error', e)
+            return
+        put('end')
+
+    @staticmethod
+    async def _drain(queue, future):
+        """连接结束后继续取出队列中的内容，直到WSGI线程退出(避免线程阻塞在put上)"""
+        while not future.done():
+            try:
+                await asyncio.wait_for(queue.get(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_file(self, scope, send, file, start, length, watcher):
+        """发送本地文件的[start, start+length)部分，length为None时发送到文件末尾"""
+        name = getattr(file, 'name', None)
+        if 'http.response.pathsend' in scope.get('extensions', {}) and isinstance(name, str) \
+                and start == 0 and length is None:
+            await send({'type': 'http.response.pathsend', 'path': os.path.abspath(name)})
+            return
+        loop = asyncio.get_running_loop()
+        fd = file.fileno()
+        end = None if length is None else start + length
+        while end is None or start < end:
+            size = FILE_BLOCK_SIZE if end is None else min(FILE_BLOCK_SIZE, end - start)
+            chunk = await loop.run_in_executor(self.io_executor, os.pread, fd, size, start)
+            if not chunk:
+                break
+            start += len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if watcher is not None and watcher.done():
+                logger.info(f"客户端已断开，停止发送文件: {scope['path']}")
+                return
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        headers = {name.lower() for name, _ in scope['headers']}
+        empty = b'content-length' not in headers and b'transfer-encoding' not in headers
+        body = _RequestBody(receive, loop, empty)
+        environ = self.environ(scope, io.BufferedReader(body, BODY_BUFFER_SIZE))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return lambda data: None
+
+        queue = asyncio.Queue(maxsize=WSGI_QUEUE_SIZE)
+        disconnected = threading.Event()
+        future = loop.run_in_executor(self.executor, self._run, environ, start_response, queue, loop, disconnected)
+        watcher = None
+        try:
+            # 生成器形式的应用可能在返回第一块内容时才调用start_response
+            kind, value = await queue.get()
+            if kind == 'error':
+                raise value
+            response['started'] = True
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response['headers']]
+            })
+            if body.complete:
+                watcher = asyncio.ensure_future(self._wait_disconnect(receive))
+            if kind == 'file':
+                result, file, start, length = value
+                try:
+                    await self._send_file(scope, send, file, start, length, watcher)
+                finally:
+                    result.close()
+                return
+            while kind == 'chunk':
+                if value:
+                    await send({'type': 'http.response.body', 'body': bytes(value), 'more_body': True})
+                if watcher is not None and watcher.done():
+                    logger.info(f"客户端已断开，停止发送响应: {scope['path']}")
+                    return
+                kind, value = await queue.get()
+            if kind == 'error':
+                raise value
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.set()
+            if watcher is not None:
+                watcher.cancel()
+            if not future.done():
+                asyncio.ensure_future(self._drain(queue, future))
+
+
+class AsyncFrameApp:
+    """
+    ASGI应用: 只读的帧接口在事件循环中处理，其余请求交给Flask
+
+    线程池、异步客户端在worker进程中首次使用时创建(gunicorn --preload的主进程中不创建)。
+    """
+
+    def __init__(self, flask_app, storage):
+        self.flask_app = flask_app
+        self.storage = storage
+        self._pid = None
+        # (路径, 处理函数, 出错时的提示，与Flask版本一致)
+        self.routes = [
+            (re.compile(r'^/api/get-frame-image$'), self.get_frame_image, 'Failed to get frame image: {}'),
+            (re.compile(r'^/api/proxy-image$'), self.proxy_image, 'Failed to proxy image: {}'),
+            (re.compile(r'^/frames/(?P<folder_name>.+)$'), self.get_frames, '获取帧列表时出错: {}'),
+            (re.compile(r'^/download/(?P<folder_name>.+)/(?P<filename>[^/]+)$'), self.download_frame,
+             '获取下载链接时出错: {}')
+        ]
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.wsgi_executor = ThreadPoolExecutor(ASGI_WSGI_THREADS, thread_name_prefix='wsgi')
+        self.io_executor = ThreadPoolExecutor(ASGI_IO_THREADS, thread_name_prefix='io')
+        self.wsgi = WsgiBridge(self.flask_app, self.wsgi_executor, self.io_executor)
+        self.async_storage = async_storage.create_async_storage(self.storage, self.io_executor, ASGI_MAX_CONNECTIONS)
+        self.bundles = async_storage.AsyncBundleIndex(self.async_storage)
+        self.http = None
+        logger.info(f"ASGI worker已启动: Flask线程={ASGI_WSGI_THREADS}, I/O线程={ASGI_IO_THREADS}")
+
+    async def _close(self):
+        if self._pid != os.getpid():
+            return
+        if self.http is not None:
+            await self.http.aclose()
+        await self.async_storage.close()
+        self.io_executor.shutdown(wait=False)
+        self.wsgi_executor.shutdown(wait=False)
+        self._pid = None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self._close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _route(self, scope):
+        """匹配异步处理的接口，返回 (处理函数, 路径参数, 出错提示)，交给Flask处理时返回None"""
+        if scope['method'] not in ('GET', 'HEAD') or self.storage.is_local:
+            return None
+        if any(name.lower() == b'x-profile' for name, _ in scope['headers']):
+            return None
+        for pattern, handler, error in self.routes:
+            match = pattern.match(scope['path'])
+            if match:
+                if handler == self.proxy_image and not _has_httpx():
+                    return None
+                return handler, match.groupdict(), error
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        self._start()
+        route = self._route(scope)
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+        handler, params, error = route
+
+        request = AsyncRequest(scope)
+        trace, token = tracing.start_trace()
+        try:
+            key = web_app.admission_controller.client_key(request)
+            allowed, retry_after = await web_app.admission_controller.admit_async(key, 1, self.io_executor)
+            if not allowed:
+                response = json_response({'error': '请求过于频繁，请稍后再试', 'retryAfter': retry_after}, 429,
+                                         [('Retry-After', str(retry_after))])
+            else:
+                response = await handler(request, **params)
+        except Exception as e:
+            message = error.format(str(e))
+            logger.error(message, exc_info=True)
+            response = json_response({'error': message}, 500)
+        finally:
+            tracing.end_trace(token)
+        response.headers.extend(web_app.cors_headers(request.headers.get('origin')))
+        response.headers.append(('Server-Timing', trace.server_timing()))
+        await response.send(send, head=request.method == 'HEAD')
+
+    async def get_frame_image(self, request):
+        """获取帧图片(web_app.get_frame_image的异步版本)"""
+        filepath = request.args.get('filepath')
+        if not filepath:
+            return json_response({"error": "Missing filepath parameter"}, 400)
+        offset = request.int_arg('offset')
+        length = request.int_arg('length')
+        # 地址中的内容哈希，带有时用作ETag
+        version = request.args.get('v')
+
+        logger.info(f"请求帧图片: {filepath}")
+        cached = not_modified(request, version)
+        if cached is not None:
+            return cached
+
+        content_type = 'image/png' if filepath.endswith('.png') else 'image/jpeg'
+        if offset is not None and length:
+            # 打包的帧: 地址中已带偏移和长度，直接按范围读取打包文件
+            bundle_object = f"{os.path.dirname(filepath)}/{self.bundles.bundle_name}"
+            file_content = await self.async_storage.get_range(bundle_object, offset, length)
+        else:
+            # 不存在时尝试从打包文件中读取
+            file_content = await self.async_storage.get_file(filepath)
+            if not file_content:
+                bundled = await self.bundles.read_async(filepath)
+                if bundled:
+                    file_content, content_type = bundled
+        if not file_content:
+            logger.warning(f"未找到帧图片: {filepath}")
+            return json_response({"error": "Frame image not found"}, 404)
+
+        return immutable_response(
+            request,
+            AsyncResponse(file_content, content_type=content_type),
+            version or hashlib.md5(file_content).hexdigest(),
+            bool(version)
+        )
+
+    async def get_frames(self, request, folder_name):
+        """列出目录中的帧(web_app.get_frames的异步版本)"""
+        objects = await self.async_storage.list_files(f"frames/{folder_name}/")
+
+        # 打包输出的目录按清单列出帧，通过单帧接口按范围读取
+        if any(os.path.basename(obj['Key']) == self.bundles.manifest_name for obj in objects):
+            index = await self.bundles.manifest_async(f"frames/{folder_name}", listed=True)
+            if index:
+                frames = [{
+                    'url': web_app.versioned_url(
+                        f"{request.url_root.rstrip('/')}/api/get-frame-image?filepath=frames/{folder_name}/{name}"
+                        f"&offset={entry['offset']}&length={entry['length']}",
+                        entry.get('md5')
+                    ),
+                    'filename': name
+                } for name, entry in index['frames'].items()]
+                return json_response({'success': True, 'frames': frames})
+
+        # 预签名只在本地计算签名，对象很多时仍然放到线程池中，不阻塞事件循环
+        def presign():
+            frames = []
+            for obj in objects:
+                url = self.storage.get_presigned_url(obj['Key'])
+                if url:
+                    frames.append({'url': url, 'filename': os.path.basename(obj['Key'])})
+            return frames
+
+        frames = await asyncio.get_running_loop().run_in_executor(self.io_executor, presign)
+        return json_response({'success': True, 'frames': frames})
+
+    async def download_frame(self, request, folder_name, filename):
+        """下载单帧(web_app.download_frame的异步版本)"""
+        version = request.args.get('v')
+        object_name = f"frames/{folder_name}/{filename}"
+        cached = not_modified(request, version)
+        if cached is not None:
+            return cached
+
+        # 打包的帧没有独立对象，按范围读取后直接返回
+        bundled = await self.bundles.read_async(object_name)
+        if bundled:
+            data, content_type = bundled
+            response = AsyncResponse(data, content_type=content_type,
+                                     headers=[('Content-Disposition', f'attachment; filename="{filename}"')])
+            return immutable_response(request, response, version or hashlib.md5(data).hexdigest(), bool(version))
+
+        url = self.storage.get_presigned_url(object_name)
+        if url:
+            return AsyncResponse(status=302, headers=[('Location', url)])
+        return json_response({'error': '获取下载链接失败'}, 404)
+
+    async def proxy_image(self, request):
+        """代理图片请求，解决CORS问题(web_app.proxy_image的异步版本)"""
+        url = request.args.get('url')
+        if not url:
+            return json_response({"error": "Missing URL parameter"}, 400)
+
+        if self.http is None:
+            import httpx
+            self.http = httpx.AsyncClient(
+                timeout=PROXY_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=ASGI_MAX_CONNECTIONS)
+            )
+        try:
+            with tracing.stage('proxy'):
+                upstream = await self.http.send(self.http.build_request('GET', url), stream=True)
+        except Exception as e:
+            logger.error(f"代理图片请求失败: {str(e)}")
+            return json_response({"error": f"Failed to proxy image: {str(e)}"}, 500)
+        if upstream.status_code != 200:
+            await upstream.aclose()
+            return json_response({"error": f"Failed to fetch image: {upstream.status_code}"}, upstream.status_code)
+
+        name = url.split('?')[0].split('/')[-1]
+        headers = [('Content-Disposition', f'inline; filename="{name}"')] if name.isascii() and '"' not in name else []
+        # 上游连接在发送结束后归还连接池(HEAD请求不读取内容，同样关闭)
+        return AsyncResponse(
+            content_type=upstream.headers.get('content-type', 'image/jpeg'),
+            headers=headers,
+            stream=upstream.aiter_bytes(),
+            close=upstream.aclose
+        )
+
+
+def _has_httpx():
+    try:
+        import httpx  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+app = AsyncFrameApp(web_app.app, web_app.storage)
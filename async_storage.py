@@ -0,0 +1,148 @@
+import os
+import asyncio
+import logging
+from frame_server import BundleIndex
+from tracing import stage
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorStorage:
+    """
+    在线程池中调用同步的存储后端
+
+    用于本地存储，以及没有安装aiobotocore时的R2存储。
+    线程池与执行Flask请求的线程池分开，大量读取请求不会占满提取任务使用的线程。
+    """
+
+    def __init__(self, storage, executor):
+        self.storage = storage
+        self.executor = executor
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get_file(self, object_name):
+        return await self._run(self.storage.get_file, object_name)
+
+    async def get_range(self, object_name, offset, length):
+        return await self._run(self.storage.get_range, object_name, offset, length)
+
+    async def list_files(self, prefix=''):
+        return await self._run(self.storage.list_files, prefix)
+
+    async def close(self):
+        pass
+
+
+class AsyncR2Storage:
+    """
+    用aiobotocore访问R2，等待响应时不占用线程
+
+    客户端在所在的事件循环中首次使用时创建(每个worker进程一个)，
+    连接池最多保持max_connections个连接，与同步的R2Storage使用相同的配置。
+    """
+
+    def __init__(self, storage, max_connections=64):
+        self.storage = storage
+        self.bucket = storage.bucket
+        self.max_connections = max_connections
+        self._context = None
+        self._client = None
+        self._lock = None
+
+    async def client(self):
+        if self._client is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._client is None:
+                    from aiobotocore.session import get_session
+
+                    options = self.storage.client_options(max_pool_connections=self.max_connections)
+                    self._context = get_session().create_client('s3', **options)
+                    self._client = await self._context.__aenter__()
+        return self._client
+
+    async def _read(self, **params):
+        client = await self.client()
+        response = await client.get_object(Bucket=self.bucket, **params)
+        async with response['Body'] as body:
+            return await body.read()
+
+    async def get_file(self, object_name):
+        """获取文件内容，不存在时返回None"""
+        try:
+            with stage('r2_get'):
+                return await self._read(Key=object_name)
+        except Exception as e:
+            logger.error(f"获取文件内容失败: {str(e)}")
+            return None
+
+    async def get_range(self, object_name, offset, length):
+        """读取对象中从offset开始的length个字节"""
+        try:
+            with stage('r2_get'):
+                return await self._read(Key=object_name, Range=f"bytes={offset}-{offset + length - 1}")
+        except Exception as e:
+            logger.error(f"读取文件范围失败: {str(e)}")
+            return None
+
+    async def list_files(self, prefix=''):
+        """列出指定前缀的所有文件，出错时返回空列表"""
+        try:
+            client = await self.client()
+            objects = []
+            with stage('r2_list'):
+                async for page in client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+                    objects.extend(page.get('Contents', []))
+            return objects
+        except Exception as e:
+            logger.error(f"列出文件失败: {str(e)}")
+            return []
+
+    async def close(self):
+        if self._context is not None:
+            await self._context.__aexit__(None, None, None)
+            self._context = None
+            self._client = None
+
+
+def create_async_storage(storage, executor, max_connections=64):
+    """按同步存储后端创建对应的异步访问方式"""
+    if not storage.is_local:
+        try:
+            import aiobotocore  # noqa: F401
+            return AsyncR2Storage(storage, max_connections)
+        except ImportError:
+            logger.warning("未安装aiobotocore，R2请求在线程池中执行")
+    return ExecutorStorage(storage, executor)
+
+
+class AsyncBundleIndex(BundleIndex):
+    """BundleIndex的异步版本，清单和帧数据通过异步存储读取"""
+
+    async def manifest_async(self, prefix, listed=None):
+        hit, index = self._cached(prefix)
+        if hit:
+            return index
+        key = f"{prefix}/{self.manifest_name}"
+        if listed is None:
+            listed = self._listed(prefix, await self.storage.list_files(key))
+        index = self._parse(prefix, await self.storage.get_file(key)) if listed else None
+        self._remember(prefix, index)
+        return index
+
+    async def read_async(self, object_name):
+        """读取打包的帧，返回 (图片数据, 内容类型)，不是打包的帧时返回None"""
+        prefix, name = os.path.split(object_name)
+        if not prefix:
+            return None
+        index = await self.manifest_async(prefix)
+        entry = index['frames'].get(name) if index else None
+        if entry is None:
+            return None
+        data = await self.storage.get_range(index['bundle'], entry['offset'], entry['length'])
+        if data is None:
+            return None
+        return data, index['content_type']
@@ -0,0 +1,116 @@
+"""
+解码循环内存基准测试
+
+生成不同长度的合成视频，用 tracemalloc 统计 extract_frames 在逐帧文件、
+按目标大小编码和打包输出时的峰值内存，以及循环结束后仍未释放的内存。解码循环复用缓冲区时，两者都不应随视频长度增长；
+超过允许的增长比例时以非零状态码退出，可作为回归测试使用。
+
+用法:
+    python benchmarks/bench_decode_memory.py --width 1280 --height 720
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+import numpy as np
+
+from extract_frames import extract_frames, iter_frames
+
+
+def make_video(path, frames, width, height, fps=30):
+    """写入一个带噪声的合成视频"""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for i in range(frames):
+        writer.write(np.roll(base, i * 4, axis=1))
+    writer.release()
+
+
+def measure(func):
+    """运行func，返回 (峰值内存字节, 结束后仍占用的字节)"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before, current - before
+
+
+# 分别测量的输出方式: 名称 -> extract_frames的参数
+# 按目标大小编码时每帧可能编码多次，打包输出时编码结果经过内存写入同一个文件
+MODES = {
+    'files': {},
+    'targetKB': {'target_kb': 20},
+    'bundle': {'bundle': True},
+    'bundle+targetKB': {'bundle': True, 'target_kb': 20},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解码循环内存基准测试")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[60, 240, 960], help="视频帧数")
+    parser.add_argument("--fps", type=float, default=10, help="提取帧率")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="允许的峰值内存增长倍数")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES), help="测量的输出方式")
+    args = parser.parse_args()
+
+    frame_bytes = args.width * args.height * 3
+    workdir = tempfile.mkdtemp(prefix='bench_decode_')
+    # 输出方式 -> [(帧数, 峰值, 结束后占用)]
+    results = {mode: [] for mode in args.modes}
+    iter_peaks = []
+    try:
+        for length in args.lengths:
+            video = os.path.join(workdir, f"v{length}.mp4")
+            make_video(video, length, args.width, args.height)
+            out_dir = os.path.join(workdir, f"out{length}")
+
+            for mode in args.modes:
+                peak, retained = measure(lambda: extract_frames(video, out_dir, fps=args.fps, **MODES[mode]))
+                results[mode].append((length, peak, retained))
+                shutil.rmtree(out_dir, ignore_errors=True)
+            iter_peak, _ = measure(lambda: [None for _ in iter_frames(video, fps=args.fps, reuse=True)])
+            iter_peaks.append((length, iter_peak))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"帧大小: {frame_bytes / 1024:.0f} KB")
+    print(f"{'输出方式':>16} {'帧数':>8} {'峰值':>12} {'结束后占用':>12} {'峰值/帧大小':>12}")
+    for mode, rows in results.items():
+        for length, peak, retained in rows:
+            print(f"{mode:>16} {length:>8} {peak / 1024:>10.0f}KB {retained / 1024:>10.0f}KB "
+                  f"{peak / frame_bytes:>12.2f}")
+    for length, iter_peak in iter_peaks:
+        print(f"{'iter_frames':>16} {length:>8} {iter_peak / 1024:>10.0f}KB")
+
+    # 每种输出方式的峰值内存都应与视频长度无关
+    failed = False
+    for mode, rows in results.items():
+        baseline = max(rows[0][1], frame_bytes)
+        for length, peak, retained in rows[1:]:
+            if peak > baseline * args.tolerance:
+                print(f"失败: {mode} {length} 帧时峰值内存 {peak} 超过基线 {baseline} 的 {args.tolerance} 倍")
+                failed = True
+            if retained > frame_bytes:
+                print(f"失败: {mode} {length} 帧处理结束后仍占用 {retained} 字节")
+                failed = True
+    if failed:
+        sys.exit(1)
+    print("通过: 峰值内存不随视频长度增长")
+
+
+if __name__ == "__main__":
+    main()
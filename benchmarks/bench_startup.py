@@ -0,0 +1,78 @@
+"""
+Worker启动耗时基准测试
+
+在全新的解释器中反复导入 web_app，统计导入耗时的中位数，
+并检查导入后 cv2 / numpy / boto3 / requests 是否仍未加载。
+每次运行测量两种方式: 延迟导入(当前的启动方式)，以及导入后立即加载这些重量级模块
+(R2存储后端同时创建S3客户端)模拟旧的启动方式，最后输出两者的差值。
+
+用法:
+    python benchmarks/bench_startup.py --runs 10
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['cv2', 'numpy', 'boto3', 'requests']
+
+SNIPPET = """
+import sys, time, json
+t0 = time.perf_counter()
+import web_app
+{eager}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{
+    'seconds': elapsed,
+    'loaded': [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure(runs, eager=False):
+    """在子进程中测量导入耗时，返回(耗时列表, 最后一次已加载的重量级模块)"""
+    eager_code = ''
+    if eager:
+        # 本地存储后端没有S3客户端
+        eager_code = 'import cv2, numpy, boto3, requests\nif not web_app.storage.is_local:\n    web_app.storage.s3'
+    code = SNIPPET.format(eager=eager_code, heavy=HEAVY_MODULES)
+    env = dict(os.environ)
+    env.setdefault('R2_ACCOUNT_ID', 'benchmark')
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded = result['loaded']
+    return timings, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="web_app 导入耗时基准测试")
+    parser.add_argument("--runs", type=int, default=10, help="重复次数")
+    args = parser.parse_args()
+
+    lazy, lazy_loaded = measure(args.runs)
+    eager, _ = measure(args.runs, eager=True)
+
+    print(f"延迟导入: 中位数 {statistics.median(lazy) * 1000:.1f} ms, 已加载重量级模块: {lazy_loaded or '无'}")
+    print(f"立即导入: 中位数 {statistics.median(eager) * 1000:.1f} ms")
+    print(f"节省: {(statistics.median(eager) - statistics.median(lazy)) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+端到端HTTP压测
+
+用gunicorn启动web_app(--asgi 时以uvicorn worker启动asgi_app)，对象存储指向本地的S3兼容服务(默认启动moto server，
+也可以用 --s3-endpoint 指向已运行的minio)，按比例混合发送上传、帧提取、
+帧列表、单帧图片和图片代理请求，输出每个接口的吞吐量和 p50/p95/p99 延迟，
+用于根据数据调整 --workers/--threads。
+
+依赖: gunicorn、requests，使用默认的存储服务时还需要 moto[server]
+
+用法:
+    python benchmarks/load_test.py --workers 2 --threads 2 --concurrency 8 --duration 30
+    python benchmarks/load_test.py --asgi --workers 2 --concurrency 32
+    python benchmarks/load_test.py --s3-endpoint http://127.0.0.1:9000 --mix image=10,list=2
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 默认的请求比例
+DEFAULT_MIX = 'upload=1,extract=1,list=3,image=10,proxy=3'
+ENDPOINTS = ('upload', 'extract', 'list', 'image', 'proxy')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url, timeout=30):
+    """等待服务可以响应请求"""
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未在 {timeout} 秒内启动: {url}")
+
+
+def make_assets(workdir, frames, width, height):
+    """生成测试视频和代理接口使用的图片"""
+    import cv2
+    import numpy as np
+
+    video = os.path.join(workdir, 'assets', 'load.mp4')
+    os.makedirs(os.path.dirname(video), exist_ok=True)
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for i in range(frames):
+        writer.write(np.roll(base, i * 4, axis=1))
+    writer.release()
+    cv2.imwrite(os.path.join(workdir, 'assets', 'image.jpg'), base)
+    return video
+
+
+def start_storage(args, workdir):
+    """启动本地S3兼容服务并创建存储桶，返回 (接口地址, 进程)"""
+    import boto3
+
+    process = None
+    endpoint = args.s3_endpoint
+    if not endpoint:
+        port = free_port()
+        endpoint = f"http://127.0.0.1:{port}"
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        wait_http(endpoint)
+
+    s3 = boto3.session.Session().client(
+        's3', endpoint_url=endpoint, region_name='us-east-1',
+        aws_access_key_id=args.access_key, aws_secret_access_key=args.secret_key
+    )
+    try:
+        s3.create_bucket(Bucket=args.bucket)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    return endpoint, process
+
+
+def start_app(args, workdir, endpoint):
+    """用gunicorn启动web_app或asgi_app，返回 (地址, 进程)"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        R2_ENDPOINT_URL=endpoint,
+        R2_ACCESS_KEY_ID=args.access_key,
+        R2_SECRET_ACCESS_KEY=args.secret_key,
+        R2_BUCKET_NAME=args.bucket,
+        AWS_DEFAULT_REGION='us-east-1',
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        FRAMES_FOLDER=os.path.join(workdir, 'frames'),
+        STATE_FOLDER=os.path.join(workdir, 'state'),
+        PROFILES_FOLDER=os.path.join(workdir, 'profiles'),
+        WORKER_URL='',
+        # 压测时不限流
+        ADMISSION_CAPACITY='1e12',
+        ADMISSION_REFILL_RATE='1e12'
+    )
+    cmd = [
+        'gunicorn', 'web_app:app',
+        '-b', f'127.0.0.1:{port}',
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--timeout', '120',
+        '--log-level', 'warning',
+        '--preload'
+    ]
+    if args.asgi:
+        # Flask请求使用的线程数由ASGI_WSGI_THREADS控制
+        cmd[1] = 'asgi_app:app'
+        cmd += ['-k', 'uvicorn.workers.UvicornWorker']
+        env['ASGI_WSGI_THREADS'] = str(args.threads)
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    wait_http(url + '/')
+    return url, process
+
+
+def start_asset_server(workdir):
+    """为图片代理请求提供一个本地图片地址"""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    handler = partial(QuietHandler, directory=os.path.join(workdir, 'assets'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/image.jpg"
+
+
+class LoadTest:
+    """按比例随机选择接口，多个线程循环发送请求并记录延迟"""
+
+    def __init__(self, base_url, video, image_url, mix):
+        self.base_url = base_url
+        self.video = video
+        self.image_url = image_url
+        self.mix = mix
+        self.results = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+        self.uploaded = None
+        self.frames = []
+        self.folders = []
+
+    def prepare(self):
+        """上传一个视频并提取一次，得到列表和单帧请求使用的路径"""
+        import requests
+
+        with open(self.video, 'rb') as f:
+            response = requests.post(f"{self.base_url}/api/upload-video", files={'video': f})
+        response.raise_for_status()
+        self.uploaded = response.json()['filename']
+
+        response = requests.post(f"{self.base_url}/api/extract-frames",
+                                 json={'videoPath': self.uploaded, 'fps': 2})
+        response.raise_for_status()
+        result = response.json()
+        self.frames = [f"{result['framesPath']}/{frame['filename']}" for frame in result['frames']]
+        self.folders = [result['framesPath'][len('frames/'):]]
+
+    def request(self, session, endpoint):
+        if endpoint == 'upload':
+            with open(self.video, 'rb') as f:
+                return session.post(f"{self.base_url}/api/upload-video", files={'video': f})
+        if endpoint == 'extract':
+            # 不同的开始时间避免相同任务被合并，每次都真正执行提取
+            return session.post(f"{self.base_url}/api/extract-frames", json={
+                'videoPath': self.uploaded,
+                'fps': 2,
+                'startTime': round(random.uniform(0, 1), 3)
+            })
+        if endpoint == 'list':
+            return session.get(f"{self.base_url}/frames/{random.choice(self.folders)}")
+        if endpoint == 'image':
+            return session.get(f"{self.base_url}/api/get-frame-image",
+                               params={'filepath': random.choice(self.frames)})
+        if endpoint == 'proxy':
+            return session.get(f"{self.base_url}/api/proxy-image", params={'url': self.image_url})
+        raise ValueError(endpoint)
+
+    def worker(self, deadline):
+        import requests
+
+        session = requests.Session()
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        while time.monotonic() < deadline:
+            endpoint = random.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                response = self.request(session, endpoint)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.results[endpoint].append(elapsed)
+                if not ok:
+                    self.errors[endpoint] += 1
+
+    def run(self, concurrency, duration):
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=self.worker, args=(deadline,)) for _ in range(concurrency)]
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.monotonic() - started
+
+
+def percentile(sorted_values, p):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(results, errors, elapsed):
+    """返回每个接口的统计结果"""
+    summary = {}
+    all_latencies = []
+    for endpoint in sorted(results):
+        latencies = sorted(results[endpoint])
+        all_latencies.extend(latencies)
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': errors.get(endpoint, 0),
+            'rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1)
+        }
+    all_latencies.sort()
+    summary['total'] = {
+        'requests': len(all_latencies),
+        'errors': sum(errors.values()),
+        'rps': round(len(all_latencies) / elapsed, 2),
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(all_latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 1)
+    }
+    return summary
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"未知的接口: {name}，可选: {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="web_app端到端HTTP压测")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker数量")
+    parser.add_argument("--threads", type=int, default=2, help="每个worker的线程数")
+    parser.add_argument("--asgi", action="store_true", help="以uvicorn worker启动asgi_app")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    parser.add_argument("--duration", type=float, default=30, help="压测时长(秒)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"请求比例，默认 {DEFAULT_MIX}")
+    parser.add_argument("--s3-endpoint", help="已运行的S3兼容服务地址，不指定时启动moto server")
+    parser.add_argument("--bucket", default='loadtest')
+    parser.add_argument("--access-key", default='loadtest')
+    parser.add_argument("--secret-key", default='loadtest')
+    parser.add_argument("--video-frames", type=int, default=90, help="测试视频的帧数(30fps)")
+    parser.add_argument("--video-size", default='640x360', help="测试视频的分辨率")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.video_size.split('x'))
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    processes = []
+    asset_server = None
+    try:
+        video = make_assets(workdir, args.video_frames, width, height)
+        endpoint, storage = start_storage(args, workdir)
+        if storage:
+            processes.append(storage)
+        base_url, app = start_app(args, workdir, endpoint)
+        processes.append(app)
+        asset_server, image_url = start_asset_server(workdir)
+
+        test = LoadTest(base_url, video, image_url, args.mix)
+        test.prepare()
+        elapsed = test.run(args.concurrency, args.duration)
+        summary = summarize(test.results, test.errors, elapsed)
+    finally:
+        if asset_server:
+            asset_server.shutdown()
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({
+            'asgi': args.asgi,
+            'workers': args.workers,
+            'threads': args.threads,
+            'concurrency': args.concurrency,
+            'duration': round(elapsed, 1),
+            'endpoints': summary
+        }, indent=2))
+        return
+
+    print(f"{'asgi' if args.asgi else 'wsgi'} workers={args.workers} threads={args.threads} concurrency={args.concurrency} 时长={elapsed:.1f}秒")
+    print(f"{'接口':<10} {'请求数':>8} {'错误':>6} {'吞吐(req/s)':>12} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+    for name, row in summary.items():
+        print(f"{name:<10} {row['requests']:>8} {row['errors']:>6} {row['rps']:>12} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from process_owner import ProcessOwner
+
+logger = logging.getLogger(__name__)
+
+# 客户端可以自己指定任务ID，便于在请求返回前取消
+JOB_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class Cancelled(Exception):
+    """任务被取消(客户端断开、DELETE请求或超过时间预算)"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class JobExists(Exception):
+    """任务ID已被正在执行的任务使用"""
+
+    def __init__(self, job_id):
+        super().__init__(job_id)
+        self.job_id = job_id
+
+
+class CancelDenied(Exception):
+    """取消请求没有携带任务的取消令牌"""
+
+
+class CancelToken:
+    """
+    协作式取消令牌
+
+    处理循环在每帧(或每批)调用check()，令牌被取消或超过截止时间时抛出Cancelled。
+    marker_path存在时视为已被其他进程取消，为减少文件系统调用最多每CHECK_INTERVAL秒检查一次。
+    """
+
+    CHECK_INTERVAL = 0.5
+
+    # 取消原因
+    DEADLINE = 'deadline'
+    DISCONNECTED = 'disconnected'
+    REQUESTED = 'requested'
+
+    def __init__(self, deadline=None, marker_path=None):
+        self.deadline = deadline
+        self.marker_path = marker_path
+        self.reason = None
+        self._next_marker_check = 0.0
+
+    @classmethod
+    def with_timeout(cls, seconds, marker_path=None):
+        """创建在seconds秒后到期的令牌，seconds为空时不设截止时间"""
+        deadline = time.monotonic() + seconds if seconds else None
+        return cls(deadline, marker_path)
+
+    def cancel(self, reason=REQUESTED):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is not None:
+            return True
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self.reason = self.DEADLINE
+        elif self.marker_path and now >= self._next_marker_check:
+            self._next_marker_check = now + self.CHECK_INTERVAL
+            if os.path.exists(self.marker_path):
+                self.reason = self.REQUESTED
+        return self.reason is not None
+
+    def check(self):
+        """已取消时抛出Cancelled"""
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时返回None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+
+def check(token):
+    """token可以为None的便捷写法"""
+    if token is not None:
+        token.check()
+
+
+def _digest(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+class JobRegistry:
+    """
+    正在执行的任务登记表，供 DELETE /api/jobs/<id> 跨worker取消任务
+
+    每个任务在状态目录中有一个登记文件，记录所属进程的属主文件(见process_owner)、
+    本次登记的编号和取消令牌的哈希。取消时写入带登记编号的标记文件，
+    执行任务的worker通过令牌轮询到标记后停止；之后同一ID的新登记编号不同，不受遗留标记影响。
+    """
+
+    # 登记文件在这段时间内仍为空或不完整时，视为写入它的进程已崩溃
+    WRITE_GRACE_SECONDS = 10
+
+    def __init__(self, state_folder):
+        self.folder = os.path.join(state_folder, 'jobs')
+        self._local = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.owner = ProcessOwner(self.folder)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.folder, f"{job_id}.{suffix}")
+
+    def _marker(self, job_id, nonce):
+        return self._path(job_id, f"{nonce}.cancel")
+
+    def _create(self, job_id, nonce, secret):
+        """原子地创建登记文件，已存在时抛出FileExistsError"""
+        owner = self.owner.name()
+        fd = os.open(self._path(job_id, 'job'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'owner': owner,
+                'pid': os.getpid(),
+                'nonce': nonce,
+                'secret': _digest(secret),
+                'created': time.time()
+            }, f)
+
+    def _read(self, job_id):
+        """读取登记文件，不存在时返回None，正在写入时返回{}"""
+        path = self._path(job_id, 'job')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            try:
+                if time.time() - os.path.getmtime(path) >= self.WRITE_GRACE_SECONDS:
+                    return {'owner': None}
+            except OSError:
+                return None
+            return {}
+
+    def _alive(self, record):
+        # 正在写入的登记({})视为存活；没有owner字段的旧格式登记视为已退出
+        return not record or self.owner.alive(record.get('owner'))
+
+    def register(self, job_id, timeout=None, secret=None):
+        """
+        登记任务并返回 (取消令牌, 取消用的密钥)
+
+        secret为空时生成随机密钥，DELETE /api/jobs/<id> 需要携带它。
+        同一个任务ID正在执行时抛出JobExists(否则后一个任务会覆盖前一个的登记，
+        前一个任务结束时又会删除后一个的登记)；登记所属的进程已退出时接管。
+        """
+        secret = secret or uuid.uuid4().hex
+        nonce = uuid.uuid4().hex
+        try:
+            self._create(job_id, nonce, secret)
+        except FileExistsError:
+            record = self._read(job_id)
+            if record is not None and self._alive(record):
+                raise JobExists(job_id)
+            if record is not None:
+                # 接管遗留的登记
+                self.unregister(job_id)
+            try:
+                self._create(job_id, nonce, secret)
+            except FileExistsError:
+                raise JobExists(job_id)
+        token = CancelToken.with_timeout(timeout, self._marker(job_id, nonce))
+        with self._lock:
+            self._local[job_id] = token
+        return token, secret
+
+    def unregister(self, job_id):
+        with self._lock:
+            token = self._local.pop(job_id, None)
+        if token is not None:
+            try:
+                os.remove(token.marker_path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(self._path(job_id, 'job'))
+        except FileNotFoundError:
+            pass
+
+    def cancel(self, job_id, secret):
+        """
+        取消任务，任务不存在(已结束)时返回False
+
+        secret与登记时的密钥不一致时抛出CancelDenied
+        """
+        record = self._read(job_id)
+        if not record or not self.owner.alive(record.get('owner')):
+            return False
+        if not secret or not hmac.compare_digest(_digest(secret), record.get('secret', '')):
+            raise CancelDenied(job_id)
+        with self._lock:
+            token = self._local.get(job_id)
+        if token is not None:
+            token.cancel(CancelToken.REQUESTED)
+        else:
+            # 任务在其他worker中，写入本次登记的标记文件；任务恰好结束时标记只会被prune清理，不影响之后的登记
+            with open(self._marker(job_id, record['nonce']), 'w') as f:
+                f.write(str(time.time()))
+        logger.info(f"已请求取消任务: {job_id}")
+        return True
+
+    def prune(self):
+        """清理已退出进程遗留的登记文件，以及不属于任何现存登记的取消标记"""
+        names = os.listdir(self.folder)
+        for name in names:
+            job_id, _, suffix = name.rpartition('.')
+            if suffix != 'job':
+                continue
+            record = self._read(job_id)
+            if record is not None and not self._alive(record):
+                self.unregister(job_id)
+        for name in names:
+            if not name.endswith('.cancel'):
+                continue
+            job_id, _, nonce = name[:-len('.cancel')].rpartition('.')
+            record = self._read(job_id) if job_id else None
+            if not record or record.get('nonce') != nonce:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+        self.owner.prune()
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """计算文件的md5，单次上传的对象ETag就是内容的md5"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ExtractionCheckpoint:
+    """
+    一个提取任务的进度日志
+
+    文件第一行是任务信息(帧的存储前缀)，之后每上传完一帧追加一行
+    (文件名、序号、时间戳、md5、大小和附加信息)。只追加不重写，worker在任意位置被杀死
+    最多丢失最后一行，重试时从日志恢复。
+    """
+
+    def __init__(self, path, frames_path, entries=None):
+        self.path = path
+        self.frames_path = frames_path
+        # 文件名 -> 已上传帧的记录
+        self.entries = entries or {}
+        # 恢复时列出的远端对象: 文件名 -> 列表中的对象
+        self.remote = {}
+        self._file = None
+
+    @property
+    def resumed(self):
+        return bool(self.entries)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def record(self, name, index, timestamp, md5, size, **extra):
+        """
+        记录一帧已上传，写入后立即刷新到系统缓冲区，进程被杀死也不会丢失
+
+        extra: 提取时的附加信息(感知哈希、选定的质量)，恢复时原样返回
+        """
+        entry = dict(extra, name=name, index=index, timestamp=timestamp, md5=md5, size=size)
+        self.entries[name] = entry
+        f = self._open()
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+
+    @staticmethod
+    def _remote_matches(obj, md5, size):
+        """远端对象的ETag(单次上传时为md5)或大小(没有ETag或分片上传时)与本地一致"""
+        if obj is None:
+            return False
+        etag = (obj.get('ETag') or '').strip('"')
+        if etag and '-' not in etag:
+            return etag == md5
+        return obj.get('Size') == size
+
+    def verify(self, objects):
+        """
+        用帧前缀下的对象列表核对日志，丢弃远端已不存在或内容不一致的记录
+
+        返回: 核对通过的帧数
+        """
+        self.remote = {os.path.basename(obj['Key']): obj for obj in objects}
+        for name, entry in list(self.entries.items()):
+            if not self._remote_matches(self.remote.get(name), entry['md5'], entry['size']):
+                del self.entries[name]
+        return len(self.entries)
+
+    def resume_index(self):
+        """从0开始连续已上传的帧数，重试时直接从这个序号开始解码"""
+        indices = {entry['index'] for entry in self.entries.values()}
+        index = 0
+        while index in indices:
+            index += 1
+        return index
+
+    def completed_before(self, index):
+        """序号小于index的已上传帧，按序号排列"""
+        return sorted((e for e in self.entries.values() if e['index'] < index), key=lambda e: e['index'])
+
+    def uploaded(self, name, md5, size):
+        """重新编码的帧与已上传的对象内容相同时返回True，不需要再次上传"""
+        entry = self.entries.get(name)
+        if entry is not None and entry['md5'] == md5 and entry['size'] == size:
+            return True
+        return self._remote_matches(self.remote.get(name), md5, size)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """任务完成或已取消并删除了上传结果时删除日志"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class CheckpointStore:
+    """
+    状态目录中的提取进度日志，按任务键保存
+
+    任务键由视频内容和参数决定，重试同一任务时找到上次的日志，
+    沿用上次的帧前缀，从中断的位置继续。日志超过ttl后不再使用，
+    避免把新帧上传到即将被生命周期清理删除的旧分区中。
+    """
+
+    def __init__(self, state_folder, ttl=1800):
+        self.folder = os.path.join(state_folder, 'checkpoints')
+        self.ttl = ttl
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, job_key):
+        return os.path.join(self.folder, f"{job_key}.ckpt")
+
+    def open(self, job_key, frames_path):
+        """
+        打开任务的进度日志
+
+        有未过期的日志时返回记录了上次进度的检查点(frames_path沿用上次的)，否则新建
+        """
+        path = self._path(job_key)
+        if os.path.exists(path):
+            checkpoint = self._load(path)
+            if checkpoint is not None:
+                return checkpoint
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'framesPath': frames_path, 'created': time.time()}) + '\n')
+        os.replace(tmp_path, path)
+        return ExtractionCheckpoint(path, frames_path)
+
+    def _load(self, path):
+        entries = {}
+        try:
+            with open(path) as f:
+                lines = f.read().split('\n')
+            header = json.loads(lines[0])
+            # 按创建时间判断，上次的帧前缀所在分区不能太旧
+            if time.time() - header['created'] >= self.ttl:
+                return None
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 空行或进程被杀死时写了一半的行
+                    continue
+                entries[entry['name']] = entry
+            if lines[-1]:
+                # 补上换行，之后追加的记录不会接在写了一半的行后面
+                with open(path, 'a') as f:
+                    f.write('\n')
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"无法读取提取进度 {path}: {str(e)}")
+            return None
+        return ExtractionCheckpoint(path, header['framesPath'], entries)
+
+    def prune(self):
+        """删除过期的进度日志"""
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
@@ -1,13 +1,26 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# 只在项目目录存在 .env 时才加载，避免每次启动都逐级向上查找
+_ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(_ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(_ENV_FILE)
 
 # R2 配置
 R2_ACCOUNT_ID = os.getenv('R2_ACCOUNT_ID')
 R2_ACCESS_KEY_ID = os.getenv('R2_ACCESS_KEY_ID')
 R2_SECRET_ACCESS_KEY = os.getenv('R2_SECRET_ACCESS_KEY')
 R2_BUCKET_NAME = os.getenv('R2_BUCKET_NAME', 'cheesecatool')
+# S3兼容接口地址，默认为R2账户地址；压测或本地开发时可指向 moto/minio 等本地服务
+R2_ENDPOINT_URL = os.getenv('R2_ENDPOINT_URL') or f'https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com'
+
+# 存储后端: r2 (Cloudflare R2) 或 local (本地文件系统，适合单机和内网部署)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'r2')
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'storage')
+# 前面有nginx时设置为internal location的前缀(例如 /protected/)，
+# 由nginx通过X-Accel-Redirect零拷贝返回文件；为空时由asgi_app在事件循环中按块读取文件发送
+# (uvicorn不支持零拷贝发送，生产环境建议配置)
+LOCAL_STORAGE_ACCEL_PREFIX = os.getenv('LOCAL_STORAGE_ACCEL_PREFIX', '')
 
 # Worker URL
 WORKER_URL = os.getenv('WORKER_URL', 'https://storage.y.cheesecatool.com')
@@ -48,4 +61,93 @@ CF_ZONE_ID = os.getenv('CF_ZONE_ID')
 CF_API_TOKEN = os.getenv('CF_API_TOKEN')
 
 # 缓存配置
-CACHE_CONTROL = 'public, max-age=31536000'  # 1年缓存 
\ No newline at end of file
+# 帧的地址带有内容哈希(?v=)，同一地址的内容不会变化，浏览器和CDN缓存1年且不需要重新验证
+CACHE_CONTROL = 'public, max-age=31536000, immutable'  # 1年缓存
+# 不带内容哈希的地址(以及对象本身的元数据)只短期缓存: 对象会在LIFECYCLE_EXPIRATION_HOURS后被清理删除
+UNVERSIONED_CACHE_CONTROL = 'public, max-age=300'
+
+# 性能采集配置
+# 请求头 X-Profile 携带该令牌时采集cProfile数据，未设置则只按采样率采集；
+# 下载采集文件(/api/profiles/<id>)同样需要携带该令牌，未设置时不能下载
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILES_FOLDER = os.getenv('PROFILES_FOLDER', 'profiles')
+# 只保留最近的采集文件，超过数量或时间的旧文件在每次保存后删除
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '100'))
+PROFILE_MAX_AGE_HOURS = float(os.getenv('PROFILE_MAX_AGE_HOURS', '24'))
+
+# 本机多个worker共享的状态文件目录(限流数据库等)
+STATE_FOLDER = os.getenv('STATE_FOLDER', 'state')
+
+# 准入控制 - 令牌桶按任务成本扣减，1个单位约等于一次普通请求
+ADMISSION_DB = os.getenv('ADMISSION_DB', os.path.join(STATE_FOLDER, 'admission.sqlite3'))
+ADMISSION_CAPACITY = float(os.getenv('ADMISSION_CAPACITY', '20000'))
+ADMISSION_REFILL_RATE = float(os.getenv('ADMISSION_REFILL_RATE', '20'))  # 每秒补充
+# 异步接口(asgi_app)排队等待令牌的最长秒数，超过则直接返回429；同步接口不等待，总是直接返回429
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '5'))
+# 请求头 X-API-Key 为其中之一时按Key单独限流(逗号分隔)，其他请求按客户端IP限流
+ADMISSION_API_KEYS = [key.strip() for key in os.getenv('ADMISSION_API_KEYS', '').split(',') if key.strip()]
+# 受信任的反向代理地址(IP或CIDR，逗号分隔): 来自这些地址的请求按 CF-Connecting-IP / X-Forwarded-For 识别客户端
+# 部署在Cloudflare之后时加上Cloudflare的IP段
+TRUSTED_PROXIES = os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16').split(',')
+
+# 上传目录和帧目录合计可占用的本地磁盘空间 (默认5GB)
+SPOOL_QUOTA_BYTES = int(os.getenv('SPOOL_QUOTA_BYTES', 5 * 1024 * 1024 * 1024))
+# 无法获取Content-Length时为下载的视频预留的空间 (默认500MB)
+SPOOL_DEFAULT_VIDEO_BYTES = int(os.getenv('SPOOL_DEFAULT_VIDEO_BYTES', 500 * 1024 * 1024))
+
+# 单帧接口 - 每个worker保持打开的解码器数量、空闲关闭时间(秒)和编码帧缓存大小
+FRAME_POOL_SIZE = int(os.getenv('FRAME_POOL_SIZE', '8'))
+FRAME_POOL_IDLE_SECONDS = float(os.getenv('FRAME_POOL_IDLE_SECONDS', '60'))
+FRAME_CACHE_BYTES = int(os.getenv('FRAME_CACHE_BYTES', 64 * 1024 * 1024))
+
+# 并发的相同下载/提取任务只执行一次 - 结果保留时间和等待正在执行的任务的最长时间(秒)
+# 结果引用R2中的帧，保留时间需小于R2生命周期清理的过期时间
+SINGLEFLIGHT_RESULT_TTL = float(os.getenv('SINGLEFLIGHT_RESULT_TTL', '600'))
+SINGLEFLIGHT_WAIT_TIMEOUT = float(os.getenv('SINGLEFLIGHT_WAIT_TIMEOUT', '110'))
+# 每个worker中等待相同任务的请求数上限 - 同一个键、所有键合计；等待者占用Flask线程，合计应小于ASGI_WSGI_THREADS
+SINGLEFLIGHT_MAX_WAITERS = int(os.getenv('SINGLEFLIGHT_MAX_WAITERS', '1'))
+SINGLEFLIGHT_MAX_WAITERS_TOTAL = int(os.getenv('SINGLEFLIGHT_MAX_WAITERS_TOTAL', '2'))
+
+# R2过期文件清理 (python r2_lifecycle.py，只运行一个实例)
+LIFECYCLE_EXPIRATION_HOURS = float(os.getenv('LIFECYCLE_EXPIRATION_HOURS', '1'))
+LIFECYCLE_INTERVAL = float(os.getenv('LIFECYCLE_INTERVAL', '3600'))  # 两次清理的间隔(秒)
+LIFECYCLE_PROGRESS_INTERVAL = float(os.getenv('LIFECYCLE_PROGRESS_INTERVAL', '10'))  # 进度日志的最小间隔(秒)
+
+# 提取任务的时间预算(秒)，超过后取消任务并清理已生成的文件
+# 普通请求需小于gunicorn的--timeout；流式请求持续有数据返回，可以更长
+EXTRACT_TIME_BUDGET = float(os.getenv('EXTRACT_TIME_BUDGET', '110'))
+EXTRACT_STREAM_TIME_BUDGET = float(os.getenv('EXTRACT_STREAM_TIME_BUDGET', '600'))
+# 逐帧上传任务的进度日志保留时间(秒)，重试相同任务时从中断的位置继续
+# 重试会继续写入上次的小时分区，需小于R2生命周期清理的过期时间
+EXTRACT_CHECKPOINT_TTL = float(os.getenv('EXTRACT_CHECKPOINT_TTL', '1800'))
+
+# 提取子进程 - 每个gunicorn worker预先启动的子进程数(0表示在worker进程内直接提取)、
+# 每个子进程的虚拟内存上限(MB)、每个任务的CPU时间上限(秒)、nice值和墙钟时间上限(秒)
+# 子进程执行max_jobs个任务后重新启动
+EXTRACT_POOL_SIZE = int(os.getenv('EXTRACT_POOL_SIZE', '2'))
+EXTRACT_MEMORY_LIMIT_MB = int(os.getenv('EXTRACT_MEMORY_LIMIT_MB', '2048'))
+EXTRACT_CPU_SECONDS = int(os.getenv('EXTRACT_CPU_SECONDS', '300'))
+EXTRACT_NICE = int(os.getenv('EXTRACT_NICE', '10'))
+EXTRACT_WALL_SECONDS = float(os.getenv('EXTRACT_WALL_SECONDS', '600'))
+EXTRACT_POOL_MAX_JOBS = int(os.getenv('EXTRACT_POOL_MAX_JOBS', '50'))
+
+# 日志 - 写入内存队列由后台线程输出；格式为json(每行一条JSON记录)或text
+# 逐帧的日志为DEBUG级别，INFO级别每个任务只输出一条汇总记录
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+
+# ASGI入口(asgi_app.py) - 每个worker执行Flask请求(提取、上传等)的线程数、
+# 本地存储和限流数据库操作使用的线程数、R2和图片代理的连接池大小、图片代理的超时(秒)
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '4'))
+ASGI_IO_THREADS = int(os.getenv('ASGI_IO_THREADS', '8'))
+ASGI_MAX_CONNECTIONS = int(os.getenv('ASGI_MAX_CONNECTIONS', '64'))
+PROXY_TIMEOUT = float(os.getenv('PROXY_TIMEOUT', '30'))
+
+# 通过videoUrl下载视频 - 服务器支持Range时的并行分段数、每段的最小字节数、
+# 每次读取的块大小、每段的最大重试次数、连接和读取超时(秒)
+DOWNLOAD_SEGMENTS = int(os.getenv('DOWNLOAD_SEGMENTS', '4'))
+DOWNLOAD_MIN_SEGMENT_BYTES = int(os.getenv('DOWNLOAD_MIN_SEGMENT_BYTES', 8 * 1024 * 1024))
+DOWNLOAD_CHUNK_BYTES = int(os.getenv('DOWNLOAD_CHUNK_BYTES', 1024 * 1024))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', '60'))
\ No newline at end of file
@@ -0,0 +1,228 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cancellation
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadError(IOError):
+    """连接提前结束或下载的字节数与文件大小不一致"""
+
+
+class RangeNotSupported(Exception):
+    """服务器忽略了Range请求头(返回200而不是206)"""
+
+
+def _retryable(error):
+    """连接错误、超时和5xx可以重试，4xx(地址错误、无权限等)不重试"""
+    response = getattr(error, 'response', None)
+    return response is None or response.status_code >= 500
+
+
+class _Segment:
+    """一个字节范围 [start, end]，done为已写入的字节数，重试时从start+done继续"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = 0
+        self.retries = 0
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def complete(self):
+        return self.done >= self.size
+
+
+class SegmentedDownloader:
+    """
+    分段并行下载
+
+    服务器支持Range且文件足够大时，把文件分为segments段，每段用连接池中的一个连接并行下载，
+    直接写入预先分配大小的(稀疏)文件的对应位置；某段出错时只重试该段，从已写入的位置继续。
+    不支持Range、大小未知或文件较小时用单个连接下载，支持Range时单连接出错后同样从断点继续。
+    """
+
+    def __init__(self, segments=4, min_segment_bytes=8 * 1024 * 1024, chunk_size=1024 * 1024,
+                 retries=3, timeout=60):
+        self.segments = max(1, segments)
+        self.min_segment_bytes = min_segment_bytes
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """每个进程一个Session，连接在各段和各次下载之间复用"""
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.segments * 4)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def content_length(self, url):
+        """HEAD请求获取文件大小，不下载内容；请求失败或没有Content-Length时返回None"""
+        import requests
+
+        try:
+            with self.session.head(url, allow_redirects=True, timeout=min(self.timeout, 10)) as response:
+                size = response.headers.get('Content-Length') if response.ok else None
+        except requests.RequestException as e:
+            logger.debug(f"HEAD请求失败: {str(e)}")
+            return None
+        return int(size) if size and size.isdigit() else None
+
+    def probe(self, url):
+        """
+        请求第一个字节，确认是否支持Range和文件大小
+
+        返回: (文件大小或None, 是否支持Range, 内容类型, 不支持Range时已打开的完整响应)
+        """
+        response = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code == 206:
+            # Content-Range: bytes 0-0/12345
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            response.close()
+            if total.isdigit():
+                return int(total), True, content_type, None
+            return None, False, content_type, None
+        # 服务器忽略了Range，这个响应就是完整的文件
+        size = response.headers.get('Content-Length')
+        size = int(size) if size and size.isdigit() else None
+        return size, False, content_type, response
+
+    def plan(self, size):
+        """按文件大小划分字节范围，每段不小于min_segment_bytes"""
+        count = max(1, min(self.segments, size // max(1, self.min_segment_bytes)))
+        step = -(-size // count)
+        return [_Segment(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    def _fetch(self, url, path, segment, cancel, stop):
+        """下载一段，出错时从已写入的位置重试，返回该段的字节数"""
+        while True:
+            try:
+                headers = {'Range': f"bytes={segment.start + segment.done}-{segment.end}"}
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise RangeNotSupported(f"服务器返回 {response.status_code}")
+                    with open(path, 'r+b') as f:
+                        f.seek(segment.start + segment.done)
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            if stop.is_set():
+                                return segment.done
+                            cancellation.check(cancel)
+                            chunk = chunk[:segment.size - segment.done]
+                            f.write(chunk)
+                            segment.done += len(chunk)
+                            if segment.complete:
+                                break
+                if segment.complete:
+                    return segment.done
+                raise DownloadError(f"连接提前结束: 已下载 {segment.done}/{segment.size} 字节")
+            except (RangeNotSupported, cancellation.Cancelled):
+                raise
+            except Exception as e:
+                if not _retryable(e) or segment.retries >= self.retries or stop.is_set():
+                    raise
+                segment.retries += 1
+                logger.warning(f"下载分段 {segment.start}-{segment.end} 出错，第 {segment.retries} 次重试"
+                               f"(已下载 {segment.done} 字节): {str(e)}")
+                time.sleep(min(2 ** segment.retries * 0.25, 5))
+
+    def _parallel(self, url, path, size, cancel):
+        segments = self.plan(size)
+        # 预先设置文件大小(稀疏文件)，各段直接写入自己的位置
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        if len(segments) == 1:
+            self._fetch(url, path, segments[0], cancel, threading.Event())
+            return segments
+
+        stop = threading.Event()
+        with ThreadPoolExecutor(len(segments), thread_name_prefix='download') as executor:
+            futures = [executor.submit(self._fetch, url, path, segment, cancel, stop) for segment in segments]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # 一段失败时让其他段尽快停止
+                stop.set()
+                raise
+        return segments
+
+    def _single(self, url, path, cancel, response=None):
+        """单连接下载(服务器不支持Range)，出错或内容不完整时从头重试"""
+        attempt = 0
+        while True:
+            try:
+                if response is None:
+                    response = self.session.get(url, stream=True, timeout=self.timeout)
+                    response.raise_for_status()
+                written = 0
+                with response, open(path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        cancellation.check(cancel)
+                        f.write(chunk)
+                        written += len(chunk)
+                expected = response.headers.get('Content-Length')
+                if expected and expected.isdigit() and written != int(expected):
+                    raise DownloadError(f"下载的文件不完整: {written}/{expected} 字节")
+                return written, attempt
+            except cancellation.Cancelled:
+                raise
+            except Exception as e:
+                response = None
+                if not _retryable(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.warning(f"下载出错，第 {attempt} 次重试: {str(e)}")
+                time.sleep(min(2 ** attempt * 0.25, 5))
+
+    def download(self, url, path, cancel=None, size=None, ranges=None, response=None):
+        """
+        下载url到path
+
+        size/ranges/response为probe()的结果，未提供时先调用probe()。
+        返回: 统计信息 {bytes, seconds, segments, retries, mode}
+        """
+        t0 = time.perf_counter()
+        if ranges is None:
+            size, ranges, _, response = self.probe(url)
+
+        stats = {'mode': 'single', 'segments': 1, 'retries': 0}
+        if ranges and size:
+            try:
+                segments = self._parallel(url, path, size, cancel)
+                stats.update(
+                    mode='ranged',
+                    segments=len(segments),
+                    retries=sum(segment.retries for segment in segments),
+                    bytes=size
+                )
+            except RangeNotSupported as e:
+                logger.warning(f"服务器不支持分段下载，改为单连接下载: {str(e)}")
+                ranges = False
+        if not (ranges and size):
+            written, retries = self._single(url, path, cancel, response)
+            stats.update(retries=retries, bytes=written)
+        stats['seconds'] = time.perf_counter() - t0
+        return stats
@@ -1,29 +1,91 @@
 import cv2
 import os
+import sys
+import glob
+import json
+import time
+import io
+import hashlib
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tracing import current_trace, start_trace, end_trace
+from cancellation import Cancelled, check as check_cancel
+from similarity import frame_hash, save_hashes, HASHES_FILE
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-def extract_frames(video_path, output_dir, fps=1, start_time=None, end_time=None, format="jpg", quality=90):
+def _normalize_fps(fps):
+    """确保fps是大于0的浮点数，无效时使用默认值1"""
+    try:
+        fps = float(fps)
+        if fps <= 0:
+            logger.warning(f"fps参数必须大于0: {fps}，使用默认值1")
+            fps = 1.0
+    except (ValueError, TypeError) as e:
+        logger.warning(f"fps参数无效: {fps}, 错误: {e}，使用默认值1")
+        fps = 1.0
+    return fps
+
+def plan_frames(video_fps, frame_count, fps, start_time=None, end_time=None):
     """
-    从视频中提取帧
+    计算提取范围
+    
+    返回: (开始帧, 结束帧, 提取间隔)，保留的帧为 [开始帧, 结束帧) 中能被间隔整除的帧
+    """
+    # 计算提取帧的间隔
+    frame_interval = int(video_fps / fps)
+    if frame_interval < 1:
+        frame_interval = 1
+    
+    # 计算开始和结束帧
+    start_frame = 0
+    if start_time is not None:
+        start_frame = int(start_time * video_fps)
+    
+    end_frame = frame_count
+    if end_time is not None:
+        end_frame = int(end_time * video_fps)
+    
+    return start_frame, end_frame, frame_interval
+
+def count_planned_frames(start_frame, end_frame, frame_interval):
+    """按计划最多会保留的帧数"""
+    if end_frame <= start_frame:
+        return 0
+    first = -(-start_frame // frame_interval)
+    last = (end_frame - 1) // frame_interval
+    return max(0, last - first + 1)
+
+def iter_frames(video_path, fps=1, start_time=None, end_time=None, batch_size=None, out=None, reuse=False,
+                cancel=None, first_index=0):
+    """
+    按需逐帧解码视频，惰性返回需要保留的帧
     
     参数:
     video_path: 视频文件路径
-    output_dir: 输出目录
     fps: 每秒提取的帧数
     start_time: 开始提取的时间(秒)
     end_time: 结束提取的时间(秒)
-    format: 输出图像格式(jpg或png)
-    quality: 输出图像质量(1-100)
+    batch_size: 不为None时按批返回堆叠后的数组
+    out: 批量模式下复用的输出数组，形状为(batch_size, H, W, C)；
+         帧直接解码到其中，每批返回的是它的切片，下一批会覆盖其内容
+    reuse: 逐帧模式下复用同一个解码缓冲区，返回的数组在下一次迭代时会被覆盖
+    cancel: 取消令牌(cancellation.CancelToken)，每个保留的帧解码前检查，已取消时抛出Cancelled
+    first_index: 从第几个保留的帧开始(恢复中断的任务时使用)，之前的帧直接跳过不解码
     
-    返回: 
-    int - 提取的帧数量
+    不需要保留的帧只调用grab()，不做颜色转换也不分配内存。
+    
+    返回:
+    生成器 - 逐帧模式下为 (序号, 时间戳秒, ndarray)；
+             批量模式下为 (序号数组, 时间戳数组, 形状为(n, H, W, C)的ndarray)
     """
-    logger.info(f"开始处理视频: {video_path}")
-    logger.info(f"参数: fps={fps}, start_time={start_time}, end_time={end_time}, format={format}, quality={quality}")
+    import numpy as np
+    
+    fps = _normalize_fps(fps)
+    if batch_size is not None and batch_size < 1:
+        raise ValueError(f"batch_size必须大于0: {batch_size}")
     
     # 检查输入参数
     if not os.path.exists(video_path):
@@ -31,31 +93,6 @@ def extract_frames(video_path, output_dir, fps=1, start_time=None, end_time=None
         logger.error(err_msg)
         raise FileNotFoundError(err_msg)
     
-    # 确保quality是整数
-    try:
-        quality = int(quality)
-        if quality < 1 or quality > 100:
-            logger.warning(f"质量参数超出范围(1-100): {quality}，使用默认值90")
-            quality = 90
-    except (ValueError, TypeError) as e:
-        logger.warning(f"质量参数无效: {quality}, 错误: {e}，使用默认值90")
-        quality = 90
-    
-    # 确保fps是浮点数
-    try:
-        fps = float(fps)
-        if fps <= 0:
-            logger.warning(f"fps参数必须大于0: {fps}，使用默认值1")
-            fps = 1.0
-    except (ValueError, TypeError) as e:
-        logger.warning(f"fps参数无效: {fps}, 错误: {e}，使用默认值1")
-        fps = 1.0
-    
-    # 确保输出目录存在
-    if not os.path.exists(output_dir):
-        logger.info(f"创建输出目录: {output_dir}")
-        os.makedirs(output_dir)
-    
     # 打开视频文件
     logger.info(f"打开视频文件: {video_path}")
     cap = cv2.VideoCapture(video_path)
@@ -64,6 +101,8 @@ def extract_frames(video_path, output_dir, fps=1, start_time=None, end_time=None
         logger.error(err_msg)
         raise ValueError(err_msg)
     
+    decoded = 0
+    decode_time = 0.0
     try:
         # 获取视频属性
         video_fps = cap.get(cv2.CAP_PROP_FPS)
@@ -72,78 +111,736 @@ def extract_frames(video_path, output_dir, fps=1, start_time=None, end_time=None
         
         logger.info(f"视频属性: fps={video_fps}, 总帧数={frame_count}, 时长={duration}秒")
         
-        # 计算提取帧的间隔
-        frame_interval = int(video_fps / fps)
-        if frame_interval < 1:
-            frame_interval = 1
+        start_frame, end_frame, frame_interval = plan_frames(video_fps, frame_count, fps, start_time, end_time)
         
         logger.info(f"提取帧间隔: {frame_interval}帧")
-        
-        # 计算开始和结束帧
-        start_frame = 0
-        if start_time is not None:
-            start_frame = int(start_time * video_fps)
-        
-        end_frame = frame_count
-        if end_time is not None:
-            end_frame = int(end_time * video_fps)
-        
         logger.info(f"提取范围: 开始帧={start_frame}, 结束帧={end_frame}")
         
-        # 设置文件扩展名和保存参数
-        if format.lower() == "jpg":
-            ext = ".jpg"
-            save_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
-        else:
-            ext = ".png"
-            save_params = [cv2.IMWRITE_PNG_COMPRESSION, min(9, 10 - int(quality / 10))]
-        
-        logger.info(f"输出格式: {format}, 参数: {save_params}")
+        # 保留的帧号是frame_interval的倍数，第first_index个保留的帧之前的部分直接跳过
+        index = 0
+        if first_index > 0:
+            first_kept = -(-start_frame // frame_interval) * frame_interval
+            start_frame = first_kept + first_index * frame_interval
+            index = first_index
+            logger.info(f"从第{first_index}个保留的帧继续提取")
         
         # 移动到起始帧
         if start_frame > 0:
             logger.info(f"移动到起始帧: {start_frame}")
             cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
         
-        # 提取帧
         frame_number = start_frame
-        count = 0
-        
-        logger.info("开始提取帧...")
+        # 逐帧模式复用的解码缓冲区，第一帧解码后按实际形状确定
+        frame_buf = None
+        # 批量模式的输出缓冲区，未传入out时在第一帧后分配
+        batch_buf = out
+        batch_len = 0
+        if batch_size is not None:
+            batch_indices = np.empty(batch_size, dtype=np.int64)
+            batch_timestamps = np.empty(batch_size, dtype=np.float64)
         while frame_number < end_frame:
-            ret, frame = cap.read()
+            keep = frame_number % frame_interval == 0
+            if keep:
+                check_cancel(cancel)
+            t0 = time.perf_counter()
+            ret = cap.grab()
+            frame = None
+            if ret and keep:
+                if batch_size is None:
+                    target = frame_buf
+                else:
+                    target = batch_buf[batch_len] if batch_buf is not None else None
+                # 解码到预分配的缓冲区中，形状不一致时OpenCV会重新分配
+                if target is not None:
+                    ret, frame = cap.retrieve(target)
+                else:
+                    ret, frame = cap.retrieve()
+            decode_time += time.perf_counter() - t0
             if not ret:
                 logger.warning(f"读取第{frame_number}帧失败，提前结束")
                 break
+            decoded += 1
             
-            if frame_number % frame_interval == 0:
-                output_path = os.path.join(output_dir, f"frame_{count:06d}{ext}")
-                cv2.imwrite(output_path, frame, save_params)
-                count += 1
-                
-                if count % 10 == 0:
-                    logger.info(f"已提取 {count} 帧")
+            if keep:
+                timestamp = frame_number / video_fps
+                if batch_size is None:
+                    if reuse:
+                        frame_buf = frame
+                    yield index, timestamp, frame
+                else:
+                    if batch_buf is None:
+                        batch_buf = np.empty((batch_size,) + frame.shape, dtype=frame.dtype)
+                    slot = batch_buf[batch_len]
+                    if not np.may_share_memory(frame, slot):
+                        slot[...] = frame
+                    batch_indices[batch_len] = index
+                    batch_timestamps[batch_len] = timestamp
+                    batch_len += 1
+                    if batch_len == batch_size:
+                        yield batch_indices.copy(), batch_timestamps.copy(), batch_buf
+                        batch_len = 0
+                        if out is None:
+                            # 返回的数组归调用方所有，下一批重新分配
+                            batch_buf = None
+                index += 1
             
             frame_number += 1
         
-        logger.info(f"提取完成，共 {count} 帧")
-        return count
+        if batch_len:
+            yield batch_indices[:batch_len].copy(), batch_timestamps[:batch_len].copy(), batch_buf[:batch_len]
+    finally:
+        cap.release()
+        logger.info(f"释放视频资源，共解码 {decoded} 帧，解码耗时 {decode_time:.2f}秒")
+        
+        # 记录到当前请求的计时中
+        trace = current_trace()
+        if trace is not None:
+            trace.add('decode', decode_time, decoded)
+
+# npy格式的输出文件名
+NPY_FRAMES_FILE = 'frames.npy'
+NPY_TIMESTAMPS_FILE = 'timestamps.npy'
+
+def _truncate_npy(path, count):
+    """把npy文件的第一维缩小为count，用于实际读取的帧数少于预估的情况"""
+    import numpy as np
+    
+    with open(path, 'r+b') as fp:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            read_header, write_header = np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0
+        else:
+            read_header, write_header = np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0
+        shape, fortran_order, dtype = read_header(fp)
+        offset = fp.tell()
+        
+        new_shape = (count,) + tuple(shape[1:])
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order, 'shape': new_shape}
+        buf = io.BytesIO()
+        write_header(buf, header)
+        if buf.tell() == offset:
+            # 头部长度不变时原地修改并截断文件
+            fp.seek(0)
+            fp.write(buf.getvalue())
+            row_bytes = dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+            fp.truncate(offset + count * row_bytes)
+            return
+    
+    # 头部长度变化时复制一份
+    data = np.load(path, mmap_mode='r')
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, data[:count])
+    del data
+    os.replace(tmp_path, path)
+
+def extract_frames_npy(video_path, output_dir, fps=1, start_time=None, end_time=None, gray=False, width=None,
+                       cancel=None):
+    """
+    把保留的帧直接写入一个预分配的 numpy.memmap (.npy) 文件，不做图片编码
+    
+    输出:
+    frames.npy - 形状为(N, H, W, C)的uint8数组，通道顺序为RGB，灰度时C为1
+    timestamps.npy - 形状为(N,)的float64数组，每帧的时间戳(秒)
+    
+    返回:
+    int - 提取的帧数量
+    """
+    import numpy as np
+    
+    if not os.path.exists(video_path):
+        err_msg = f"视频文件不存在: {video_path}"
+        logger.error(err_msg)
+        raise FileNotFoundError(err_msg)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # 先读取视频属性，计算输出数组的形状
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise ValueError(f"无法打开视频文件: {video_path}")
+        video_fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        src_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        src_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+    
+    planned = count_planned_frames(*plan_frames(video_fps, frame_count, _normalize_fps(fps), start_time, end_time))
+    out_width, out_height = src_width, src_height
+    if width and int(width) != src_width:
+        out_width = int(width)
+        out_height = max(1, round(src_height * out_width / src_width))
+    channels = 1 if gray else 3
+    
+    frames_path = os.path.join(output_dir, NPY_FRAMES_FILE)
+    timestamps_path = os.path.join(output_dir, NPY_TIMESTAMPS_FILE)
+    logger.info(f"创建帧数组: {frames_path}, 形状=({planned}, {out_height}, {out_width}, {channels})")
+    frames = np.lib.format.open_memmap(
+        frames_path, mode='w+', dtype=np.uint8,
+        shape=(planned, out_height, out_width, channels)
+    )
+    timestamps = np.zeros(planned, dtype=np.float64)
+    color_code = cv2.COLOR_BGR2GRAY if gray else cv2.COLOR_BGR2RGB
+    resize_buf = None
+    if (out_width, out_height) != (src_width, src_height):
+        resize_buf = np.empty((out_height, out_width, 3), dtype=np.uint8)
+    
+    count = 0
+    encode_time = 0.0
+    try:
+        for index, timestamp, frame in iter_frames(video_path, fps, start_time, end_time, reuse=True, cancel=cancel):
+            if count >= planned:
+                logger.warning(f"实际帧数超过预估的 {planned} 帧，忽略多余的帧")
+                break
+            t0 = time.perf_counter()
+            if resize_buf is not None:
+                frame = cv2.resize(frame, (out_width, out_height), dst=resize_buf, interpolation=cv2.INTER_AREA)
+            # 直接转换到内存映射数组中，不产生中间副本
+            cv2.cvtColor(frame, color_code, dst=frames[count])
+            timestamps[count] = timestamp
+            encode_time += time.perf_counter() - t0
+            count += 1
+        frames.flush()
+    finally:
+        del frames
+        trace = current_trace()
+        if trace is not None:
+            trace.add('encode', encode_time, count)
+    
+    if count < planned:
+        _truncate_npy(frames_path, count)
+    np.save(timestamps_path, timestamps[:count])
+    
+    logger.info(f"提取完成，共 {count} 帧写入 {frames_path}")
+    return count
+
+def _encode_params(format, quality):
+    """
+    根据输出格式和质量确定文件扩展名和OpenCV编码参数
+    
+    返回: (扩展名, 编码参数)
+    """
+    # 确保quality是整数
+    try:
+        quality = int(quality)
+        if quality < 1 or quality > 100:
+            logger.warning(f"质量参数超出范围(1-100): {quality}，使用默认值90")
+            quality = 90
+    except (ValueError, TypeError) as e:
+        logger.warning(f"质量参数无效: {quality}, 错误: {e}，使用默认值90")
+        quality = 90
+    
+    # 设置文件扩展名和保存参数
+    if format.lower() == "jpg":
+        ext = ".jpg"
+        save_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    else:
+        ext = ".png"
+        save_params = [cv2.IMWRITE_PNG_COMPRESSION, min(9, 10 - int(quality / 10))]
+    
+    logger.info(f"输出格式: {format}, 参数: {save_params}")
+    return ext, save_params
+
+# 按目标大小选择JPEG质量: 质量的搜索范围，以及大小在目标的 (1-容差, 1] 之间时直接采用
+TARGET_MIN_QUALITY = 10
+TARGET_MAX_QUALITY = 95
+TARGET_TOLERANCE = 0.15
+
+class _QualitySearch:
+    """
+    为每帧选择不超过目标字节数的最高JPEG质量
+    
+    从上一帧选定的质量开始，大小落在目标下方的容差范围内时只需编码一次；
+    否则在剩余的质量区间内二分查找。同一场景中相邻帧的复杂度相近，
+    大多数帧一次命中，只有场景切换时才需要多次编码。
+    """
+    
+    def __init__(self, target_bytes, quality):
+        self.target_bytes = target_bytes
+        self.quality = min(TARGET_MAX_QUALITY, max(TARGET_MIN_QUALITY, int(quality)))
+        self.encodes = 0
+    
+    def encode(self, frame):
+        """返回: (编码后的内容, 选定的质量)"""
+        low, high = TARGET_MIN_QUALITY, TARGET_MAX_QUALITY
+        quality = self.quality
+        best = None
+        smallest = None
+        while True:
+            ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            self.encodes += 1
+            if not ok:
+                raise ValueError(f"质量 {quality} 编码失败")
+            size = len(encoded)
+            if size <= self.target_bytes:
+                if best is None or quality > best[1]:
+                    best = (encoded, quality)
+                if size >= self.target_bytes * (1 - TARGET_TOLERANCE):
+                    break
+                low = quality + 1
+            else:
+                if smallest is None or size < len(smallest[0]):
+                    smallest = (encoded, quality)
+                high = quality - 1
+            if low > high:
+                break
+            quality = (low + high) // 2
+        
+        # 最低质量也超过目标时使用最小的结果
+        result = best or smallest
+        self.quality = result[1]
+        return result
+
+def _target_search(ext, target_kb, quality):
+    """按目标大小编码时返回质量搜索器；只支持JPEG(PNG是无损的，质量只影响压缩级别)"""
+    if not target_kb:
+        return None
+    if ext != '.jpg':
+        logger.warning(f"目标大小只支持jpg格式，忽略targetKB={target_kb}")
+        return None
+    return _QualitySearch(float(target_kb) * 1024, quality)
+
+def write_frames(video_path, output_dir, fps=1, start_time=None, end_time=None, format="jpg", quality=90,
+                 cancel=None, first_index=0, phash=False, target_kb=None):
+    """
+    逐帧提取并写入图片文件，每写完一帧立即返回，便于调用方边提取边上传
+    
+    参数与extract_frames相同(不支持npy格式)，first_index见iter_frames
+    phash: 同时计算每帧的感知哈希(similarity.frame_hash)
+    
+    返回:
+    生成器 - (序号, 时间戳秒, 输出文件路径, 附加信息)
+    附加信息是dict: phash为True时有phash(感知哈希)，按目标大小编码时有quality(选定的质量)
+    """
+    logger.info(f"开始处理视频: {video_path}")
+    logger.info(f"参数: fps={fps}, start_time={start_time}, end_time={end_time}, format={format}, quality={quality}")
+    
+    # 检查输入参数
+    if not os.path.exists(video_path):
+        err_msg = f"视频文件不存在: {video_path}"
+        logger.error(err_msg)
+        raise FileNotFoundError(err_msg)
+    
+    # 确保输出目录存在
+    if not os.path.exists(output_dir):
+        logger.info(f"创建输出目录: {output_dir}")
+        os.makedirs(output_dir)
+    
+    ext, save_params = _encode_params(format, quality)
+    search = _target_search(ext, target_kb, quality)
+    
+    count = 0
+    encode_time = 0.0
+    hash_time = 0.0
+    try:
+        logger.info("开始提取帧...")
+        # imwrite直接编码写入文件，配合复用的解码缓冲区，循环中不再分配帧大小的数组
+        for index, timestamp, frame in iter_frames(video_path, fps, start_time, end_time, reuse=True, cancel=cancel,
+                                                   first_index=first_index):
+            t0 = time.perf_counter()
+            output_path = os.path.join(output_dir, f"frame_{index:06d}{ext}")
+            extra = {}
+            if search is not None:
+                encoded, extra['quality'] = search.encode(frame)
+                encoded.tofile(output_path)
+            else:
+                cv2.imwrite(output_path, frame, save_params)
+            encode_time += time.perf_counter() - t0
+            count += 1
+            
+            if phash:
+                t0 = time.perf_counter()
+                extra['phash'] = frame_hash(frame)
+                hash_time += time.perf_counter() - t0
+            
+            if count % 100 == 0:
+                logger.debug("已提取 %d 帧", count)
+            
+            yield index, timestamp, output_path, extra
+        
+        logger.info(f"提取完成，共 {count} 帧，编码耗时 {encode_time:.2f}秒")
+    except Cancelled as e:
+        logger.info(f"提取已取消({e.reason})，已提取 {count} 帧")
+        raise
     except Exception as e:
         logger.error(f"提取帧过程中出错: {str(e)}", exc_info=True)
         raise
     finally:
-        cap.release()
-        logger.info("释放视频资源")
+        trace = current_trace()
+        if trace is not None:
+            # 按目标大小编码时计数为实际编码次数
+            trace.add('encode', encode_time, search.encodes if search is not None else count)
+            if phash:
+                trace.add('phash', hash_time, count)
+
+# 打包输出: 所有帧编码后顺序写入一个文件，清单记录每帧的偏移和长度，
+# 存储端只需保存两个对象，单帧通过HTTP Range读取
+BUNDLE_FILE = 'frames.bundle'
+BUNDLE_MANIFEST_FILE = 'manifest.json'
+
+def extract_frames_bundle(video_path, output_dir, fps=1, start_time=None, end_time=None, format="jpg", quality=90,
+                          cancel=None, phash=False, target_kb=None):
+    """
+    提取帧并打包为单个文件
+    
+    在output_dir中生成 frames.bundle 和 manifest.json，清单中每帧记录
+    name(与逐帧输出的文件名相同)、index、timestamp、offset、length，
+    以及编码后内容的md5(用作帧地址的版本号和ETag)。
+    phash为True时另外生成 phash.npy (按序号排列的感知哈希，见similarity.save_hashes)，清单的phash字段为其文件名。
+    按目标大小编码时每帧另外记录选定的quality。
+    
+    返回:
+    dict - 清单内容
+    """
+    if not os.path.exists(video_path):
+        err_msg = f"视频文件不存在: {video_path}"
+        logger.error(err_msg)
+        raise FileNotFoundError(err_msg)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    ext, save_params = _encode_params(format, quality)
+    search = _target_search(ext, target_kb, quality)
+    bundle_path = os.path.join(output_dir, BUNDLE_FILE)
+    
+    entries = []
+    hashes = {}
+    offset = 0
+    encode_time = 0.0
+    hash_time = 0.0
+    try:
+        with open(bundle_path, 'wb') as f:
+            for index, timestamp, frame in iter_frames(video_path, fps, start_time, end_time, reuse=True, cancel=cancel):
+                t0 = time.perf_counter()
+                if search is not None:
+                    encoded, chosen = search.encode(frame)
+                else:
+                    ok, encoded = cv2.imencode(ext, frame, save_params)
+                    if not ok:
+                        raise ValueError(f"第 {index} 帧编码失败")
+                f.write(encoded)
+                encode_time += time.perf_counter() - t0
+                
+                entries.append({
+                    'name': f"frame_{index:06d}{ext}",
+                    'index': len(entries),
+                    'timestamp': timestamp,
+                    'offset': offset,
+                    'length': len(encoded),
+                    'md5': hashlib.md5(encoded).hexdigest()
+                })
+                if search is not None:
+                    entries[-1]['quality'] = chosen
+                offset += len(encoded)
+                
+                if phash:
+                    t0 = time.perf_counter()
+                    hashes[entries[-1]['index']] = frame_hash(frame)
+                    hash_time += time.perf_counter() - t0
+    finally:
+        trace = current_trace()
+        if trace is not None:
+            trace.add('encode', encode_time, search.encodes if search is not None else len(entries))
+            if phash:
+                trace.add('phash', hash_time, len(hashes))
+    
+    manifest = {
+        'version': 1,
+        'bundle': BUNDLE_FILE,
+        'format': ext[1:],
+        'contentType': 'image/jpeg' if ext == '.jpg' else 'image/png',
+        'size': offset,
+        'frames': entries
+    }
+    if phash:
+        save_hashes(os.path.join(output_dir, HASHES_FILE), hashes)
+        manifest['phash'] = HASHES_FILE
+    with open(os.path.join(output_dir, BUNDLE_MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    
+    logger.info(f"打包完成，共 {len(entries)} 帧，{offset} 字节，编码耗时 {encode_time:.2f}秒")
+    return manifest
+
+def extract_frames(video_path, output_dir, fps=1, start_time=None, end_time=None, format="jpg", quality=90,
+                   gray=False, width=None, bundle=False, cancel=None, target_kb=None):
+    """
+    从视频中提取帧
+    
+    参数:
+    video_path: 视频文件路径
+    output_dir: 输出目录
+    fps: 每秒提取的帧数
+    start_time: 开始提取的时间(秒)
+    end_time: 结束提取的时间(秒)
+    format: 输出图像格式(jpg、png，或npy表示写入单个数组文件)
+    quality: 输出图像质量(1-100)
+    gray: 仅npy格式，输出灰度图
+    width: 仅npy格式，按宽度等比缩放
+    bundle: jpg/png格式，把所有帧打包为一个文件
+    cancel: 取消令牌，已取消时抛出Cancelled，已写入的输出由调用方清理
+    target_kb: 仅jpg格式，每帧的目标大小(KB)；设置后quality只作为第一帧的初始质量，
+               之后每帧从上一帧选定的质量开始搜索不超过目标大小的最高质量
+    
+    返回: 
+    int - 提取的帧数量
+    """
+    if format.lower() == "npy":
+        return extract_frames_npy(video_path, output_dir, fps, start_time, end_time, gray=gray, width=width,
+                                  cancel=cancel)
+    if bundle:
+        manifest = extract_frames_bundle(video_path, output_dir, fps, start_time, end_time, format, quality,
+                                         cancel=cancel, target_kb=target_kb)
+        return len(manifest['frames'])
+    
+    count = 0
+    for _ in write_frames(video_path, output_dir, fps, start_time, end_time, format, quality, cancel=cancel,
+                          target_kb=target_kb):
+        count += 1
+    return count
+
+# 批量模式下支持的视频扩展名
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.wmv', '.flv', '.mkv')
+
+# 输出目录中的完成标记文件
+COMPLETE_MARKER = '.complete.json'
+
+def collect_videos(inputs, manifest=None):
+    """
+    展开批量模式的输入: 文件路径、通配符、目录，以及清单文件中的路径
+    
+    清单文件每行一个路径，#开头的行为注释；也可以是JSON数组。
+    返回去重后保持原顺序的绝对路径列表。
+    """
+    patterns = list(inputs)
+    if manifest:
+        with open(manifest, encoding='utf-8') as f:
+            content = f.read()
+        if content.lstrip().startswith('['):
+            patterns.extend(json.loads(content))
+        else:
+            patterns.extend(
+                line.strip() for line in content.splitlines()
+                if line.strip() and not line.strip().startswith('#')
+            )
+    
+    videos = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(
+                os.path.join(pattern, name) for name in os.listdir(pattern)
+                if name.lower().endswith(VIDEO_EXTENSIONS)
+            )
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+        for path in matches:
+            path = os.path.abspath(path)
+            if path not in seen:
+                seen.add(path)
+                videos.append(path)
+    return videos
+
+def batch_output_dirs(videos, output_root):
+    """为每个视频分配输出目录，同名视频追加路径哈希避免冲突"""
+    names = {}
+    for video in videos:
+        name = os.path.splitext(os.path.basename(video))[0]
+        names.setdefault(name, []).append(video)
+    
+    output_dirs = {}
+    for name, paths in names.items():
+        for video in paths:
+            if len(paths) > 1:
+                digest = hashlib.sha1(video.encode('utf-8')).hexdigest()[:8]
+                output_dirs[video] = os.path.join(output_root, f"{name}_{digest}")
+            else:
+                output_dirs[video] = os.path.join(output_root, name)
+    return output_dirs
+
+def read_complete_marker(output_dir, params):
+    """读取完成标记，参数一致且视频未修改时返回记录的结果，否则返回None"""
+    try:
+        with open(os.path.join(output_dir, COMPLETE_MARKER), encoding='utf-8') as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if marker.get('params') != params:
+        return None
+    return marker
+
+def _init_batch_worker():
+    # 多个进程并行时让OpenCV单线程运行，避免线程数超过CPU核数
+    cv2.setNumThreads(1)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+def _batch_extract_one(video_path, output_dir, params):
+    """批量模式下在子进程中处理单个视频，返回结果摘要"""
+    trace, token = start_trace()
+    started = time.perf_counter()
+    try:
+        # 先删除旧的完成标记，中途中断时不会被误认为已完成
+        marker_path = os.path.join(output_dir, COMPLETE_MARKER)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        
+        count = extract_frames(video_path, output_dir, **params)
+        total_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(output_dir)
+            if entry.is_file() and entry.name != COMPLETE_MARKER
+        )
+        result = {
+            'video': video_path,
+            'output_dir': output_dir,
+            'status': 'done',
+            'frames': count,
+            'bytes': total_bytes,
+            'seconds': round(time.perf_counter() - started, 3),
+            'timings': trace.as_dict()
+        }
+        
+        # 原子写入完成标记
+        tmp_path = marker_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(result, params=params, video_mtime=os.path.getmtime(video_path)), f)
+        os.replace(tmp_path, marker_path)
+        return result
+    except Exception as e:
+        return {
+            'video': video_path,
+            'output_dir': output_dir,
+            'status': 'failed',
+            'error': str(e),
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+    finally:
+        end_trace(token)
+
+def default_workers():
+    """可用的CPU核数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def extract_batch(videos, output_root, workers=None, **params):
+    """
+    使用进程池批量提取多个视频的帧
+    
+    已有完成标记且参数相同的视频会被跳过，因此中断后重新运行可以继续。
+    返回: dict - 包含每个视频结果的摘要
+    """
+    started = time.perf_counter()
+    output_dirs = batch_output_dirs(videos, output_root)
+    results = []
+    pending = []
+    for video in videos:
+        marker = read_complete_marker(output_dirs[video], params)
+        if marker and os.path.exists(video) and marker.get('video_mtime') == os.path.getmtime(video):
+            logger.info(f"跳过已完成的视频: {video}")
+            result = {key: marker[key] for key in ('video', 'output_dir', 'frames', 'bytes', 'seconds', 'timings')}
+            result['status'] = 'skipped'
+            results.append(result)
+        else:
+            pending.append(video)
+    
+    workers = max(1, min(workers or default_workers(), len(pending) or 1))
+    logger.info(f"批量提取: 共 {len(videos)} 个视频，待处理 {len(pending)} 个，进程数 {workers}")
+    
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker) as pool:
+            futures = [
+                pool.submit(_batch_extract_one, video, output_dirs[video], params)
+                for video in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'done':
+                    logger.info(f"完成: {result['video']}，{result['frames']} 帧，{result['seconds']}秒")
+                else:
+                    logger.error(f"失败: {result['video']}: {result['error']}")
+    
+    order = {video: i for i, video in enumerate(videos)}
+    results.sort(key=lambda r: order[r['video']])
+    return {
+        'videos': results,
+        'total': len(videos),
+        'done': sum(1 for r in results if r['status'] == 'done'),
+        'skipped': sum(1 for r in results if r['status'] == 'skipped'),
+        'failed': sum(1 for r in results if r['status'] == 'failed'),
+        'frames': sum(r.get('frames', 0) for r in results),
+        'bytes': sum(r.get('bytes', 0) for r in results),
+        'seconds': round(time.perf_counter() - started, 3),
+        'workers': workers
+    }
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog="extract_frames.py batch", description="批量从多个视频中提取帧")
+    parser.add_argument("inputs", nargs="*", help="视频文件路径、通配符或目录")
+    parser.add_argument("-o", "--output-root", required=True, help="输出根目录，每个视频一个子目录")
+    parser.add_argument("--manifest", help="清单文件，每行一个视频路径或通配符")
+    parser.add_argument("--workers", type=int, help="并行进程数(默认为可用CPU核数)")
+    parser.add_argument("--summary", help="结果摘要JSON文件路径")
+    parser.add_argument("--fps", type=float, default=1, help="每秒提取的帧数")
+    parser.add_argument("--start", type=float, help="开始提取的时间(秒)")
+    parser.add_argument("--end", type=float, help="结束提取的时间(秒)")
+    parser.add_argument("--format", choices=["jpg", "png", "npy"], default="jpg", help="输出图像格式")
+    parser.add_argument("--quality", type=int, default=90, help="输出图像质量(1-100)")
+    parser.add_argument("--target-kb", type=float, help="jpg格式每帧的目标大小(KB)，按帧自动选择质量")
+    parser.add_argument("--gray", action="store_true", help="npy格式输出灰度图")
+    parser.add_argument("--width", type=int, help="npy格式按宽度等比缩放")
+    
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    videos = collect_videos(args.inputs, args.manifest)
+    if not videos:
+        print("错误: 没有找到任何视频文件")
+        exit(1)
+    
+    summary = extract_batch(
+        videos,
+        args.output_root,
+        workers=args.workers,
+        fps=args.fps,
+        start_time=args.start,
+        end_time=args.end,
+        format=args.format,
+        quality=args.quality,
+        gray=args.gray,
+        width=args.width,
+        target_kb=args.target_kb
+    )
+    
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    
+    print(f"完成 {summary['done']} 个，跳过 {summary['skipped']} 个，失败 {summary['failed']} 个，"
+          f"共提取 {summary['frames']} 帧，耗时 {summary['seconds']}秒")
+    if summary['failed']:
+        exit(1)
 
 def main():
+    # 批量模式: extract_frames.py batch <视频...> -o <输出根目录>
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+    
     parser = argparse.ArgumentParser(description="从视频中提取帧")
     parser.add_argument("video_path", help="视频文件路径")
     parser.add_argument("output_dir", help="输出目录")
     parser.add_argument("--fps", type=float, default=1, help="每秒提取的帧数")
     parser.add_argument("--start", type=float, help="开始提取的时间(秒)")
     parser.add_argument("--end", type=float, help="结束提取的时间(秒)")
-    parser.add_argument("--format", choices=["jpg", "png"], default="jpg", help="输出图像格式")
+    parser.add_argument("--format", choices=["jpg", "png", "npy"], default="jpg", help="输出图像格式")
     parser.add_argument("--quality", type=int, default=90, help="输出图像质量(1-100)")
+    parser.add_argument("--target-kb", type=float, help="jpg格式每帧的目标大小(KB)，按帧自动选择质量")
+    parser.add_argument("--gray", action="store_true", help="npy格式输出灰度图")
+    parser.add_argument("--width", type=int, help="npy格式按宽度等比缩放")
+    parser.add_argument("--bundle", action="store_true", help="把所有帧打包为一个文件并生成偏移清单")
     
     args = parser.parse_args()
     
@@ -158,7 +855,11 @@ def main():
             start_time=args.start,
             end_time=args.end,
             format=args.format,
-            quality=args.quality
+            quality=args.quality,
+            gray=args.gray,
+            width=args.width,
+            bundle=args.bundle,
+            target_kb=args.target_kb
         )
         
         print(f"已提取 {frames} 帧")
@@ -0,0 +1,339 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 目标帧在当前解码位置之后不超过该帧数时，顺序读取而不是重新定位
+# (定位需要从关键帧重新解码，短距离内顺序读取更快)
+MAX_FORWARD_GRAB = 30
+
+
+class _Decoder:
+    """一个已打开的视频解码器及其状态"""
+
+    def __init__(self, cap, fps, frame_count, width, height):
+        self.cap = cap
+        self.fps = fps
+        self.frame_count = frame_count
+        self.width = width
+        self.height = height
+        self.next_frame = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def read_frame(self, frame_index):
+        """读取指定帧，调用方需持有self.lock"""
+        import cv2
+
+        gap = frame_index - self.next_frame
+        if gap < 0 or gap > MAX_FORWARD_GRAB:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        else:
+            # 向前跳过少量帧时只grab不解码
+            for _ in range(gap):
+                if not self.cap.grab():
+                    return None
+        ret, frame = self.cap.read()
+        self.next_frame = frame_index + 1 if ret else 0
+        return frame if ret else None
+
+
+class DecoderPool:
+    """
+    按视频复用已打开的cv2.VideoCapture
+
+    同时打开的解码器数量不超过max_handles，空闲超过idle_seconds的解码器会被关闭，
+    这样在同一个视频上拖动进度条时不需要重复打开文件。
+    """
+
+    def __init__(self, max_handles=8, idle_seconds=60):
+        self.max_handles = max_handles
+        self.idle_seconds = idle_seconds
+        self._decoders = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _open(self, video_path):
+        import cv2
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            cap.release()
+            raise ValueError(f"无法打开视频文件: {video_path}")
+        return _Decoder(
+            cap,
+            cap.get(cv2.CAP_PROP_FPS) or 0.0,
+            int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        )
+
+    @contextmanager
+    def acquire(self, video_path):
+        """独占使用某个视频的解码器"""
+        key = (video_path, os.path.getmtime(video_path))
+        with self._lock:
+            decoder = self._decoders.pop(key, None)
+        if decoder is None:
+            decoder = self._open(video_path)
+
+        try:
+            with decoder.lock:
+                yield decoder
+        except BaseException:
+            # 出错的解码器状态不可靠，直接关闭
+            self._close([decoder])
+            raise
+        decoder.last_used = time.monotonic()
+
+        with self._lock:
+            existing = self._decoders.get(key)
+            if existing is not None and existing is not decoder:
+                # 并发请求期间另一个线程已放回同一视频的解码器，关闭多余的这个
+                stale = [decoder]
+            else:
+                self._decoders[key] = decoder
+                self._decoders.move_to_end(key)
+                stale = self._collect_stale()
+        self._close(stale)
+
+    def _collect_stale(self):
+        """取出超过数量或空闲时间限制的解码器，调用方需持有self._lock"""
+        stale = []
+        now = time.monotonic()
+        for key in list(self._decoders):
+            decoder = self._decoders[key]
+            if len(self._decoders) > self.max_handles or now - decoder.last_used > self.idle_seconds:
+                stale.append(self._decoders.pop(key))
+        return stale
+
+    def _close(self, decoders):
+        for decoder in decoders:
+            with decoder.lock:
+                decoder.cap.release()
+
+    def close_all(self):
+        with self._lock:
+            decoders = list(self._decoders.values())
+            self._decoders.clear()
+        self._close(decoders)
+
+
+class FrameCache:
+    """按总字节数限制大小的已编码帧LRU缓存"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class FrameServer:
+    """按时间点解码单帧，只解码请求的帧并缓存编码结果"""
+
+    # 记住最近视频的元数据，缓存命中时无需打开解码器
+    MAX_META = 256
+
+    def __init__(self, pool, cache):
+        self.pool = pool
+        self.cache = cache
+        self._meta = OrderedDict()
+        self._meta_lock = threading.Lock()
+
+    def _cache_key(self, meta_key, t, width, quality):
+        """根据已知的视频元数据计算缓存键，元数据未知时返回None"""
+        with self._meta_lock:
+            meta = self._meta.get(meta_key)
+        if meta is None:
+            return None
+        fps, frame_width = meta
+        if width:
+            width = max(16, min(int(width), frame_width))
+            if width == frame_width:
+                width = None
+        return meta_key + (int(t * fps), width, quality)
+
+    def get_frame(self, video_path, t, width=None, quality=80):
+        """
+        获取视频在t秒处的帧，编码为JPEG
+
+        返回: bytes - 编码后的图片，时间点超出视频范围(包括nan/inf)时返回None
+        """
+        import cv2
+
+        if not math.isfinite(t):
+            return None
+        meta_key = (video_path, os.path.getmtime(video_path))
+        key = self._cache_key(meta_key, t, width, quality)
+        if key is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+        with self.pool.acquire(video_path) as decoder:
+            with self._meta_lock:
+                self._meta[meta_key] = (decoder.fps, decoder.width)
+                self._meta.move_to_end(meta_key)
+                if len(self._meta) > self.MAX_META:
+                    self._meta.popitem(last=False)
+
+            if decoder.fps <= 0:
+                raise ValueError(f"无法获取视频帧率: {video_path}")
+            frame_index = int(t * decoder.fps)
+            if frame_index < 0 or (decoder.frame_count and frame_index >= decoder.frame_count):
+                return None
+            if width:
+                width = max(16, min(int(width), decoder.width))
+                if width == decoder.width:
+                    width = None
+
+            # 同一帧可能对应多个时间点，按帧序号缓存
+            key = meta_key + (frame_index, width, quality)
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+            frame = decoder.read_frame(frame_index)
+            if frame is None:
+                return None
+
+        if width:
+            height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("图片编码失败")
+        data = encoded.tobytes()
+        self.cache.put(key, data)
+        return data
+
+
+class BundleIndex:
+    """
+    打包帧的清单缓存
+
+    打包输出时帧不再是独立的对象，按帧的原路径(frames/<任务>/<帧文件名>)
+    查找清单中的偏移和长度，再用Range读取打包文件。
+    """
+
+    # 目录没有清单时，在该时间(秒)内不再重复查询
+    NEGATIVE_TTL = 60
+
+    def __init__(self, storage, bundle_name='frames.bundle', manifest_name='manifest.json', max_manifests=128):
+        # 文件名与extract_frames.BUNDLE_FILE/BUNDLE_MANIFEST_FILE一致(避免在此导入cv2)
+        self.storage = storage
+        self.bundle_name = bundle_name
+        self.manifest_name = manifest_name
+        self.max_manifests = max_manifests
+        self._manifests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _parse(self, prefix, data):
+        """索引某个目录的清单内容，不存在或格式错误时返回None"""
+        if not data:
+            return None
+        try:
+            manifest = json.loads(data)
+        except ValueError:
+            logger.warning(f"打包清单格式错误: {prefix}")
+            return None
+        return {
+            'bundle': f"{prefix}/{manifest['bundle']}",
+            'content_type': manifest.get('contentType', 'image/jpeg'),
+            'frames': {entry['name']: entry for entry in manifest['frames']}
+        }
+
+    def _cached(self, prefix):
+        """返回 (是否命中缓存, 索引)"""
+        with self._lock:
+            cached = self._manifests.get(prefix)
+            if cached is not None:
+                index, expires = cached
+                if expires is None or expires > time.monotonic():
+                    self._manifests.move_to_end(prefix)
+                    return True, index
+        return False, None
+
+    def _remember(self, prefix, index):
+        # 清单生成后不再变化，只有查询不到的结果需要过期
+        expires = None if index else time.monotonic() + self.NEGATIVE_TTL
+        with self._lock:
+            self._manifests[prefix] = (index, expires)
+            self._manifests.move_to_end(prefix)
+            while len(self._manifests) > self.max_manifests:
+                self._manifests.popitem(last=False)
+
+    def _listed(self, prefix, objects):
+        """列表中是否有该目录的清单"""
+        key = f"{prefix}/{self.manifest_name}"
+        return any(obj['Key'] == key for obj in objects)
+
+    def manifest(self, prefix, listed=None):
+        """
+        目录的清单索引，不是打包目录时返回None
+
+        listed为调用方已列出的目录中是否有清单；未提供时只列出清单这一个键确认存在后才读取，
+        普通目录不会产生读取失败的请求和错误日志
+        """
+        hit, index = self._cached(prefix)
+        if hit:
+            return index
+        if listed is None:
+            listed = self._listed(prefix, self.storage.list_files(f"{prefix}/{self.manifest_name}"))
+        index = self._parse(prefix, self.storage.get_file(f"{prefix}/{self.manifest_name}")) if listed else None
+        self._remember(prefix, index)
+        return index
+
+    def locate(self, object_name):
+        """
+        查找帧在打包文件中的位置
+
+        返回: (打包文件对象名, 偏移, 长度, 内容类型)，不是打包的帧时返回None
+        """
+        prefix, name = os.path.split(object_name)
+        if not prefix:
+            return None
+        index = self.manifest(prefix)
+        if index is None:
+            return None
+        entry = index['frames'].get(name)
+        if entry is None:
+            return None
+        return index['bundle'], entry['offset'], entry['length'], index['content_type']
+
+    def read(self, object_name):
+        """读取打包的帧，返回 (图片数据, 内容类型)，不是打包的帧时返回None"""
+        location = self.locate(object_name)
+        if location is None:
+            return None
+        bundle, offset, length, content_type = location
+        data = self.storage.get_range(bundle, offset, length)
+        if data is None:
+            return None
+        return data, content_type
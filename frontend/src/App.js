@@ -447,11 +447,13 @@ function App() {
       const apiUrl = `${API_URL}/api/extract-frames`;
       console.log('发送请求到:', apiUrl);
       
-      // 发送到后端API，使用JSON格式
+      // 发送到后端API，使用JSON格式，要求逐帧流式返回(NDJSON)
+      setFrames([]);
       const response = await fetch(apiUrl, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Accept': 'application/x-ndjson, application/json',
         },
         body: JSON.stringify(requestData),
       });
@@ -469,6 +471,34 @@ function App() {
         throw new Error(errorMessage);
       }
       
+      // 流式返回: 每收到一帧就加入画廊，不必等待全部帧处理完成
+      if ((response.headers.get('Content-Type') || '').includes('application/x-ndjson')) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        const handleLine = (line) => {
+          if (!line.trim()) return;
+          const event = JSON.parse(line);
+          if (event.type === 'frame') {
+            setFrames(prev => [...prev, event]);
+          } else if (event.type === 'error') {
+            throw new Error(event.error);
+          } else if (event.type === 'done') {
+            console.log('提取完成:', event);
+          }
+        };
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop();
+          lines.forEach(handleLine);
+        }
+        handleLine(buffer);
+        return;
+      }
+      
       const data = await response.json();
       console.log('服务器响应数据:', data);
       
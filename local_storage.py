@@ -0,0 +1,218 @@
+import os
+import shutil
+import logging
+import tempfile
+from datetime import datetime, timezone
+from storage import Storage
+from tracing import stage
+
+logger = logging.getLogger(__name__)
+
+
+class LocalStorage(Storage):
+    """
+    本地文件系统存储，适合单机和内网部署
+
+    对象键直接映射为root下的相对路径。列表和过期清理用os.scandir完成，
+    web_app通过local_path()拿到文件路径后用X-Accel-Redirect(nginx)或send_file返回，不读入内存。
+    """
+
+    is_local = True
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, object_name):
+        """对象键转为文件路径，拒绝跳出root的键"""
+        path = os.path.normpath(os.path.join(self.root, object_name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"无效的对象键: {object_name}")
+        return path
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    @staticmethod
+    def _object(key, st):
+        return {
+            'Key': key,
+            'Size': st.st_size,
+            'LastModified': datetime.fromtimestamp(st.st_mtime, timezone.utc)
+        }
+
+    def _prune_dirs(self, folder):
+        """删除对象后移除空的上级目录，避免过期的分区目录一直残留"""
+        while folder != self.root and folder.startswith(self.root):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def _write(self, object_name, write):
+        """先写入临时文件再改名，读取中的请求不会看到写了一半的文件"""
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 每次写入使用自己的临时文件，同一进程中的多个线程写同一个对象时不会相互覆盖
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix='.tmp',
+                                        dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            write(tmp_path)
+            # mkstemp创建的文件只有所有者可读，nginx(X-Accel-Redirect)需要读取
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def upload_file(self, file_path, object_name, content_type=None):
+        """
+        保存本地文件的副本
+
+        不使用硬链接: 存储的对象不能与临时的帧文件共用inode，否则恢复的任务重新写帧时
+        会就地改写正在被读取的对象。copyfile在Linux上由内核复制(sendfile)，不经过Python缓冲。
+        """
+        def write(tmp_path):
+            shutil.copyfile(file_path, tmp_path)
+
+        try:
+            with stage('upload'):
+                self._write(object_name, write)
+            return True
+        except Exception as e:
+            logger.error(f"保存文件到本地存储失败: {str(e)}", exc_info=True)
+            return False
+
+    def upload_fileobj(self, file_obj, object_name, content_type=None):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(file_obj, f)
+
+        try:
+            with stage('upload'):
+                self._write(object_name, write)
+            return True
+        except Exception as e:
+            logger.error(f"保存文件对象到本地存储失败: {str(e)}")
+            return False
+
+    def download_file(self, object_name, file_path):
+        try:
+            shutil.copyfile(self._path(object_name), file_path)
+            return True
+        except Exception as e:
+            logger.error(f"从本地存储复制文件失败: {str(e)}")
+            return False
+
+    def local_path(self, object_name):
+        try:
+            path = self._path(object_name)
+        except ValueError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def delete_file(self, object_name):
+        try:
+            path = self._path(object_name)
+            os.remove(path)
+            self._prune_dirs(os.path.dirname(path))
+            return True
+        except FileNotFoundError:
+            return True
+        except Exception as e:
+            logger.error(f"删除本地存储文件失败: {str(e)}")
+            return False
+
+    @staticmethod
+    def _sort_name(entry):
+        # 目录按 名称+'/' 排序，遍历顺序与完整键的字典序一致(例如 a-b 在 a/x 之前)
+        return entry.name + '/' if entry.is_dir(follow_symlinks=False) else entry.name
+
+    def _walk(self, folder, prefix, after=None):
+        """按键的字典序遍历folder下键以prefix开头、大于after的文件，返回 (键, stat)"""
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=self._sort_name)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            key = self._key(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                # 只进入可能包含匹配键、且不全在after之前的目录
+                if after and after > key + '/' and not after.startswith(key + '/'):
+                    continue
+                if key.startswith(prefix) or prefix.startswith(key + '/'):
+                    yield from self._walk(entry.path, prefix, after)
+            elif after and key <= after:
+                continue
+            elif key.startswith(prefix) and not entry.name.endswith('.tmp'):
+                try:
+                    yield key, entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+    def _start(self, prefix):
+        return self._path(prefix.rsplit('/', 1)[0]) if '/' in prefix else self.root
+
+    def iter_files(self, prefix=''):
+        with stage('r2_list'):
+            items = list(self._walk(self._start(prefix), prefix))
+        for key, st in items:
+            yield self._object(key, st)
+
+    def list_page(self, prefix='', continuation_token=None, max_keys=1000):
+        """令牌为上一页最后一个键，下一页从它之后继续遍历(跳过之前的目录)，取满一页即停止"""
+        objects = []
+        with stage('r2_list'):
+            for key, st in self._walk(self._start(prefix), prefix, continuation_token):
+                if len(objects) == max_keys:
+                    return objects, objects[-1]['Key']
+                objects.append(self._object(key, st))
+        return objects, None
+
+    def list_prefixes(self, prefix=''):
+        folder = self._path(prefix) if prefix.strip('/') else self.root
+        prefixes = []
+        files = []
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except FileNotFoundError:
+            return prefixes, files
+        for entry in entries:
+            key = self._key(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                prefixes.append(key + '/')
+            elif not entry.name.endswith('.tmp'):
+                files.append(self._object(key, entry.stat(follow_symlinks=False)))
+        return prefixes, files
+
+    def get_file(self, object_name):
+        try:
+            with stage('r2_get'):
+                with open(self._path(object_name), 'rb') as f:
+                    return f.read()
+        except Exception as e:
+            logger.info(f"读取本地存储文件失败: {str(e)}")
+            return None
+
+    def get_range(self, object_name, offset, length):
+        try:
+            with stage('r2_get'):
+                with open(self._path(object_name), 'rb') as f:
+                    return os.pread(f.fileno(), length, offset)
+        except Exception as e:
+            logger.error(f"读取本地存储文件范围失败: {str(e)}")
+            return None
+
+    def copy_file(self, source_name, object_name):
+        try:
+            source = self._path(source_name)
+            self._write(object_name, lambda tmp_path: shutil.copyfile(source, tmp_path))
+            return True
+        except Exception as e:
+            logger.error(f"复制本地存储文件失败: {str(e)}")
+            return False
@@ -0,0 +1,77 @@
+import os
+import uuid
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.owner'
+
+
+class ProcessOwner:
+    """
+    判断状态文件(租约、任务登记等)所属的进程是否仍在运行
+
+    每个进程在folder中有一个属主文件，进程存活期间持有它的排他flock，进程退出(包括崩溃)后由内核释放。
+    状态文件记录属主文件名，锁未被持有即所属进程已退出。与进程号无关，容器重启后复用的进程号不会被误判为存活。
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._fd = None
+        self._pid = None
+        self._name = None
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        # fork出的子进程不继承父进程的属主文件(否则父进程退出后锁仍被子进程持有)
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = self._pid = self._name = None
+
+    def name(self):
+        """当前进程的属主文件名，第一次使用时创建"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._forget()
+                name = f"{os.getpid()}.{uuid.uuid4().hex}{SUFFIX}"
+                # 加锁后再改为正式的文件名，其他进程看到的属主文件一定已被锁定
+                tmp_path = os.path.join(self.folder, f"{name}.tmp")
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.rename(tmp_path, os.path.join(self.folder, name))
+                self._fd, self._pid, self._name = fd, os.getpid(), name
+            return self._name
+
+    def alive(self, name):
+        """属主文件的锁仍被持有即进程存活；name为空(旧格式的状态文件)时视为已退出"""
+        if not name:
+            return False
+        if name == self._name and self._pid == os.getpid():
+            return True
+        try:
+            fd = os.open(os.path.join(self.folder, name), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def prune(self):
+        """删除已退出进程的属主文件，返回删除的文件数"""
+        removed = 0
+        for name in os.listdir(self.folder):
+            if name.endswith(SUFFIX) and not self.alive(name):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -1,118 +1,329 @@
+import os
+import re
+import sys
+import json
+import time
+import fcntl
 import logging
+import argparse
 from datetime import datetime, timedelta, timezone
-from r2_storage import R2Storage
+from storage import create_storage
+
+# 按时间分区的根目录: 对象键的第二级为UTC小时，例如 frames/2026101712/<任务>/frame_000000.jpg
+PARTITIONED_ROOTS = ('videos/', 'frames/')
+PARTITION_FORMAT = '%Y%m%d%H'
+PARTITION_SPAN = timedelta(hours=1)
+_PARTITION_RE = re.compile(r'^\d{10}$')
+
+
+def time_partition(when=None):
+    """返回时间所在的小时分区名(UTC)"""
+    when = when or datetime.now(timezone.utc)
+    return when.astimezone(timezone.utc).strftime(PARTITION_FORMAT)
+
+
+def partition_prefix(root, when=None):
+    """root下当前小时分区的前缀，例如 frames/2026101712"""
+    return f"{root.rstrip('/')}/{time_partition(when)}"
+
+
+def parse_partition(name):
+    """分区名转为该小时的开始时间，不是分区名时返回None"""
+    if not _PARTITION_RE.match(name):
+        return None
+    try:
+        return datetime.strptime(name, PARTITION_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+class SweepCheckpoint:
+    """
+    保存清理进度(当前前缀和列表的ContinuationToken)
+
+    清理进程中断后，下次从上次处理到的那一页继续，而不是从头重新列出。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def resume_token(self, prefix):
+        """上次中断在prefix时返回保存的ContinuationToken"""
+        state = self.load()
+        return state.get('token') if state.get('prefix') == prefix else None
+
+    def save(self, prefix, token):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'prefix': prefix, 'token': token, 'updated': time.time()}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SweepProgress:
+    """累计清理进度，按最小间隔输出日志，避免大量删除时刷屏"""
+
+    def __init__(self, logger, interval=10):
+        self.logger = logger
+        self.interval = interval
+        self.listed = 0
+        self.deleted = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def update(self, prefix, listed, deleted):
+        self.listed += listed
+        self.deleted += deleted
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            elapsed = now - self.started
+            self.logger.info(
+                f"清理进度: 正在处理 {prefix}，已检查 {self.listed} 个文件，"
+                f"已删除 {self.deleted} 个 ({self.deleted / elapsed:.0f} 个/秒)"
+            )
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return f"检查 {self.listed} 个文件，删除 {self.deleted} 个，耗时 {elapsed:.1f}秒"
+
+
+class SweepLease:
+    """
+    清理任务的独占租约(状态目录中的文件锁)
+
+    同一台机器上只有持有租约的进程执行清理，进程退出后锁自动释放。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """尝试获取租约，已被其他进程持有时返回False"""
+        if self._file is not None:
+            return True
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
 
 class R2Lifecycle:
-    def __init__(self, r2_storage):
+    """
+    存储过期文件清理(R2和本地存储后端都适用)
+
+    新文件写入小时分区，整个分区都过期后按前缀批量删除，不需要逐个比较对象时间；
+    分区布局之前写入的旧键仍按LastModified逐个判断，可用migrate_legacy_keys迁移到分区中。
+    逐页列出并删除，每页之后保存进度，中断后可以继续。
+    """
+
+    def __init__(self, r2_storage, expiration_hours=1, checkpoint=None, progress_interval=10):
         self.r2_storage = r2_storage
+        self.expiration_hours = expiration_hours
+        self.checkpoint = checkpoint
+        self.progress_interval = progress_interval
         self.logger = logging.getLogger(__name__)
 
-    def _get_expired_files(self, prefix, expiration_hours=1):
-        """获取超过指定时间的文件列表"""
-        try:
-            objects = self.r2_storage.list_files(prefix)
-            expired_files = []
-            # 使用UTC timezone-aware时间
-            now = datetime.now(timezone.utc)
-            
-            for obj in objects:
-                if obj.get('LastModified'):
-                    last_modified = obj['LastModified']
-                    
-                    # 确保last_modified是timezone-aware
-                    if isinstance(last_modified, str):
-                        # 将字符串转换为timezone-aware datetime
-                        try:
-                            if 'Z' in last_modified:
-                                # 处理ISO格式的UTC时间字符串
-                                last_modified = datetime.fromisoformat(last_modified.replace('Z', '+00:00'))
-                            elif '+' in last_modified or '-' in last_modified[-6:]:
-                                # 已经包含时区信息
-                                last_modified = datetime.fromisoformat(last_modified)
-                            else:
-                                # 假设是UTC时间但没有时区信息
-                                last_modified = datetime.fromisoformat(last_modified).replace(tzinfo=timezone.utc)
-                        except ValueError:
-                            # 如果无法解析，使用标准库解析
-                            from dateutil import parser
-                            last_modified = parser.parse(last_modified)
-                    
-                    # 如果last_modified是naive datetime，添加UTC时区
-                    if last_modified.tzinfo is None:
-                        last_modified = last_modified.replace(tzinfo=timezone.utc)
-                    
-                    # 检查文件是否超过指定小时
-                    if now - last_modified > timedelta(hours=expiration_hours):
-                        expired_files.append(obj['Key'])
-            
-            return expired_files
-        except Exception as e:
-            self.logger.error(f"获取过期文件列表失败: {str(e)}", exc_info=True)
-            return []
+    def _scan_root(self, root):
+        """
+        列出根目录下一级的条目
+
+        返回: ([(分区前缀, 分区开始时间)], [旧布局的子目录前缀], [根目录下直接存放的旧文件])
+        """
+        prefixes, files = self.r2_storage.list_prefixes(root)
+        partitions = []
+        legacy = []
+        for prefix in prefixes:
+            start = parse_partition(prefix[len(root):].rstrip('/'))
+            if start is None:
+                legacy.append(prefix)
+            else:
+                partitions.append((prefix, start))
+        partitions.sort(key=lambda p: p[1])
+        return partitions, legacy, files
+
+    def expired_partitions(self, root, now=None):
+        """返回root下所有对象都已过期的分区前缀(按时间从旧到新)"""
+        now = now or datetime.now(timezone.utc)
+        cutoff = now - timedelta(hours=self.expiration_hours)
+        partitions, _, _ = self._scan_root(root)
+        return [prefix for prefix, start in partitions if start + PARTITION_SPAN <= cutoff]
+
+    def delete_prefix(self, prefix, cutoff=None, progress=None):
+        """
+        逐页删除前缀下的文件，返回删除的数量
+
+        cutoff不为None时只删除LastModified早于cutoff的文件(旧布局的键)。
+        每处理完一页保存ContinuationToken，中断后从下一页继续。
+        """
+        token = self.checkpoint.resume_token(prefix) if self.checkpoint else None
+        if token:
+            self.logger.info(f"从上次中断的位置继续清理: {prefix}")
+        deleted = 0
+        while True:
+            objects, token = self.r2_storage.list_page(prefix, token)
+            keys = [
+                obj['Key'] for obj in objects
+                if cutoff is None or (obj.get('LastModified') and obj['LastModified'] < cutoff)
+            ]
+            count = self.r2_storage.delete_files(keys) if keys else 0
+            deleted += count
+            if progress is not None:
+                progress.update(prefix, len(objects), count)
+            if not token:
+                break
+            if self.checkpoint:
+                self.checkpoint.save(prefix, token)
+        if self.checkpoint:
+            self.checkpoint.clear()
+        return deleted
 
     def cleanup_expired_files(self):
-        """清理过期文件"""
-        try:
-            # 检查视频文件
-            expired_videos = self._get_expired_files('videos/')
-            for video_key in expired_videos:
-                try:
-                    self.r2_storage.delete_file(video_key)
-                    self.logger.info(f"已删除过期视频: {video_key}")
-                except Exception as e:
-                    self.logger.error(f"删除视频失败 {video_key}: {str(e)}")
-
-            # 检查帧文件
-            expired_frames = self._get_expired_files('frames/')
-            for frame_key in expired_frames:
-                try:
-                    self.r2_storage.delete_file(frame_key)
-                    self.logger.info(f"已删除过期帧: {frame_key}")
-                except Exception as e:
-                    self.logger.error(f"删除帧失败 {frame_key}: {str(e)}")
-
-            return len(expired_videos) + len(expired_frames)
-        except Exception as e:
-            self.logger.error(f"清理过期文件失败: {str(e)}", exc_info=True)
+        """清理过期文件，返回删除的文件数"""
+        progress = SweepProgress(self.logger, self.progress_interval)
+        deleted = 0
+        for root in PARTITIONED_ROOTS:
+            try:
+                partitions, legacy, files = self._scan_root(root)
+            except Exception as e:
+                self.logger.error(f"列出 {root} 分区失败: {str(e)}", exc_info=True)
+                continue
+
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=self.expiration_hours)
+            try:
+                for prefix, start in partitions:
+                    if start + PARTITION_SPAN > cutoff:
+                        break
+                    count = self.delete_prefix(prefix, progress=progress)
+                    deleted += count
+                    self.logger.info(f"已删除过期分区: {prefix} ({count} 个文件)")
+
+                # 旧布局的键逐个比较修改时间
+                expired = [obj['Key'] for obj in files
+                           if obj.get('LastModified') and obj['LastModified'] < cutoff]
+                if expired:
+                    deleted += self.r2_storage.delete_files(expired)
+                for prefix in legacy:
+                    deleted += self.delete_prefix(prefix, cutoff=cutoff, progress=progress)
+            except Exception as e:
+                self.logger.error(f"清理 {root} 时出错: {str(e)}", exc_info=True)
+
+        self.logger.info(f"清理完成: {progress.summary()}")
+        return deleted
+
+    def migrate_legacy_keys(self, dry_run=False):
+        """
+        把分区布局之前写入的键按LastModified移动到对应的小时分区
+
+        frames/<任务>/<文件> -> frames/<分区>/<任务>/<文件>
+        返回: 迁移(dry_run时为需要迁移)的文件数
+        """
+        moved = 0
+        for root in PARTITIONED_ROOTS:
+            _, legacy, files = self._scan_root(root)
+            objects = list(files)
+            for prefix in legacy:
+                objects.extend(self.r2_storage.iter_files(prefix))
+
+            for obj in objects:
+                key = obj['Key']
+                target = f"{partition_prefix(root, obj['LastModified'])}/{key[len(root):]}"
+                if dry_run:
+                    self.logger.info(f"需要迁移: {key} -> {target}")
+                    moved += 1
+                    continue
+                if self.r2_storage.copy_file(key, target) and self.r2_storage.delete_file(key):
+                    moved += 1
+                    self.logger.info(f"已迁移: {key} -> {target}")
+        return moved
+
+
+def main(argv=None):
+    """
+    过期文件清理入口，部署时只运行一个实例 (Procfile中的sweeper进程)
+
+    python r2_lifecycle.py            按间隔循环清理
+    python r2_lifecycle.py --once     清理一次后退出(适合cron)
+    python r2_lifecycle.py --migrate  把旧布局的键迁移到小时分区
+    """
+    from config import (
+        STATE_FOLDER,
+        LIFECYCLE_EXPIRATION_HOURS,
+        LIFECYCLE_INTERVAL,
+        LIFECYCLE_PROGRESS_INTERVAL,
+        LOG_LEVEL,
+        LOG_FORMAT
+    )
+    import structured_log
+
+    parser = argparse.ArgumentParser(description="清理存储中的过期文件")
+    parser.add_argument("--once", action="store_true", help="只清理一次")
+    parser.add_argument("--interval", type=float, default=LIFECYCLE_INTERVAL, help="两次清理的间隔(秒)")
+    parser.add_argument("--expiration-hours", type=float, default=LIFECYCLE_EXPIRATION_HOURS, help="文件保留的小时数")
+    parser.add_argument("--migrate", action="store_true", help="把旧布局的键迁移到小时分区后退出")
+    parser.add_argument("--dry-run", action="store_true", help="配合--migrate，只列出需要迁移的键")
+    args = parser.parse_args(argv)
+
+    structured_log.setup_logging(LOG_LEVEL, LOG_FORMAT)
+    logger = logging.getLogger(__name__)
+
+    lifecycle = R2Lifecycle(
+        create_storage(),
+        expiration_hours=args.expiration_hours,
+        checkpoint=SweepCheckpoint(os.path.join(STATE_FOLDER, 'lifecycle.json')),
+        progress_interval=LIFECYCLE_PROGRESS_INTERVAL
+    )
+    if args.migrate:
+        moved = lifecycle.migrate_legacy_keys(dry_run=args.dry_run)
+        logger.info(f"{'需要迁移' if args.dry_run else '已迁移'} {moved} 个文件")
+        return 0
+
+    lease = SweepLease(os.path.join(STATE_FOLDER, 'lifecycle.lock'))
+    while True:
+        if lease.acquire():
+            try:
+                lifecycle.cleanup_expired_files()
+            except Exception as e:
+                logger.error(f"清理任务出错: {str(e)}", exc_info=True)
+        else:
+            logger.info("另一个实例正在执行清理，本次跳过")
+        if args.once:
             return 0
+        time.sleep(args.interval)
 
-    def _cleanup_prefix(self, prefix, expiration_time):
-        """清理指定前缀的过期文件"""
-        try:
-            # 确保expiration_time是timezone-aware
-            if expiration_time.tzinfo is None:
-                expiration_time = expiration_time.replace(tzinfo=timezone.utc)
-                
-            # 列出所有文件
-            files = self.r2_storage.list_files(prefix)
-            
-            for file in files:
-                # 获取文件的最后修改时间
-                last_modified = file.get('LastModified')
-                
-                # 确保last_modified是timezone-aware
-                if last_modified:
-                    if isinstance(last_modified, str):
-                        try:
-                            if 'Z' in last_modified:
-                                last_modified = datetime.fromisoformat(last_modified.replace('Z', '+00:00'))
-                            elif '+' in last_modified or '-' in last_modified[-6:]:
-                                last_modified = datetime.fromisoformat(last_modified)
-                            else:
-                                last_modified = datetime.fromisoformat(last_modified).replace(tzinfo=timezone.utc)
-                        except ValueError:
-                            from dateutil import parser
-                            last_modified = parser.parse(last_modified)
-                    
-                    # 如果last_modified是naive datetime，添加UTC时区
-                    if last_modified.tzinfo is None:
-                        last_modified = last_modified.replace(tzinfo=timezone.utc)
-                        
-                    if last_modified < expiration_time:
-                        # 删除过期文件
-                        if self.r2_storage.delete_file(file['Key']):
-                            self.logger.info(f"已删除过期文件: {file['Key']}")
-                        else:
-                            self.logger.warning(f"删除文件失败: {file['Key']}")
-        except Exception as e:
-            self.logger.error(f"清理 {prefix} 目录时出错: {str(e)}", exc_info=True) 
\ No newline at end of file
+
+if __name__ == "__main__":
+    sys.exit(main())
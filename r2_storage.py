@@ -1,48 +1,77 @@
-import boto3
-from botocore.config import Config
+import os
+import threading
 from config import (
-    R2_ACCOUNT_ID,
     R2_ACCESS_KEY_ID,
     R2_SECRET_ACCESS_KEY,
     R2_BUCKET_NAME,
-    CACHE_CONTROL
+    R2_ENDPOINT_URL,
+    UNVERSIONED_CACHE_CONTROL
 )
+from storage import Storage
+from tracing import stage
 import logging
 
 logger = logging.getLogger(__name__)
 
-class R2Storage:
+class R2Storage(Storage):
+    """Cloudflare R2 (S3兼容接口) 存储"""
+
     def __init__(self):
-        self.s3 = boto3.client(
-            's3',
-            endpoint_url=f'https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com',
-            aws_access_key_id=R2_ACCESS_KEY_ID,
-            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-            config=Config(signature_version='s3v4')
-        )
+        # boto3客户端在首次使用时才创建，加快worker启动；
+        # 记录创建时的进程号，gunicorn --preload 分叉后在子进程中重新创建
+        self._s3 = None
+        self._pid = None
+        self._lock = threading.Lock()
         self.bucket = R2_BUCKET_NAME
 
+    @property
+    def s3(self):
+        """获取当前进程的 boto3 S3 客户端"""
+        if self._s3 is None or self._pid != os.getpid():
+            with self._lock:
+                if self._s3 is None or self._pid != os.getpid():
+                    self._s3 = self._create_client()
+                    self._pid = os.getpid()
+        return self._s3
+
+    @staticmethod
+    def client_options(**config):
+        """创建S3客户端的参数，async_storage用同样的参数创建aiobotocore客户端"""
+        from botocore.config import Config
+
+        return {
+            'endpoint_url': R2_ENDPOINT_URL,
+            'aws_access_key_id': R2_ACCESS_KEY_ID,
+            'aws_secret_access_key': R2_SECRET_ACCESS_KEY,
+            'config': Config(signature_version='s3v4', **config)
+        }
+
+    def _create_client(self):
+        import boto3
+
+        # 每个客户端使用独立的session，boto3默认session不是线程安全的
+        session = boto3.session.Session()
+        return session.client('s3', **self.client_options())
+
     def upload_file(self, file_path, object_name, content_type=None):
         """上传文件到 R2 存储"""
         try:
-            logger.info(f"开始上传文件到R2: {file_path} -> {object_name}")
-            
+            # 对象会被生命周期清理删除，元数据只设短期缓存；带内容哈希的地址由Worker设置永久缓存
             extra_args = {
-                'CacheControl': CACHE_CONTROL
+                'CacheControl': UNVERSIONED_CACHE_CONTROL
             }
             if content_type:
                 extra_args['ContentType'] = content_type
-                
-            logger.info(f"上传参数: bucket={self.bucket}, extra_args={extra_args}")
-
-            self.s3.upload_file(
-                file_path,
-                self.bucket,
-                object_name,
-                ExtraArgs=extra_args
-            )
+
+            with stage('upload'):
+                self.s3.upload_file(
+                    file_path,
+                    self.bucket,
+                    object_name,
+                    ExtraArgs=extra_args
+                )
             
-            logger.info(f"文件成功上传到R2: {object_name}")
+            logger.debug("文件成功上传到R2: %s -> %s", file_path, object_name)
             return True
         except Exception as e:
             logger.error(f"上传文件到 R2 失败: {str(e)}", exc_info=True)
@@ -52,17 +81,18 @@ class R2Storage:
         """上传文件对象到 R2 存储"""
         try:
             extra_args = {
-                'CacheControl': CACHE_CONTROL
+                'CacheControl': UNVERSIONED_CACHE_CONTROL
             }
             if content_type:
                 extra_args['ContentType'] = content_type
 
-            self.s3.upload_fileobj(
-                file_obj,
-                self.bucket,
-                object_name,
-                ExtraArgs=extra_args
-            )
+            with stage('upload'):
+                self.s3.upload_fileobj(
+                    file_obj,
+                    self.bucket,
+                    object_name,
+                    ExtraArgs=extra_args
+                )
             return True
         except Exception as e:
             logger.error(f"上传文件对象到 R2 失败: {str(e)}")
@@ -105,23 +135,102 @@ class R2Storage:
     def list_files(self, prefix=''):
         """列出指定前缀的所有文件"""
         try:
-            response = self.s3.list_objects_v2(
-                Bucket=self.bucket,
-                Prefix=prefix
-            )
-            return response.get('Contents', [])
+            with stage('r2_list'):
+                return list(self.iter_files(prefix))
         except Exception as e:
             logger.error(f"列出 R2 文件失败: {str(e)}")
             return []
 
-    def get_file(self, object_name):
-        """获取文件内容"""
+    def iter_files(self, prefix=''):
+        """分页遍历指定前缀的所有文件(每页最多1000个)，出错时抛出异常"""
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def list_page(self, prefix='', continuation_token=None, max_keys=1000):
+        """
+        列出一页文件
+
+        返回: (文件列表, 下一页的ContinuationToken，没有下一页时为None)，出错时抛出异常
+        """
+        params = {'Bucket': self.bucket, 'Prefix': prefix, 'MaxKeys': max_keys}
+        if continuation_token:
+            params['ContinuationToken'] = continuation_token
+        with stage('r2_list'):
+            response = self.s3.list_objects_v2(**params)
+        next_token = response.get('NextContinuationToken') if response.get('IsTruncated') else None
+        return response.get('Contents', []), next_token
+
+    def list_prefixes(self, prefix=''):
+        """
+        按 / 分隔列出prefix下一级的子目录和文件
+
+        返回: (子目录前缀列表, 该层的文件列表)，出错时抛出异常
+        """
+        prefixes = []
+        files = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        with stage('r2_list'):
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+                prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+                files.extend(page.get('Contents', []))
+        return prefixes, files
+
+    def delete_files(self, object_names):
+        """批量删除文件(每次请求最多1000个)，返回成功删除的数量"""
+        deleted = 0
+        object_names = list(object_names)
+        for i in range(0, len(object_names), 1000):
+            batch = object_names[i:i + 1000]
+            try:
+                response = self.s3.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+                )
+                errors = response.get('Errors', [])
+                for error in errors:
+                    logger.error(f"删除 R2 文件失败 {error.get('Key')}: {error.get('Message')}")
+                deleted += len(batch) - len(errors)
+            except Exception as e:
+                logger.error(f"批量删除 R2 文件失败: {str(e)}")
+        return deleted
+
+    def copy_file(self, source_name, object_name):
+        """在存储桶内复制文件"""
         try:
-            response = self.s3.get_object(
+            self.s3.copy_object(
                 Bucket=self.bucket,
-                Key=object_name
+                Key=object_name,
+                CopySource={'Bucket': self.bucket, 'Key': source_name}
             )
-            return response['Body'].read()
+            return True
+        except Exception as e:
+            logger.error(f"复制 R2 文件失败: {str(e)}")
+            return False
+
+    def get_range(self, object_name, offset, length):
+        """读取对象中从offset开始的length个字节(HTTP Range请求)"""
+        try:
+            with stage('r2_get'):
+                response = self.s3.get_object(
+                    Bucket=self.bucket,
+                    Key=object_name,
+                    Range=f"bytes={offset}-{offset + length - 1}"
+                )
+                return response['Body'].read()
+        except Exception as e:
+            logger.error(f"读取文件范围失败: {str(e)}")
+            return None
+
+    def get_file(self, object_name):
+        """获取文件内容"""
+        try:
+            with stage('r2_get'):
+                response = self.s3.get_object(
+                    Bucket=self.bucket,
+                    Key=object_name
+                )
+                return response['Body'].read()
         except Exception as e:
             logger.error(f"获取文件内容失败: {str(e)}")
             return None 
\ No newline at end of file
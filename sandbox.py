@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import selectors
+import threading
+import subprocess
+
+from cancellation import Cancelled, CancelToken, check as check_cancel
+from tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+# 子进程可以执行的提取函数: 名称 -> 是否逐项返回结果(生成器)
+TASKS = {
+    'write_frames': True,
+    'extract_frames': False,
+    'extract_frames_bundle': False
+}
+
+
+class SandboxError(Exception):
+    """提取子进程出错或被资源限制终止"""
+
+
+def _usage(ru, wall=None):
+    """resource.struct_rusage 转为记录用的字典"""
+    usage = {
+        'user_s': round(ru.ru_utime, 3),
+        'system_s': round(ru.ru_stime, 3),
+        'max_rss_mb': round(ru.ru_maxrss / 1024, 1)
+    }
+    if wall is not None:
+        usage['wall_s'] = round(wall, 3)
+    return usage
+
+
+class _Channel:
+    """子进程stdout上的JSON行协议，支持带超时的读取(用于检查取消和墙钟时间)"""
+
+    def __init__(self, fileobj):
+        self.fd = fileobj.fileno()
+        self._buf = b''
+        self._lines = []
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.fd, selectors.EVENT_READ)
+
+    def read(self, timeout):
+        """读取一条消息；超时返回None，子进程退出(EOF)时抛出EOFError"""
+        while not self._lines:
+            if not self._selector.select(timeout):
+                return None
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                raise EOFError
+            self._buf += chunk
+            *lines, self._buf = self._buf.split(b'\n')
+            self._lines.extend(line for line in lines if line)
+        return json.loads(self._lines.pop(0))
+
+    def close(self):
+        self._selector.close()
+
+
+class _Worker:
+    """一个预先启动的提取子进程"""
+
+    def __init__(self, limits):
+        env = dict(os.environ)
+        # 限制glibc的malloc arena数量，避免多线程解码时虚拟内存膨胀触发RLIMIT_AS
+        env.setdefault('MALLOC_ARENA_MAX', '2')
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), json.dumps(limits)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.getcwd(),
+            env=env
+        )
+        self.channel = _Channel(self.proc.stdout)
+        self.jobs = 0
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def send(self, message):
+        self.proc.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.proc.stdin.flush()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def kill(self):
+        """立即终止子进程并回收，返回子进程整个生命周期的资源使用"""
+        try:
+            self.proc.kill()
+        except ProcessLookupError:
+            pass
+        return self.reap()
+
+    def reap(self):
+        """回收已退出的子进程，返回 (资源使用, 退出状态说明)"""
+        usage = None
+        status = ''
+        try:
+            _, wait_status, ru = os.wait4(self.proc.pid, 0)
+            self.proc.returncode = os.waitstatus_to_exitcode(wait_status)
+            usage = _usage(ru)
+        except ChildProcessError:
+            self.proc.wait()
+        code = self.proc.returncode
+        if code is not None and code < 0:
+            status = f"信号 {signal.Signals(-code).name}"
+        elif code is not None:
+            status = f"退出码 {code}"
+        self.close()
+        return usage, status
+
+    def close(self):
+        self.channel.close()
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except OSError:
+                pass
+
+
+class SandboxJob:
+    """
+    在子进程中执行的一次提取
+
+    逐项返回结果的任务可以直接迭代；迭代结束后result为函数的返回值，
+    usage为本次任务的资源使用(CPU时间、峰值内存、墙钟时间)。
+    """
+
+    # 等待子进程消息时检查取消的间隔(秒)
+    POLL_INTERVAL = 0.5
+    # 设置后，超过该秒数没有产生结果时产生一个None，调用方可以借此发送心跳
+    heartbeat = None
+
+    def __init__(self, pool, worker, task, kwargs, cancel, wall_seconds):
+        self.pool = pool
+        self.worker = worker
+        self.task = task
+        self.kwargs = kwargs
+        self.cancel = cancel
+        self.wall_seconds = wall_seconds
+        self.result = None
+        self.usage = None
+        self._started = time.monotonic()
+
+    def _remaining(self):
+        remaining = self.wall_seconds - (time.monotonic() - self._started)
+        if self.cancel is not None and self.cancel.remaining() is not None:
+            remaining = min(remaining, self.cancel.remaining())
+        return remaining
+
+    def _abort(self):
+        """终止子进程(它可能卡在解码器中)，记录资源使用"""
+        usage, status = self.worker.kill()
+        self.usage = dict(usage or {}, wall_s=round(time.monotonic() - self._started, 3), killed=True)
+        self.worker = None
+        return status
+
+    def __iter__(self):
+        worker = self.worker
+        last_yield = time.monotonic()
+        try:
+            while True:
+                check_cancel(self.cancel)
+                remaining = self._remaining()
+                if remaining <= 0:
+                    logger.warning(f"提取子进程超过墙钟时间限制，强制终止: pid={worker.pid}")
+                    self._abort()
+                    raise Cancelled(CancelToken.DEADLINE)
+                try:
+                    message = worker.channel.read(min(remaining, self.POLL_INTERVAL))
+                except EOFError:
+                    status = self._abort()
+                    raise SandboxError(f"提取子进程异常退出({status})，可能超出了内存或CPU时间限制")
+                if message is None:
+                    if self.heartbeat and time.monotonic() - last_yield >= self.heartbeat:
+                        last_yield = time.monotonic()
+                        yield None
+                    continue
+                kind = message['type']
+                if kind == 'item':
+                    yield tuple(message['value'])
+                    last_yield = time.monotonic()
+                elif kind == 'done':
+                    self.result = message.get('result')
+                    self._finish(message)
+                    return
+                elif kind == 'error':
+                    self._finish(message)
+                    raise SandboxError(message['error'])
+        except BaseException:
+            # 取消、客户端断开(GeneratorExit)或出错时子进程可能还在运行，直接终止
+            if self.worker is not None:
+                self._abort()
+            raise
+
+    def _finish(self, message):
+        self.usage = message.get('usage')
+        trace = current_trace()
+        if trace is not None:
+            for name, entry in message.get('stages', {}).items():
+                trace.add(name, *entry)
+        worker = self.worker
+        self.worker = None
+        # 出错后的子进程状态不可信(例如内存分配失败)，不再复用
+        self.pool._release(worker, reuse=message['type'] == 'done')
+
+    def wait(self):
+        """执行到结束并返回结果(用于不逐项返回的任务)"""
+        for _ in self:
+            pass
+        return self.result
+
+
+class _InlineJob(SandboxJob):
+    """不使用子进程，直接在当前进程中执行(EXTRACT_POOL_SIZE为0时)"""
+
+    def __init__(self, task, kwargs, cancel):
+        self.task = task
+        self.kwargs = kwargs
+        self.cancel = cancel
+        self.result = None
+        self.usage = None
+
+    def __iter__(self):
+        import extract_frames
+        func = getattr(extract_frames, self.task)
+        if TASKS[self.task]:
+            yield from func(cancel=self.cancel, **self.kwargs)
+        else:
+            self.result = func(cancel=self.cancel, **self.kwargs)
+
+
+class ExtractionPool:
+    """
+    预先启动的提取子进程池
+
+    子进程启动时导入cv2并设置内存上限(RLIMIT_AS)和nice值，每个任务前设置CPU时间上限(RLIMIT_CPU)；
+    父进程负责墙钟时间限制，超时、取消或客户端断开时直接杀死子进程。
+    畸形或超大的视频只会让子进程被终止，不影响gunicorn worker和其中的其他请求。
+
+    每个gunicorn worker有自己的池: 分叉后第一次提交任务时丢弃从父进程继承的子进程。
+    """
+
+    def __init__(self, size=2, memory_mb=2048, cpu_seconds=300, nice=10, wall_seconds=600, max_jobs=50):
+        self.size = size
+        self.limits = {'memory_mb': memory_mb, 'cpu_seconds': cpu_seconds, 'nice': nice}
+        self.wall_seconds = wall_seconds
+        self.max_jobs = max_jobs
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def reset(self):
+        """分叉后的子进程中调用，继承来的子进程属于父进程，不能使用"""
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def start(self):
+        """预先启动子进程，子进程在后台导入cv2，第一个任务不需要等待"""
+        if self.size <= 0:
+            return
+        with self._lock:
+            while len(self._idle) < self.size:
+                self._idle.append(_Worker(self.limits))
+        logger.info(f"已启动 {self.size} 个提取子进程")
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    return worker
+                worker.reap()
+        # 所有子进程都在使用中时临时启动一个，结束后超出池大小的会被关闭
+        return _Worker(self.limits)
+
+    def _release(self, worker, reuse=True):
+        worker.jobs += 1
+        with self._lock:
+            if reuse and worker.jobs < self.max_jobs and len(self._idle) < self.size and worker.alive():
+                self._idle.append(worker)
+                return
+        # 关闭stdin后子进程读到EOF自行退出
+        try:
+            worker.proc.stdin.close()
+        except OSError:
+            pass
+        threading.Thread(target=worker.reap, daemon=True).start()
+
+    def submit(self, task, cancel=None, **kwargs):
+        """
+        提交一个提取任务
+
+        task: TASKS中的函数名；kwargs为该函数的参数(不含cancel，取消由父进程处理)
+        返回: SandboxJob
+        """
+        if task not in TASKS:
+            raise ValueError(f"不支持的提取任务: {task}")
+        if self.size <= 0:
+            return _InlineJob(task, kwargs, cancel)
+        if self._pid != os.getpid():
+            self.reset()
+        message = {'task': task, 'kwargs': kwargs}
+        worker = self._acquire()
+        try:
+            worker.send(message)
+        except BrokenPipeError:
+            # 空闲期间退出的子进程，换一个新的
+            worker.reap()
+            worker = _Worker(self.limits)
+            worker.send(message)
+        return SandboxJob(self, worker, task, kwargs, cancel, self.wall_seconds)
+
+    def close(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.kill()
+
+
+def _child_main(limits):
+    """子进程入口: 设置资源限制后循环执行父进程发来的任务"""
+    import resource
+
+    # 协议使用原来的stdout，之后的print等输出都转到stderr
+    out = os.fdopen(os.dup(1), 'wb', buffering=0)
+    os.dup2(2, 1)
+
+    from config import LOG_LEVEL, LOG_FORMAT
+    import structured_log
+    structured_log.setup_logging(LOG_LEVEL, LOG_FORMAT)
+
+    if limits.get('memory_mb'):
+        limit = int(limits['memory_mb']) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if limits.get('nice'):
+        os.nice(int(limits['nice']))
+
+    # 预先导入，任务到来时不再等待cv2加载
+    import extract_frames
+    import tracing
+
+    def send(message):
+        out.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    for line in sys.stdin.buffer:
+        request = json.loads(line)
+        task = request['task']
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        if limits.get('cpu_seconds'):
+            # RLIMIT_CPU按进程累计，每个任务在已用时间上加上限额；超出时内核发送SIGXCPU终止进程
+            used = before.ru_utime + before.ru_stime
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(used + limits['cpu_seconds']) + 1, hard))
+        started = time.monotonic()
+        trace, token = tracing.start_trace()
+
+        def usage():
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            return {
+                'user_s': round(after.ru_utime - before.ru_utime, 3),
+                'system_s': round(after.ru_stime - before.ru_stime, 3),
+                'max_rss_mb': round(after.ru_maxrss / 1024, 1),
+                'wall_s': round(time.monotonic() - started, 3),
+                'pid': os.getpid()
+            }
+
+        try:
+            func = getattr(extract_frames, task)
+            if TASKS[task]:
+                for item in func(**request['kwargs']):
+                    send({'type': 'item', 'value': list(item)})
+                result = None
+            else:
+                result = func(**request['kwargs'])
+            send({'type': 'done', 'result': result, 'usage': usage(), 'stages': trace.stages})
+        except Exception as e:
+            logging.getLogger(__name__).error(f"提取子进程任务出错: {str(e)}", exc_info=True)
+            send({'type': 'error', 'error': str(e), 'exc': type(e).__name__, 'usage': usage(), 'stages': trace.stages})
+        finally:
+            tracing.end_trace(token)
+
+
+if __name__ == '__main__':
+    _child_main(json.loads(sys.argv[1]))
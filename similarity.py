@@ -0,0 +1,215 @@
+import io
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 每个任务的帧哈希保存为一个结构化数组(第i个元素是序号为i的帧的哈希和是否有效)，与帧放在同一前缀下。
+# 全黑帧的哈希是0，缺少哈希的帧不能用0占位，否则会被当作全黑帧匹配
+HASHES_FILE = 'phash.npy'
+HASHES_DTYPE = [('hash', '<u8'), ('valid', '?')]
+
+# 差值哈希(dHash)的边长: 缩小为 (HASH_SIZE+1) x HASH_SIZE 的灰度图，比较相邻像素得到64位
+HASH_SIZE = 8
+
+_popcount_table = None
+
+
+def frame_hash(frame):
+    """
+    计算一帧的感知哈希(dHash)，返回64位无符号整数
+
+    对亮度、压缩质量和缩放不敏感，内容相近的帧汉明距离小(通常不超过10)
+    """
+    import cv2
+    import numpy as np
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def save_hashes(path, hashes):
+    """
+    把 {帧序号: 哈希} 写为数组文件，没有哈希的帧标记为无效
+
+    返回: 帧数
+    """
+    import numpy as np
+
+    array = np.zeros(max(hashes) + 1 if hashes else 0, dtype=HASHES_DTYPE)
+    for index, value in hashes.items():
+        array[index] = (value, True)
+    missing = len(array) - len(hashes)
+    if missing:
+        logger.warning(f"{missing} 帧没有感知哈希，标记为无效: {path}")
+    np.save(path, array)
+    return len(array)
+
+
+def load_hashes(data):
+    """
+    从数组文件内容读取哈希
+
+    返回: (uint64哈希数组, bool有效标记数组)；旧格式的uint64数组视为全部有效
+    """
+    import numpy as np
+
+    array = np.load(io.BytesIO(data), allow_pickle=False)
+    if array.dtype.names:
+        if set(array.dtype.names) != {'hash', 'valid'}:
+            raise ValueError(f"未知的哈希数组字段: {array.dtype.names}")
+        return (np.ascontiguousarray(array['hash'], dtype=np.uint64),
+                np.ascontiguousarray(array['valid'], dtype=bool))
+    hashes = np.ascontiguousarray(array, dtype=np.uint64)
+    return hashes, np.ones(len(hashes), dtype=bool)
+
+
+def hamming(hashes, value):
+    """哈希数组中每个哈希与value的汉明距离，整个数组一次异或和按字节查表计数"""
+    global _popcount_table
+    import numpy as np
+
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(diff)
+    if _popcount_table is None:
+        _popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _popcount_table[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def nearest(candidates, value, k, max_distance=None):
+    """
+    在多个哈希数组中查找与value最接近的k帧
+
+    candidates: [(标签, 哈希数组, 排除的帧序号或None, 有效标记数组或None)]，有效标记为None时全部有效
+    返回: [(标签, 帧序号, 距离)]，按距离、再按candidates中的顺序和帧序号排列
+    """
+    import numpy as np
+
+    if not candidates:
+        return []
+    distances = []
+    for _, hashes, exclude, valid in candidates:
+        d = hamming(hashes, value).astype(np.int16)
+        if valid is not None:
+            d[~valid] = HASH_SIZE * HASH_SIZE + 1
+        if exclude is not None and 0 <= exclude < len(d):
+            d[exclude] = HASH_SIZE * HASH_SIZE + 1
+        distances.append(d)
+    owners = np.repeat(np.arange(len(candidates)), [len(d) for d in distances])
+    offsets = np.cumsum([0] + [len(d) for d in distances[:-1]])
+    distances = np.concatenate(distances)
+
+    # 被排除和没有哈希的帧距离为64+1，距离上限不超过64，避免它们作为匹配返回
+    limit = HASH_SIZE * HASH_SIZE if max_distance is None else min(max_distance, HASH_SIZE * HASH_SIZE)
+    selected = np.flatnonzero(distances <= limit)
+    # 距离相同时按位置排列，结果不随数组大小变化
+    order = distances[selected].astype(np.int64) * len(distances) + selected
+    if len(selected) > k:
+        # 只对最小的k个排序
+        keep = np.argpartition(order, k - 1)[:k]
+        selected, order = selected[keep], order[keep]
+    selected = selected[np.argsort(order)]
+    return [
+        (candidates[owners[i]][0], int(i - offsets[owners[i]]), int(distances[i]))
+        for i in selected
+    ]
+
+
+class FrameHashIndex:
+    """
+    按任务ID查找帧哈希
+
+    提取时计算了哈希的任务在状态目录中登记(任务ID -> 帧前缀、格式)，
+    哈希数组从存储读取一次后缓存在内存中(生成后不再变化)，查询时不读取任何图片。
+    登记超过ttl(帧已被生命周期清理删除)后失效。
+    """
+
+    def __init__(self, state_folder, storage, ttl=3600, max_entries=256):
+        self.folder = os.path.join(state_folder, 'hashes')
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def register(self, job_id, frames_path, format, versions=None):
+        """
+        登记任务的帧前缀，可以被 /api/jobs/<id>/similar 查询
+
+        versions: {帧序号: md5}，查询结果的帧地址带上内容哈希(?v=)
+        """
+        versions = versions or {}
+        record = {
+            'framesPath': frames_path,
+            'format': format,
+            'versions': [versions.get(i) for i in range(max(versions) + 1 if versions else 0)],
+            'created': time.time()
+        }
+        # 临时文件名唯一，同一进程的多个线程同时登记同一个任务ID时不会相互覆盖
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=f"{job_id}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, self._path(job_id))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def lookup(self, job_id):
+        """返回任务的登记信息，不存在或已过期时返回None"""
+        try:
+            with open(self._path(job_id)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - record.get('created', 0) >= self.ttl:
+            return None
+        return record
+
+    def hashes(self, frames_path):
+        """帧前缀下的 (哈希数组, 有效标记数组)，不存在时返回None"""
+        with self._lock:
+            entry = self._hashes.get(frames_path)
+            if entry is not None:
+                self._hashes.move_to_end(frames_path)
+                return entry
+
+        data = self.storage.get_file(f"{frames_path}/{HASHES_FILE}")
+        if not data:
+            return None
+        try:
+            entry = load_hashes(data)
+        except ValueError as e:
+            logger.warning(f"帧哈希文件格式错误: {frames_path}: {str(e)}")
+            return None
+        with self._lock:
+            self._hashes[frames_path] = entry
+            while len(self._hashes) > self.max_entries:
+                self._hashes.popitem(last=False)
+        return entry
+
+    def prune(self):
+        """删除过期的登记"""
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+
+class FlightTimeout(Exception):
+    """等待正在执行的相同任务超时"""
+
+
+class FlightBusy(FlightTimeout):
+    """等待相同任务的请求已达上限，不再排队等待"""
+
+
+def normalize_url(url):
+    """
+    规范化视频URL，使等价的链接得到相同的键
+
+    协议和主机名转为小写，去掉默认端口和片段(#...)，查询参数按名称排序。
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username:
+        auth = parts.username + (f":{parts.password}" if parts.password else '')
+        netloc = f"{auth}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+# 已计算过的文件哈希: (路径, 大小, 修改时间) -> sha256
+_digest_cache = OrderedDict()
+_digest_lock = threading.Lock()
+_DIGEST_CACHE_SIZE = 256
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """计算文件内容的sha256，文件未变化时直接使用缓存结果"""
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _digest_lock:
+        digest = _digest_cache.get(cache_key)
+    if digest:
+        return digest
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _digest_lock:
+        _digest_cache[cache_key] = digest
+        while len(_digest_cache) > _DIGEST_CACHE_SIZE:
+            _digest_cache.popitem(last=False)
+    return digest
+
+
+def job_key(kind, source, params=None):
+    """根据任务类型、视频来源和参数生成任务键"""
+    payload = json.dumps([kind, source, params or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class Flight:
+    """
+    一次合并后的任务
+
+    leader为True时由调用方执行任务，结束后必须调用publish或abandon；
+    否则result为其他请求已完成任务的结果。
+    """
+
+    def __init__(self, group, key, leader, result=None, lock_file=None):
+        self.group = group
+        self.key = key
+        self.leader = leader
+        self.result = result
+        self._lock_file = lock_file
+
+    @property
+    def pending(self):
+        """是否仍持有锁(尚未publish/abandon)"""
+        return self._lock_file is not None
+
+    def publish(self, result):
+        """保存任务结果供后续请求共享，并释放锁"""
+        if not self.leader:
+            return
+        self.result = result
+        try:
+            self.group._write_result(self.key, result)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"保存合并任务结果失败 {self.key}: {str(e)}")
+        self._release()
+
+    def abandon(self):
+        """任务失败时释放锁，等待中的请求会有一个接手重新执行"""
+        if self.leader:
+            self._release()
+
+    def _release(self):
+        lock_file = self._lock_file
+        if lock_file is None:
+            return
+        self._lock_file = None
+        # 先删除锁文件再解锁，等待者发现锁文件已被替换后会重新检查结果
+        try:
+            os.remove(self.group._lock_path(self.key))
+        except FileNotFoundError:
+            pass
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+class SingleFlight:
+    """
+    合并并发的相同任务(下载、帧提取)
+
+    同一个键同一时间只有一个请求执行，其他请求(包括其他gunicorn worker中的请求)
+    等待它完成后直接使用它的结果。通过状态目录中的文件锁协调，
+    完成的结果在result_ttl秒内可被后续请求复用。
+
+    等待会占用一个Flask线程，每个进程中同一个键最多max_waiters个、所有键合计最多
+    max_waiters_total个请求等待，超过时立即抛出FlightBusy，避免等待者占满线程池。
+    """
+
+    # 等待锁时的轮询间隔(秒)
+    POLL_INTERVAL = 0.2
+    # 每发布多少次结果清理一次过期的结果文件
+    PRUNE_EVERY = 100
+
+    def __init__(self, state_folder, result_ttl=600, wait_timeout=110, max_waiters=1, max_waiters_total=2):
+        self.folder = os.path.join(state_folder, 'flight')
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+        self.max_waiters = max_waiters
+        self.max_waiters_total = max_waiters_total
+        self._published = 0
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _lock_path(self, key):
+        return os.path.join(self.folder, f"{key}.lock")
+
+    def _result_path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def _read_result(self, key):
+        """读取未过期的任务结果，不存在时返回None"""
+        try:
+            with open(self._result_path(key)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - record.get('created', 0) > self.result_ttl:
+            return None
+        return record.get('result')
+
+    def _write_result(self, key, result):
+        path = self._result_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'result': result}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        self._published += 1
+        if self._published % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def forget(self, key):
+        """删除已保存的结果(例如结果引用的本地文件已被清理)"""
+        try:
+            os.remove(self._result_path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """删除过期的结果文件"""
+        cutoff = time.time() - self.result_ttl
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def join(self, key):
+        """
+        加入键为key的任务
+
+        已有结果时直接返回；没有请求在执行时成为leader(持有锁)；
+        否则等待正在执行的请求完成。等待超时时抛出FlightTimeout，等待的请求已达上限时抛出FlightBusy，
+        不在没有锁的情况下执行(相同任务的输出位置相同，并发执行会相互覆盖)。
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        waiting = False
+        try:
+            while True:
+                result = self._read_result(key)
+                if result is not None:
+                    if waited:
+                        logger.info(f"合并到已完成的相同任务: {key[:16]}")
+                    return Flight(self, key, leader=False, result=result)
+
+                lock_path = self._lock_path(key)
+                lock_file = open(lock_path, 'a')
+                if not self._try_lock(lock_file):
+                    if not waiting:
+                        if not self._enter_wait(key):
+                            lock_file.close()
+                            logger.info(f"等待相同任务的请求已达上限: {key[:16]}")
+                            raise FlightBusy(key)
+                        waiting = True
+                    if not self._wait_lock(lock_file, deadline):
+                        lock_file.close()
+                        logger.warning(f"等待相同任务超时: {key[:16]}")
+                        raise FlightTimeout(key)
+
+                # 持锁期间锁文件被上一个leader删除并重建时，说明锁已失效，重新检查
+                try:
+                    current = os.stat(lock_path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(lock_file.fileno()).st_ino:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+                    waited = True
+                    continue
+
+                result = self._read_result(key)
+                if result is not None:
+                    Flight(self, key, leader=True, lock_file=lock_file).abandon()
+                    return Flight(self, key, leader=False, result=result)
+                return Flight(self, key, leader=True, lock_file=lock_file)
+        finally:
+            if waiting:
+                self._leave_wait(key)
+
+    def _enter_wait(self, key):
+        """登记一个等待者，超过上限时返回False"""
+        with self._waiters_lock:
+            if (self._waiters.get(key, 0) >= self.max_waiters
+                    or sum(self._waiters.values()) >= self.max_waiters_total):
+                return False
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            return True
+
+    def _leave_wait(self, key):
+        with self._waiters_lock:
+            count = self._waiters.pop(key) - 1
+            if count:
+                self._waiters[key] = count
+
+    @staticmethod
+    def _try_lock(lock_file):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _wait_lock(self, lock_file, deadline):
+        """获取文件锁，超过deadline返回False"""
+        while time.monotonic() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            if self._try_lock(lock_file):
+                return True
+        return False
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import itertools
+from contextlib import contextmanager
+from process_owner import ProcessOwner
+
+logger = logging.getLogger(__name__)
+
+# 估算单帧输出大小时使用的压缩比(相对于未压缩的BGR数据)
+COMPRESSION_RATIO = {
+    'jpg': 0.15,
+    'png': 0.5
+}
+
+
+class SpoolFullError(Exception):
+    """本地磁盘配额不足，且无法通过清理已完成任务腾出空间"""
+
+
+def estimate_frames_bytes(meta, frame_total, format='jpg'):
+    """根据分辨率和输出帧数估算帧文件占用的磁盘空间"""
+    raw = meta.get('width', 0) * meta.get('height', 0) * 3
+    return int(raw * COMPRESSION_RATIO.get(format, 1.0) * frame_total)
+
+
+def path_size(path):
+    """计算文件或目录占用的字节数"""
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+    except OSError:
+        return 0
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+def remove_path(path):
+    """删除文件或目录，不存在时忽略"""
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"删除本地文件失败 {path}: {str(e)}")
+
+
+class SpoolLease:
+    """正在使用中的本地文件/目录，持有期间不会被清理"""
+
+    def __init__(self, manager, path, lease_file, reserved):
+        self.manager = manager
+        self.path = path
+        self.lease_file = lease_file
+        self.reserved = reserved
+        self.released = False
+
+    def release(self, delete=False):
+        """释放租约; delete为True时同时删除对应的本地文件"""
+        if self.released:
+            return
+        self.released = True
+        with self.manager._locked():
+            sizes = self.manager._load_sizes()
+            if delete:
+                remove_path(self.path)
+            elif os.path.exists(self.path):
+                # 更新修改时间，作为LRU清理的依据
+                try:
+                    os.utime(self.path)
+                except OSError:
+                    pass
+            # 只重新统计这一个条目的大小
+            self.manager._measure(sizes, self.path)
+            try:
+                os.remove(self.lease_file)
+            except FileNotFoundError:
+                pass
+            self.manager._save_sizes(sizes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release(delete=exc_type is not None)
+
+
+class SpoolManager:
+    """
+    本地磁盘缓冲区管理
+
+    管理上传目录和帧目录下的顶层条目(上传的视频文件、每个任务的帧目录):
+    - 开始任务前按估算大小预留空间，超出配额时按LRU清理已完成的条目
+    - 使用中的条目在状态目录中有租约文件，记录所属进程的属主文件；
+      进程存活期间持有属主文件的flock，崩溃后由内核释放，不依赖可能被复用的进程号
+    - 各条目的大小记录在状态目录中，只在条目释放、清理时重新统计，预留空间时不遍历磁盘
+    - 启动时和空间不足时清理崩溃worker遗留的条目
+    """
+
+    SIZES_FILE = 'sizes.json'
+
+    def __init__(self, roots, quota_bytes, state_folder):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.quota_bytes = quota_bytes
+        self.lease_folder = os.path.join(state_folder, 'spool')
+        os.makedirs(self.lease_folder, exist_ok=True)
+        self.owner = ProcessOwner(self.lease_folder)
+
+    @contextmanager
+    def _locked(self):
+        """跨进程互斥，保证预留空间的计算不会相互覆盖"""
+        with open(os.path.join(self.lease_folder, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # 同一路径可以同时有多个租约(例如合并的请求共用一个下载的视频)
+    _lease_ids = itertools.count()
+
+    def _lease_file(self, path, owner):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.lease_folder, f"{digest}.{owner[:-len('.owner')]}.{next(self._lease_ids)}.lease")
+
+    def _leases(self):
+        """读取所有租约，返回 [(租约文件, 内容)]"""
+        leases = []
+        for name in os.listdir(self.lease_folder):
+            if not name.endswith('.lease'):
+                continue
+            lease_file = os.path.join(self.lease_folder, name)
+            try:
+                with open(lease_file) as f:
+                    leases.append((lease_file, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return leases
+
+    def _entries(self):
+        """列出所有顶层条目，返回 [(路径, 大小, 修改时间)]"""
+        entries = []
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        mtime = entry.stat(follow_symlinks=False).st_mtime
+                    except OSError:
+                        continue
+                    entries.append((entry.path, path_size(entry.path), mtime))
+        return entries
+
+    def _load_sizes(self):
+        """读取各条目的大小 {路径: 字节数}，记录不存在或损坏时遍历一次磁盘重建(需要在_locked中调用)"""
+        try:
+            with open(os.path.join(self.lease_folder, self.SIZES_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self._rescan()
+
+    def _save_sizes(self, sizes):
+        path = os.path.join(self.lease_folder, self.SIZES_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sizes, f)
+        os.replace(tmp_path, path)
+
+    def _rescan(self):
+        """遍历所有顶层条目重新统计大小"""
+        return {path: size for path, size, _ in self._entries()}
+
+    @staticmethod
+    def _measure(sizes, path):
+        """重新统计一个条目的大小，条目已删除时移除记录"""
+        if os.path.exists(path):
+            sizes[path] = path_size(path)
+        else:
+            sizes.pop(path, None)
+
+    def usage(self, sizes=None):
+        """已记录的磁盘占用加上租约中尚未写入的预留空间"""
+        if sizes is None:
+            with self._locked():
+                sizes = self._load_sizes()
+        reserved = 0
+        for _, lease in self._leases():
+            reserved += max(0, lease.get('reserved', 0) - sizes.get(lease['path'], 0))
+        return sum(sizes.values()) + reserved
+
+    def reserve(self, path, estimated_bytes=0, complete=False):
+        """
+        为即将写入的文件/目录预留空间并加租约
+
+        空间不足时按修改时间从旧到新清理没有租约的条目，
+        仍然不足则抛出SpoolFullError。
+        complete为True表示文件已经写完(见pin)，持有的进程崩溃后不删除。
+        """
+        path = os.path.abspath(path)
+        with self._locked():
+            sizes = self._load_sizes()
+            if complete:
+                # 已写完的文件(例如下载完成后改名的视频)在这里计入占用
+                self._measure(sizes, path)
+            needed = self.usage(sizes) + estimated_bytes - self.quota_bytes
+            if needed > 0:
+                # 记录可能与磁盘不一致(例如文件被外部删除)，空间不足时先清理崩溃遗留的条目并重新统计
+                self._recover()
+                sizes = self._rescan()
+                needed = self.usage(sizes) + estimated_bytes - self.quota_bytes
+                freed = self._evict(sizes, needed) if needed > 0 else 0
+                self._save_sizes(sizes)
+                if freed < needed:
+                    raise SpoolFullError(
+                        f"本地磁盘配额不足: 需要 {estimated_bytes} 字节，"
+                        f"清理后仍差 {needed - freed} 字节"
+                    )
+            else:
+                self._save_sizes(sizes)
+            owner = self.owner.name()
+            lease_file = self._lease_file(path, owner)
+            with open(lease_file, 'w') as f:
+                json.dump({
+                    'path': path,
+                    'owner': owner,
+                    'pid': os.getpid(),
+                    'reserved': estimated_bytes,
+                    'complete': complete,
+                    'created': time.time()
+                }, f)
+        return SpoolLease(self, path, lease_file, estimated_bytes)
+
+    def pin(self, path):
+        """
+        为已经写完的文件(上传或下载完成的视频)加租约，使用期间不会被清理
+
+        与reserve不同，持有的进程崩溃后只删除租约，文件保留给重试的请求使用
+        """
+        return self.reserve(path, complete=True)
+
+    def _evict(self, sizes, needed):
+        """按LRU清理已完成的条目，返回释放的字节数"""
+        active = {lease['path'] for _, lease in self._leases()}
+        freed = 0
+        for path, size, _ in sorted(self._entries(), key=lambda e: e[2]):
+            if freed >= needed:
+                break
+            if path in active:
+                continue
+            remove_path(path)
+            sizes.pop(path, None)
+            freed += size
+            logger.info(f"磁盘配额不足，清理已完成的本地文件: {path} ({size} 字节)")
+        return freed
+
+    def _recover(self):
+        """清理属主进程已退出的租约和属主文件(需要在_locked中调用)，返回清理的租约数"""
+        recovered = 0
+        leases = self._leases()
+        alive = {}
+        for _, lease in leases:
+            owner = lease.get('owner')
+            if owner not in alive:
+                alive[owner] = self.owner.alive(owner)
+        active = {lease['path'] for _, lease in leases if alive[lease.get('owner')]}
+        for lease_file, lease in leases:
+            if alive[lease.get('owner')]:
+                continue
+            # 已写完的文件和其他存活进程仍在使用的路径只删除租约
+            if not lease.get('complete') and lease['path'] not in active:
+                remove_path(lease['path'])
+            try:
+                os.remove(lease_file)
+            except FileNotFoundError:
+                pass
+            recovered += 1
+            logger.info(f"清理崩溃进程遗留的本地文件: {lease['path']}")
+        self.owner.prune()
+        return recovered
+
+    def recover_orphans(self):
+        """清理崩溃worker遗留的租约及其未完成的输出，并重新统计各条目的大小，返回清理的条目数"""
+        with self._locked():
+            recovered = self._recover()
+            self._save_sizes(self._rescan())
+        return recovered
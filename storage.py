@@ -0,0 +1,109 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Storage:
+    """
+    对象存储接口，web_app 和 R2Lifecycle 只通过这些方法访问存储
+
+    对象用 / 分隔的键标识(例如 frames/2026101712/<任务>/frame_000000.jpg)，
+    列表返回的每个对象是包含 Key、Size、LastModified(带时区的datetime) 的字典。
+    实现: r2_storage.R2Storage (Cloudflare R2/S3兼容接口)、local_storage.LocalStorage (本地文件系统)
+    """
+
+    # 对象是否保存在本机文件系统中(可以直接返回文件，不经过存储接口读取)
+    is_local = False
+
+    def upload_file(self, file_path, object_name, content_type=None):
+        """上传本地文件，返回是否成功"""
+        raise NotImplementedError
+
+    def upload_fileobj(self, file_obj, object_name, content_type=None):
+        """上传文件对象，返回是否成功"""
+        raise NotImplementedError
+
+    def download_file(self, object_name, file_path):
+        """下载到本地文件，返回是否成功"""
+        raise NotImplementedError
+
+    def get_presigned_url(self, object_name, expiration=3600):
+        """获取可直接访问的临时地址，不支持时返回None"""
+        return None
+
+    def local_path(self, object_name):
+        """对象在本机文件系统中的路径，不是本地存储或对象不存在时返回None"""
+        return None
+
+    def delete_file(self, object_name):
+        """删除对象，返回是否成功"""
+        raise NotImplementedError
+
+    def delete_files(self, object_names):
+        """批量删除对象，返回成功删除的数量"""
+        return sum(1 for name in object_names if self.delete_file(name))
+
+    def list_page(self, prefix='', continuation_token=None, max_keys=1000):
+        """
+        列出一页对象
+
+        返回: (对象列表, 下一页的令牌，没有下一页时为None)，出错时抛出异常
+        """
+        raise NotImplementedError
+
+    def iter_files(self, prefix=''):
+        """遍历指定前缀的所有对象，出错时抛出异常"""
+        token = None
+        while True:
+            objects, token = self.list_page(prefix, token)
+            yield from objects
+            if not token:
+                break
+
+    def list_files(self, prefix=''):
+        """列出指定前缀的所有对象，出错时返回空列表"""
+        try:
+            return list(self.iter_files(prefix))
+        except Exception as e:
+            logger.error(f"列出文件失败: {str(e)}")
+            return []
+
+    def list_prefixes(self, prefix=''):
+        """
+        按 / 分隔列出prefix下一级的子目录和对象
+
+        返回: (子目录前缀列表, 该层的对象列表)，出错时抛出异常
+        """
+        raise NotImplementedError
+
+    def get_file(self, object_name):
+        """读取对象内容，不存在时返回None"""
+        raise NotImplementedError
+
+    def get_range(self, object_name, offset, length):
+        """读取对象中从offset开始的length个字节，不存在时返回None"""
+        raise NotImplementedError
+
+    def copy_file(self, source_name, object_name):
+        """在存储内复制对象，返回是否成功"""
+        raise NotImplementedError
+
+
+def create_storage(backend=None):
+    """
+    按配置创建存储后端
+
+    backend: 'r2' 或 'local'，为None时使用config.STORAGE_BACKEND
+    """
+    if backend is None:
+        from config import STORAGE_BACKEND
+        backend = STORAGE_BACKEND
+
+    if backend == 'r2':
+        from r2_storage import R2Storage
+        return R2Storage()
+    if backend == 'local':
+        from config import LOCAL_STORAGE_ROOT
+        from local_storage import LocalStorage
+        return LocalStorage(LOCAL_STORAGE_ROOT)
+    raise ValueError(f"未知的存储后端: {backend}")
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+# 标准LogRecord属性，其余属性(通过extra传入)作为结构化字段输出
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行JSON，extra中的字段原样合并到顶层"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    只在调用线程中合并消息参数和异常堆栈，JSON序列化和写入都在后台线程完成
+
+    标准QueueHandler.prepare会调用格式化器把整条记录格式化成文本，这里保留结构化字段。
+    """
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class _BackgroundLogging:
+    """根日志记录器 -> 队列 -> 后台线程写入stderr"""
+
+    def __init__(self, handler, target):
+        self.handler = handler
+        self.target = target
+        self.listener = None
+
+    def start(self):
+        self.handler.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def after_fork(self):
+        # gunicorn --preload 分叉后子进程中没有后台线程，用新的队列重新启动
+        self.listener = None
+        self.start()
+
+
+_background = None
+
+
+def setup_logging(level='INFO', fmt='json'):
+    """
+    配置根日志记录器: 日志写入内存队列，由后台线程格式化并输出，请求线程不等待IO
+
+    fmt: json 每行一条JSON记录，text 沿用原来的文本格式
+    重复调用时只更新级别
+    """
+    global _background
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _background is not None:
+        return _background
+
+    target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler = _QueueHandler(queue.SimpleQueue())
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+    _background = _BackgroundLogging(handler, target)
+    _background.start()
+    # 退出时把队列中剩余的日志写完
+    atexit.register(_background.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_background.after_fork)
+    return _background
+
+
+class JobSummary:
+    """
+    汇总一个任务中逐帧事件的次数和字节数，任务结束时只输出一条日志
+
+    替代逐帧的INFO日志: 5000帧的任务只产生一条汇总记录
+    """
+
+    def __init__(self, job_id, **fields):
+        self.job_id = job_id
+        self.fields = dict(fields)
+        self.counts = {}
+        self.started = time.monotonic()
+        self.emitted = False
+
+    def add(self, name, count=1):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def emit(self, logger, status, timings=None):
+        """输出汇总记录，同一任务只输出一次"""
+        if self.emitted:
+            return
+        self.emitted = True
+        logger.info(
+            "任务结束: %s status=%s counts=%s", self.job_id, status, self.counts,
+            extra={
+                'event': 'job_summary',
+                'job_id': self.job_id,
+                'status': status,
+                'counts': self.counts,
+                'duration_ms': round((time.monotonic() - self.started) * 1000, 2),
+                'timings': timings or {},
+                **self.fields
+            }
+        )
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+
+# 测试使用本地存储后端和临时目录，需要在导入config之前设置
+_ROOT = tempfile.mkdtemp(prefix='vf1_tests_')
+for _name, _value in {
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_ROOT': os.path.join(_ROOT, 'storage'),
+    'STATE_FOLDER': os.path.join(_ROOT, 'state'),
+    'PROFILES_FOLDER': os.path.join(_ROOT, 'profiles'),
+    'UPLOAD_FOLDER': os.path.join(_ROOT, 'uploads'),
+    'FRAMES_FOLDER': os.path.join(_ROOT, 'frames'),
+    'EXTRACT_POOL_SIZE': '0',
+    'ADMISSION_CAPACITY': '1e12',
+    'ADMISSION_REFILL_RATE': '1e12',
+    'LOG_LEVEL': 'WARNING',
+}.items():
+    os.environ.setdefault(_name, _value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def video_file():
+    """生成一个30帧、10fps的小视频，放在上传目录中，返回文件名"""
+    import cv2
+    import numpy as np
+
+    folder = os.environ['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'sample.mp4')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (64, 48))
+    rng = np.random.default_rng(0)
+    for i in range(30):
+        writer.write(rng.integers(0, 255, (48, 64, 3), dtype=np.uint8))
+    writer.release()
+    return 'sample.mp4'
+
+
+@pytest.fixture
+def client():
+    import web_app
+
+    return web_app.app.test_client()
@@ -0,0 +1,124 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+import admission
+
+
+def controller(tmp_path, refill_rate, max_wait=5):
+    store = admission.TokenBucketStore(str(tmp_path / 'admission.sqlite3'), capacity=2, refill_rate=refill_rate)
+    return admission.AdmissionController(store, max_wait=max_wait)
+
+
+def test_admit_rejects_without_sleeping(tmp_path, monkeypatch):
+    def sleep(seconds):
+        raise AssertionError(f'请求线程中等待了 {seconds} 秒')
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    admit = controller(tmp_path, refill_rate=1).admit
+    assert admit('ip:a', 2)[0]
+    allowed, retry_after = admit('ip:a', 2)
+    assert not allowed
+    assert retry_after >= 1
+    # 每个客户端的桶互不影响
+    assert admit('ip:b', 1)[0]
+
+
+def test_admit_async_queues_short_waits_on_the_event_loop(tmp_path):
+    limiter = controller(tmp_path, refill_rate=20, max_wait=1)
+
+    async def run():
+        assert (await limiter.admit_async('ip:a', 2))[0]
+        t0 = time.monotonic()
+        allowed, _ = await limiter.admit_async('ip:a', 1)
+        return allowed, time.monotonic() - t0
+
+    allowed, waited = asyncio.run(run())
+    assert allowed
+    assert 0.02 <= waited < 1
+
+
+def test_admit_async_rejects_long_waits(tmp_path):
+    limiter = controller(tmp_path, refill_rate=0.01, max_wait=1)
+
+    async def run():
+        await limiter.admit_async('ip:a', 2)
+        return await limiter.admit_async('ip:a', 2)
+
+    allowed, retry_after = asyncio.run(run())
+    assert not allowed
+    assert retry_after > 1
+
+
+class Request:
+    def __init__(self, remote_addr, **headers):
+        self.remote_addr = remote_addr
+        self.headers = {name.replace('_', '-'): value for name, value in headers.items()}
+
+
+def test_client_key_ignores_unknown_api_keys():
+    limiter = admission.AdmissionController(None, api_keys=['known'])
+    assert limiter.client_key(Request('203.0.113.5', **{'X_API_Key': 'known'})).startswith('key:')
+    # 随机的Key不能得到新的令牌桶
+    assert limiter.client_key(Request('203.0.113.5', **{'X_API_Key': 'random-1'})) == 'ip:203.0.113.5'
+    assert limiter.client_key(Request('203.0.113.5', **{'X_API_Key': 'random-2'})) == 'ip:203.0.113.5'
+
+
+def test_client_ip_uses_proxy_headers_only_from_trusted_proxies():
+    limiter = admission.AdmissionController(None, trusted_proxies=['10.0.0.0/8', '127.0.0.1'])
+    assert limiter.client_ip(Request('10.1.2.3', CF_Connecting_IP='198.51.100.7')) == '198.51.100.7'
+    assert limiter.client_ip(Request('127.0.0.1', X_Forwarded_For='1.1.1.1, 198.51.100.8, 10.0.0.2')) == '198.51.100.8'
+    assert limiter.client_ip(Request('10.1.2.3')) == '10.1.2.3'
+    # 不是受信任的代理时代理头可以被伪造
+    assert limiter.client_ip(Request('203.0.113.9', CF_Connecting_IP='198.51.100.7',
+                                     X_Forwarded_For='198.51.100.8')) == '203.0.113.9'
+
+
+def test_video_url_is_charged_before_download(client, monkeypatch):
+    import web_app
+
+    charged = []
+
+    def admit(key, cost):
+        charged.append(cost)
+        return cost <= 1, 30
+
+    def fetch_video(video_url, cancel=None):
+        raise AssertionError('额度不足时不应下载')
+
+    monkeypatch.setattr(web_app.admission_controller, 'admit', admit)
+    monkeypatch.setattr(web_app.video_downloader, 'content_length', lambda url: 200 * 1000 * 1000)
+    monkeypatch.setattr(web_app, 'fetch_video', fetch_video)
+    r = client.post('/api/extract-frames', json={'videoUrl': 'http://example.invalid/large.mp4', 'fps': 1})
+    assert r.status_code == 429
+    assert r.headers['Retry-After'] == '30'
+    assert charged == [1, admission.estimate_download_cost(200 * 1000 * 1000)]
+
+
+def test_probed_cost_is_settled_after_prepaid_part(client, monkeypatch, video_file):
+    import shutil
+    import web_app
+
+    charged = []
+
+    def admit(key, cost):
+        charged.append(cost)
+        return True, 0
+
+    def fetch_video(video_url, cancel=None):
+        path = os.path.join(web_app.app.config['UPLOAD_FOLDER'], 'prepaid.mp4')
+        shutil.copyfile(os.path.join(web_app.app.config['UPLOAD_FOLDER'], video_file), path)
+        return path, web_app.spool_manager.pin(path)
+
+    monkeypatch.setattr(web_app.admission_controller, 'admit', admit)
+    monkeypatch.setattr(web_app.video_downloader, 'content_length', lambda url: None)
+    monkeypatch.setattr(web_app, 'fetch_video', fetch_video)
+    r = client.post('/api/extract-frames', json={'videoUrl': 'http://example.invalid/prepaid.mp4', 'fps': 2})
+    assert r.status_code == 200
+    meta = admission.probe_video(os.path.join(web_app.app.config['UPLOAD_FOLDER'], 'prepaid.mp4'))
+    cost = admission.estimate_cost(meta, fps=2)
+    # 装饰器的1个单位、下载前预扣的1个单位，之后只补扣差额
+    assert charged[:2] == [1, 1.0]
+    assert charged[2:] == ([pytest.approx(cost - 1.0)] if cost > 1.0 else [])
@@ -0,0 +1,197 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, request, send_file, stream_with_context
+
+import admission
+from asgi_app import AsyncRequest, WsgiBridge
+
+
+def make_app(closed):
+    app = Flask(__name__)
+
+    @app.route('/stream')
+    def stream():
+        count = int(request.args['n'])
+
+        @stream_with_context
+        def generate():
+            thread = threading.get_ident()
+            try:
+                for i in range(count):
+                    time.sleep(0.005)
+                    # 每块都在同一个线程中生成，并能访问请求上下文
+                    assert threading.get_ident() == thread
+                    yield f"{request.args['id']}:{i}\n"
+            finally:
+                closed.append((request.args['id'], threading.get_ident() == thread))
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    return app
+
+
+def scope(query):
+    return {
+        'type': 'http', 'method': 'GET', 'path': '/stream', 'root_path': '',
+        'query_string': query.encode(), 'headers': [(b'host', b'test')],
+        'client': ('127.0.0.1', 1), 'server': ('test', 80), 'scheme': 'http', 'http_version': '1.1'
+    }
+
+
+async def request_stream(bridge, query, disconnect_after=None):
+    messages = []
+    sent = asyncio.Event()
+
+    async def receive():
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        while sum(1 for m in messages if m.get('body')) < disconnect_after:
+            sent.clear()
+            await sent.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+        sent.set()
+
+    await bridge(scope(query), receive, send)
+    return messages
+
+
+def test_concurrent_streams_keep_request_context():
+    closed = []
+    bridge = WsgiBridge(make_app(closed), ThreadPoolExecutor(4))
+
+    async def run():
+        return await asyncio.gather(*[request_stream(bridge, f"id={i}&n=20") for i in range(6)])
+
+    results = asyncio.run(run())
+    for i, messages in enumerate(results):
+        assert messages[0]['status'] == 200
+        body = b''.join(m.get('body', b'') for m in messages[1:]).decode()
+        assert body == ''.join(f"{i}:{n}\n" for n in range(20))
+        assert messages[-1]['more_body'] is False
+    assert sorted(closed) == [(str(i), True) for i in range(6)]
+
+
+def test_disconnect_closes_stream_on_its_thread():
+    closed = []
+    executor = ThreadPoolExecutor(2)
+    bridge = WsgiBridge(make_app(closed), executor)
+
+    async def run():
+        messages = await request_stream(bridge, "id=x&n=1000", disconnect_after=3)
+        for _ in range(100):
+            if closed:
+                break
+            await asyncio.sleep(0.01)
+        return messages
+
+    messages = asyncio.run(run())
+    assert len([m for m in messages if m.get('body')]) < 1000
+    assert closed == [('x', True)]
+
+
+def test_client_key_uses_api_key_header_case_insensitively():
+    request = AsyncRequest(dict(scope(''), headers=[(b'x-api-key', b'secret')]))
+    assert admission.AdmissionController(None, api_keys=['secret']).client_key(request).startswith('key:')
+
+
+def file_app(path):
+    app = Flask(__name__)
+
+    @app.route('/file')
+    def file():
+        return send_file(path, conditional=True)
+
+    return app
+
+
+def request_file(bridge, headers=(), extensions=None):
+    messages = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    request_scope = dict(scope(''), path='/file', headers=[(b'host', b'test')] + list(headers))
+    if extensions is not None:
+        request_scope['extensions'] = extensions
+    asyncio.run(bridge(request_scope, receive, send))
+    return messages
+
+
+def test_send_file_is_sent_from_the_event_loop(tmp_path):
+    import asgi_app
+
+    data = bytes(range(256)) * 10000
+    path = tmp_path / 'frame.bin'
+    path.write_bytes(data)
+    bridge = WsgiBridge(file_app(str(path)), ThreadPoolExecutor(2))
+
+    messages = request_file(bridge)
+    assert messages[0]['status'] == 200
+    chunks = [m['body'] for m in messages[1:] if m.get('body')]
+    assert b''.join(chunks) == data
+    # 按大块读取，而不是werkzeug FileWrapper的8KB
+    assert max(len(c) for c in chunks) == asgi_app.FILE_BLOCK_SIZE
+
+    messages = request_file(bridge, [(b'range', b'bytes=1000-2999')])
+    assert messages[0]['status'] == 206
+    assert b''.join(m.get('body', b'') for m in messages[1:]) == data[1000:3000]
+
+
+def test_send_file_uses_pathsend_when_supported(tmp_path):
+    path = tmp_path / 'frame.bin'
+    path.write_bytes(b'x' * 100)
+    bridge = WsgiBridge(file_app(str(path)), ThreadPoolExecutor(1))
+    messages = request_file(bridge, extensions={'http.response.pathsend': {}})
+    assert messages[0]['status'] == 200
+    assert messages[1] == {'type': 'http.response.pathsend', 'path': str(path)}
+
+
+def test_head_proxy_image_closes_upstream(monkeypatch):
+    import asgi_app
+
+    closed = []
+
+    class Upstream:
+        status_code = 200
+        headers = {'content-type': 'image/png'}
+
+        async def aiter_bytes(self):
+            yield b'png'
+
+        async def aclose(self):
+            closed.append(True)
+
+    class Client:
+        def build_request(self, method, url):
+            return (method, url)
+
+        async def send(self, request, stream=False):
+            return Upstream()
+
+    frame_app = asgi_app.AsyncFrameApp(Flask(__name__), None)
+    frame_app.http = Client()
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def run(method):
+        request = AsyncRequest(dict(scope('url=http://example.invalid/a.png'), method=method))
+        response = await frame_app.proxy_image(request)
+        await response.send(send, head=method == 'HEAD')
+
+    asyncio.run(run('HEAD'))
+    assert closed == [True]
+    assert messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    asyncio.run(run('GET'))
+    assert closed == [True, True]
+    assert b''.join(m.get('body', b'') for m in messages[2:]) == b'png'
@@ -0,0 +1,51 @@
+import json
+
+from frame_server import BundleIndex
+
+
+class DictStorage:
+    """记录调用的内存存储"""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = []
+
+    def list_files(self, prefix=''):
+        self.calls.append(('list', prefix))
+        return [{'Key': key} for key in sorted(self.objects) if key.startswith(prefix)]
+
+    def get_file(self, name):
+        self.calls.append(('get', name))
+        return self.objects.get(name)
+
+    def get_range(self, name, offset, length):
+        self.calls.append(('range', name))
+        return self.objects[name][offset:offset + length]
+
+
+def test_plain_folder_never_reads_manifest():
+    storage = DictStorage({'frames/a/frame_000000.jpg': b'x'})
+    index = BundleIndex(storage)
+    assert index.read('frames/a/frame_000001.jpg') is None
+    assert index.read('frames/a/frame_000002.jpg') is None
+    assert storage.calls == [('list', 'frames/a/manifest.json')]
+
+
+def test_bundled_folder_reads_frame_by_range():
+    manifest = {'bundle': 'frames.bundle', 'contentType': 'image/png',
+                'frames': [{'name': 'f0.png', 'offset': 3, 'length': 2}]}
+    storage = DictStorage({
+        'frames/b/manifest.json': json.dumps(manifest).encode(),
+        'frames/b/frames.bundle': b'abcdefg'
+    })
+    index = BundleIndex(storage)
+    assert index.read('frames/b/f0.png') == (b'de', 'image/png')
+    assert index.read('frames/b/missing.png') is None
+    assert [c[0] for c in storage.calls] == ['list', 'get', 'range']
+
+
+def test_listed_manifest_skips_listing():
+    manifest = {'bundle': 'frames.bundle', 'frames': []}
+    storage = DictStorage({'frames/c/manifest.json': json.dumps(manifest).encode()})
+    assert BundleIndex(storage).manifest('frames/c', listed=True)['frames'] == {}
+    assert storage.calls == [('get', 'frames/c/manifest.json')]
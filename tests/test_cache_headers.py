@@ -0,0 +1,33 @@
+import io
+
+import web_app
+from config import CACHE_CONTROL, UNVERSIONED_CACHE_CONTROL
+
+
+def put(name, data=b'frame-bytes'):
+    assert web_app.storage.upload_fileobj(io.BytesIO(data), name, 'image/jpeg')
+
+
+def test_unversioned_object_is_short_lived(client):
+    put('frames/cache/a.jpg')
+    r = client.get('/storage/frames/cache/a.jpg')
+    assert r.status_code == 200
+    assert r.headers['Cache-Control'] == UNVERSIONED_CACHE_CONTROL
+
+
+def test_versioned_object_is_immutable(client):
+    put('frames/cache/b.jpg')
+    r = client.get('/storage/frames/cache/b.jpg?v=0123456789abcdef')
+    assert r.headers['Cache-Control'] == CACHE_CONTROL
+    r = client.get('/storage/frames/cache/b.jpg?v=0123456789abcdef',
+                   headers={'If-None-Match': '"0123456789abcdef"'})
+    assert r.status_code == 304
+    assert r.headers['Cache-Control'] == CACHE_CONTROL
+
+
+def test_frame_image_cache_control_follows_version(client):
+    put('frames/cache/c.jpg')
+    r = client.get('/api/get-frame-image?filepath=frames/cache/c.jpg')
+    assert r.headers['Cache-Control'] == UNVERSIONED_CACHE_CONTROL
+    r = client.get('/api/get-frame-image?filepath=frames/cache/c.jpg&v=abc')
+    assert r.headers['Cache-Control'] == CACHE_CONTROL
@@ -0,0 +1,58 @@
+import cancellation
+import web_app
+
+
+def count_uploads(monkeypatch, cancel_at=None, job_id=None, reason=cancellation.CancelToken.DEADLINE):
+    """记录上传次数，第cancel_at次上传后按reason取消任务"""
+    calls = []
+    upload_file = web_app.storage.upload_file
+
+    def upload(path, object_name, content_type=None):
+        calls.append(object_name)
+        result = upload_file(path, object_name, content_type)
+        if cancel_at is not None and len(calls) == cancel_at:
+            web_app.job_registry._local[job_id].cancel(reason)
+        return result
+
+    monkeypatch.setattr(web_app.storage, 'upload_file', upload)
+    return calls
+
+
+def frame_objects(frames_path):
+    return [obj for obj in web_app.storage.list_files(f"{frames_path}/") if obj['Key'].endswith('.jpg')]
+
+
+def test_deadline_keeps_journal_and_resumes(client, monkeypatch, video_file):
+    params = {'videoPath': video_file, 'fps': 10, 'quality': 71}
+    calls = count_uploads(monkeypatch, cancel_at=5, job_id='resume-1')
+    r = client.post('/api/extract-frames', json=dict(params, jobId='resume-1'))
+    assert r.status_code == 408
+    assert r.get_json()['cancelled'] == cancellation.CancelToken.DEADLINE
+    assert len(calls) == 5
+    frames_path = calls[0].rsplit('/', 1)[0]
+    # 超时取消时保留已上传的帧
+    assert len(frame_objects(frames_path)) == 5
+
+    calls = count_uploads(monkeypatch)
+    r = client.post('/api/extract-frames', json=dict(params, jobId='resume-2'))
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data['framesPath'].endswith(frames_path)
+    assert [f['index'] for f in data['frames']] == list(range(data['count']))
+    # 已上传的5帧从进度日志恢复，不再上传
+    assert len(calls) == data['count'] - 5
+    assert all(f['url'] for f in data['frames'])
+
+
+def test_explicit_cancel_discards_partial_results(client, monkeypatch, video_file):
+    params = {'videoPath': video_file, 'fps': 5, 'quality': 72}
+    calls = count_uploads(monkeypatch, cancel_at=3, job_id='discard-1', reason=cancellation.CancelToken.REQUESTED)
+    r = client.post('/api/extract-frames', json=dict(params, jobId='discard-1'))
+    assert r.status_code == 409
+    frames_path = calls[0].rsplit('/', 1)[0]
+    assert frame_objects(frames_path) == []
+
+    calls = count_uploads(monkeypatch)
+    r = client.post('/api/extract-frames', json=dict(params, jobId='discard-2'))
+    assert r.status_code == 200
+    assert len(calls) == r.get_json()['count']
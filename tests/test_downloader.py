@@ -0,0 +1,128 @@
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import downloader
+from downloader import SegmentedDownloader
+
+DATA = bytes(range(256)) * 4096  # 1MB
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    测试用的文件服务器
+
+    ranges: 'all' - 支持Range; 'probe' - 只对探测请求(bytes=0-0)返回206; 'none' - 忽略Range
+    faults: {起始偏移: 字节数}，从该偏移开始的响应只发送这么多字节后断开(每个只触发一次)
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        header = self.headers.get('Range')
+        server.requests.append(header)
+        if server.status != 200:
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if header and (server.ranges == 'all' or (server.ranges == 'probe' and header == 'bytes=0-0')):
+            start, end = re.match(r'bytes=(\d+)-(\d*)', header).groups()
+            start, end = int(start), int(end) if end else len(DATA) - 1
+            body = DATA[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            start, body = 0, DATA
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        cut = server.faults.pop(start, None)
+        if cut is not None:
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(downloader.time, 'sleep', lambda seconds: None)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.ranges, httpd.faults, httpd.requests, httpd.status = 'all', {}, [], 200
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/video.mp4"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_downloader():
+    return SegmentedDownloader(segments=4, min_segment_bytes=128 * 1024, chunk_size=64 * 1024, retries=2, timeout=5)
+
+
+def test_ranged_download_in_parallel_segments(server, tmp_path):
+    path = tmp_path / 'video.mp4'
+    stats = make_downloader().download(server.url, str(path))
+    assert stats['mode'] == 'ranged'
+    assert stats['segments'] == 4
+    assert stats['retries'] == 0
+    assert stats['bytes'] == len(DATA)
+    assert path.read_bytes() == DATA
+
+
+def test_segment_retry_resumes_from_written_offset(server, tmp_path):
+    segment = len(DATA) // 4
+    server.faults[segment] = 100 * 1024
+    path = tmp_path / 'video.mp4'
+    stats = make_downloader().download(server.url, str(path))
+    assert stats['mode'] == 'ranged'
+    assert stats['retries'] == 1
+    assert path.read_bytes() == DATA
+    # 重试只请求该段剩下的部分
+    assert f"bytes={segment + 100 * 1024}-{2 * segment - 1}" in server.requests
+
+
+def test_server_without_ranges_uses_single_connection(server, tmp_path):
+    server.ranges = 'none'
+    path = tmp_path / 'video.mp4'
+    stats = make_downloader().download(server.url, str(path))
+    assert stats['mode'] == 'single'
+    assert stats['bytes'] == len(DATA)
+    assert path.read_bytes() == DATA
+    # 探测请求的完整响应直接用于下载，不再请求第二次
+    assert len(server.requests) == 1
+
+
+def test_ranges_ignored_after_probe_falls_back(server, tmp_path):
+    server.ranges = 'probe'
+    path = tmp_path / 'video.mp4'
+    stats = make_downloader().download(server.url, str(path))
+    assert stats['mode'] == 'single'
+    assert path.read_bytes() == DATA
+
+
+def test_single_connection_retries_truncated_response(server, tmp_path):
+    server.ranges = 'none'
+    server.faults[0] = 1000
+    path = tmp_path / 'video.mp4'
+    stats = make_downloader().download(server.url, str(path))
+    assert stats['retries'] == 1
+    assert path.read_bytes() == DATA
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    import requests
+
+    server.status = 404
+    with pytest.raises(requests.HTTPError):
+        make_downloader().download(server.url, str(tmp_path / 'video.mp4'))
+    assert len(server.requests) == 1
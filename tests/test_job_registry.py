@@ -0,0 +1,93 @@
+import os
+import json
+
+import pytest
+
+import cancellation
+import web_app
+
+
+def test_register_rejects_running_job_id(tmp_path):
+    registry = cancellation.JobRegistry(str(tmp_path))
+    registry.register('job-a')
+    with pytest.raises(cancellation.JobExists):
+        registry.register('job-a')
+    registry.unregister('job-a')
+    registry.register('job-a')
+
+
+def test_register_takes_over_registration_of_exited_process(tmp_path):
+    registry = cancellation.JobRegistry(str(tmp_path))
+    # 进程号仍在使用(例如容器重启后被复用)，但属主文件的锁已释放
+    with open(os.path.join(registry.folder, 'job-b.job'), 'w') as f:
+        json.dump({'owner': 'gone.owner', 'pid': os.getpid(), 'nonce': 'old', 'created': 0}, f)
+    open(os.path.join(registry.folder, 'job-b.old.cancel'), 'w').close()
+    token, _ = registry.register('job-b')
+    # 遗留的取消标记不影响新任务
+    assert not token.cancelled
+
+
+def test_stale_cancel_marker_does_not_cancel_next_registration(tmp_path):
+    registry = cancellation.JobRegistry(str(tmp_path))
+    other = cancellation.JobRegistry(str(tmp_path))
+    _, secret = registry.register('job-c')
+    # 另一个worker写入标记后，任务在轮询到标记前结束
+    registry._local.pop('job-c')
+    assert other.cancel('job-c', secret)
+    registry.unregister('job-c')
+    token, _ = registry.register('job-c')
+    assert not token.cancelled
+    registry.prune()
+    assert [name for name in os.listdir(registry.folder) if name.endswith('.cancel')] == []
+
+
+def test_cancel_requires_secret(tmp_path):
+    registry = cancellation.JobRegistry(str(tmp_path))
+    token, secret = registry.register('job-d')
+    for wrong in (None, '', 'x' * 32):
+        with pytest.raises(cancellation.CancelDenied):
+            registry.cancel('job-d', wrong)
+    assert not token.cancelled
+    assert registry.cancel('job-d', secret)
+    assert token.cancelled
+    registry.unregister('job-d')
+    assert not registry.cancel('job-d', secret)
+
+
+def test_extract_with_running_job_id_returns_409(client, video_file):
+    _, secret = web_app.job_registry.register('busy-job')
+    try:
+        r = client.post('/api/extract-frames', json={'videoPath': video_file, 'jobId': 'busy-job'})
+        assert r.status_code == 409
+        # 前一个任务的登记仍然有效
+        assert web_app.job_registry.cancel('busy-job', secret)
+    finally:
+        web_app.job_registry.unregister('busy-job')
+
+
+def test_delete_job_requires_cancel_token(client):
+    _, secret = web_app.job_registry.register('owned-job')
+    try:
+        assert client.delete('/api/jobs/owned-job').status_code == 403
+        assert client.delete('/api/jobs/owned-job', headers={'X-Cancel-Token': 'guess' * 8}).status_code == 403
+        assert client.delete('/api/jobs/owned-job', headers={'X-Cancel-Token': secret}).status_code == 202
+    finally:
+        web_app.job_registry.unregister('owned-job')
+
+
+def test_extract_returns_cancel_token(client, video_file):
+    r = client.post('/api/extract-frames', json={'videoPath': video_file, 'jobId': 'token-job'})
+    assert r.status_code == 200
+    assert r.headers['X-Job-Id'] == 'token-job'
+    assert len(r.headers['X-Cancel-Token']) >= 16
+
+
+def test_extract_rejects_short_cancel_token(client, video_file):
+    r = client.post('/api/extract-frames', json={'videoPath': video_file, 'cancelToken': 'short'})
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize('timeout', ['abc', -1, [1]])
+def test_extract_rejects_invalid_timeout(client, video_file, timeout):
+    r = client.post('/api/extract-frames', json={'videoPath': video_file, 'timeout': timeout})
+    assert r.status_code == 400
@@ -0,0 +1,54 @@
+import io
+import os
+import threading
+
+from local_storage import LocalStorage
+
+
+def test_upload_copies_instead_of_linking(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'storage'))
+    source = tmp_path / 'frame.jpg'
+    source.write_bytes(b'first')
+    assert storage.upload_file(str(source), 'frames/job/frame.jpg')
+    # 重新写入临时帧文件不影响已存储的对象
+    with open(source, 'r+b') as f:
+        f.write(b'XXXXX')
+    assert storage.get_file('frames/job/frame.jpg') == b'first'
+    assert os.stat(storage.local_path('frames/job/frame.jpg')).st_nlink == 1
+
+
+def test_concurrent_writes_to_same_object(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'storage'))
+    sources = []
+    for i in range(8):
+        path = tmp_path / f"src{i}"
+        path.write_bytes(bytes([i]) * 100000)
+        sources.append(str(path))
+    results = []
+    threads = [threading.Thread(target=lambda p=p: results.append(storage.upload_file(p, 'a/b.bin')))
+               for p in sources]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(results)
+    data = storage.get_file('a/b.bin')
+    assert len(data) == 100000 and len(set(data)) == 1
+    assert [o['Key'] for o in storage.iter_files('a/')] == ['a/b.bin']
+
+
+def test_list_page_resumes_in_key_order(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'storage'))
+    keys = ['v/a-b', 'v/a/x', 'v/a/y/z', 'v/a0', 'v/b/c', 'v/b/d', 'v/c', 'w/other']
+    for key in keys:
+        storage.upload_fileobj(io.BytesIO(b'x'), key)
+    pages = []
+    token = None
+    while True:
+        objects, token = storage.list_page('v/', token, max_keys=2)
+        pages.append([o['Key'] for o in objects])
+        if token is None:
+            break
+    assert sum(pages, []) == sorted(k for k in keys if k.startswith('v/'))
+    assert all(len(page) <= 2 for page in pages)
+    assert [o['Key'] for o in storage.iter_files('v/')] == sorted(k for k in keys if k.startswith('v/'))
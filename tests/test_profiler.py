@@ -0,0 +1,43 @@
+import os
+import time
+
+import tracing
+import web_app
+
+
+def test_prune_keeps_recent_files(tmp_path):
+    profiler = tracing.Profiler(str(tmp_path), max_files=3, max_age=3600)
+    now = time.time()
+    for i in range(5):
+        path = tmp_path / f"{i:032x}.prof"
+        path.write_bytes(b'x')
+        os.utime(path, (now - i, now - i))
+    stale = tmp_path / f"{9:032x}.prof"
+    stale.write_bytes(b'x')
+    os.utime(stale, (now - 7200, now - 7200))
+
+    assert profiler.prune() == 3
+    assert sorted(os.listdir(tmp_path)) == [f"{i:032x}.prof" for i in range(3)]
+
+
+def test_stop_prunes_old_profiles(tmp_path):
+    profiler = tracing.Profiler(str(tmp_path), max_files=2)
+    ids = [profiler.stop(profiler.start()) for _ in range(4)]
+    assert len(os.listdir(tmp_path)) == 2
+    assert os.path.exists(profiler.path_for(ids[-1]))
+
+
+def test_download_requires_token(client, monkeypatch, tmp_path):
+    profiler = tracing.Profiler(str(tmp_path), token='secret')
+    monkeypatch.setattr(web_app, 'profiler', profiler)
+    profile_id = profiler.stop(profiler.start())
+
+    assert client.get(f'/api/profiles/{profile_id}').status_code == 403
+    assert client.get(f'/api/profiles/{profile_id}', headers={'X-Profile': 'wrong'}).status_code == 403
+    r = client.get(f'/api/profiles/{profile_id}', headers={'X-Profile': 'secret'})
+    assert r.status_code == 200
+    r.close()
+
+    # 未设置令牌时不能下载
+    monkeypatch.setattr(profiler, 'token', '')
+    assert client.get(f'/api/profiles/{profile_id}', headers={'X-Profile': ''}).status_code == 403
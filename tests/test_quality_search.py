@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+
+import extract_frames
+from extract_frames import _QualitySearch, TARGET_MIN_QUALITY, TARGET_MAX_QUALITY, TARGET_TOLERANCE
+
+
+def frame(seed=0):
+    rng = np.random.default_rng(seed)
+    smooth = cv2.resize(rng.integers(0, 255, (12, 16, 3), dtype=np.uint8), (320, 240))
+    return cv2.add(smooth, rng.integers(0, 40, (240, 320, 3), dtype=np.uint8))
+
+
+def size_at(image, quality):
+    return len(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1])
+
+
+def test_selects_highest_quality_under_target():
+    image = frame()
+    target = size_at(image, 60)
+    search = _QualitySearch(target, 90)
+    encoded, quality = search.encode(image)
+    assert len(encoded) <= target
+    # 落在目标下方的容差范围内，或者再提高一级质量就超过目标
+    assert (len(encoded) >= target * (1 - TARGET_TOLERANCE)
+            or quality == TARGET_MAX_QUALITY or size_at(image, quality + 1) > target)
+
+
+def test_similar_frames_reuse_previous_quality():
+    image = frame()
+    search = _QualitySearch(size_at(image, 70), 90)
+    _, quality = search.encode(image)
+    search.encodes = 0
+    encoded, again = search.encode(image)
+    assert again == quality
+    if len(encoded) >= search.target_bytes * (1 - TARGET_TOLERANCE):
+        assert search.encodes == 1
+
+
+def test_unreachable_target_returns_smallest_encoding():
+    image = frame()
+    search = _QualitySearch(10, 90)
+    encoded, quality = search.encode(image)
+    assert quality == TARGET_MIN_QUALITY
+    assert len(encoded) == size_at(image, TARGET_MIN_QUALITY)
+
+
+def test_target_search_only_for_jpeg():
+    assert extract_frames._target_search('.png', 50, 90) is None
+    assert extract_frames._target_search('.jpg', None, 90) is None
+    assert extract_frames._target_search('.jpg', 50, 90).target_bytes == 50 * 1024
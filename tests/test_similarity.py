@@ -0,0 +1,70 @@
+import io
+import os
+
+import numpy as np
+
+import similarity
+
+
+def test_nearest_orders_by_distance_then_position():
+    a = np.array([0b0000, 0b0001, 0b0111, 0b0011], dtype=np.uint64)
+    b = np.array([0b0001, 0b1111], dtype=np.uint64)
+    matches = similarity.nearest([('a', a, 0, None), ('b', b, None, None)], 0, k=3)
+    assert matches == [('a', 1, 1), ('b', 0, 1), ('a', 3, 2)]
+
+
+def test_nearest_applies_max_distance_and_k():
+    hashes = np.array([0, 1, 3, 7, 15], dtype=np.uint64)
+    assert similarity.nearest([('a', hashes, None, None)], 0, k=10, max_distance=1) == [('a', 0, 0), ('a', 1, 1)]
+    assert [m[1] for m in similarity.nearest([('a', hashes, None, None)], 0, k=2)] == [0, 1]
+    assert similarity.nearest([], 0, k=5) == []
+
+
+def test_nearest_never_returns_the_excluded_frame():
+    hashes = np.array([2 ** 64 - 1, 0], dtype=np.uint64)
+    matches = similarity.nearest([('a', hashes, 1, None)], 0, k=5, max_distance=1000)
+    assert matches == [('a', 0, 64)]
+
+
+def test_similar_route_validates_distance_and_versions_urls(client, video_file):
+    r = client.post('/api/extract-frames', json={'videoPath': video_file, 'fps': 5, 'quality': 73,
+                                                 'phash': True, 'jobId': 'similar-1'})
+    assert r.status_code == 200
+    etags = {f['index']: f['etag'] for f in r.get_json()['frames']}
+
+    for bad in (-1, 65):
+        r = client.get(f'/api/jobs/similar-1/similar?frame=0&maxDistance={bad}')
+        assert r.status_code == 400
+
+    r = client.get('/api/jobs/similar-1/similar?frame=0&maxDistance=64&k=50')
+    assert r.status_code == 200
+    matches = r.get_json()['matches']
+    assert matches and all(m['index'] != 0 for m in matches)
+    for m in matches:
+        assert m['url'].endswith(f"?v={etags[m['index']][:16]}")
+
+
+def test_missing_hashes_are_never_matched(tmp_path):
+    path = str(tmp_path / similarity.HASHES_FILE)
+    # 第1帧没有哈希，不能被当作哈希为0的全黑帧
+    assert similarity.save_hashes(path, {0: 0, 2: 0b11}) == 3
+    with open(path, 'rb') as f:
+        hashes, valid = similarity.load_hashes(f.read())
+    assert valid.tolist() == [True, False, True]
+    matches = similarity.nearest([('a', hashes, None, valid)], 0, k=5)
+    assert matches == [('a', 0, 0), ('a', 2, 2)]
+
+
+def test_load_hashes_accepts_plain_uint64_arrays():
+    buffer = io.BytesIO()
+    np.save(buffer, np.array([1, 2], dtype=np.uint64))
+    hashes, valid = similarity.load_hashes(buffer.getvalue())
+    assert hashes.tolist() == [1, 2] and valid.all()
+
+
+def test_register_leaves_no_temporary_files(tmp_path):
+    index = similarity.FrameHashIndex(str(tmp_path), storage=None)
+    index.register('job-1', 'frames/a', 'jpg', {0: 'md5'})
+    index.register('job-1', 'frames/b', 'jpg')
+    assert os.listdir(index.folder) == ['job-1.json']
+    assert index.lookup('job-1')['framesPath'] == 'frames/b'
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+import web_app
+
+
+def test_frame_returns_jpeg(client, video_file):
+    r = client.get(f'/api/frame?video={video_file}&t=1.5')
+    assert r.status_code == 200
+    assert r.mimetype == 'image/jpeg'
+
+
+@pytest.mark.parametrize('t', ['nan', 'inf', '-inf', 'abc'])
+def test_frame_rejects_invalid_t(client, video_file, t):
+    r = client.get(f'/api/frame?video={video_file}&t={t}')
+    assert r.status_code == 400
+
+
+def test_frame_service_treats_non_finite_t_as_out_of_range(video_file):
+    path = os.path.join(web_app.app.config['UPLOAD_FOLDER'], video_file)
+    web_app.frame_service.get_frame(path, 0.0)
+    assert web_app.frame_service.get_frame(path, float('nan')) is None
@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+
+import pytest
+
+import singleflight
+import web_app
+
+
+def test_wait_timeout_raises_instead_of_running_without_lock(tmp_path):
+    group = singleflight.SingleFlight(str(tmp_path), wait_timeout=0.3)
+    first = group.join('key')
+    assert first.leader and first.pending
+    with pytest.raises(singleflight.FlightTimeout):
+        group.join('key')
+    first.publish({'ok': True})
+    assert group.join('key').result == {'ok': True}
+
+
+def test_evicted_download_is_redownloaded_as_leader(monkeypatch):
+    url = 'http://example.com/evicted.mp4'
+    key = singleflight.job_key('download', singleflight.normalize_url(url))
+    # 其他请求下载过，但文件已被磁盘配额清理
+    web_app.single_flight.join(key).publish({'size': 1})
+    downloads = []
+
+    def download_video(video_url, video_path, cancel=None):
+        # 重新下载时持有锁，相同的请求不会同时下载
+        with pytest.raises(singleflight.FlightTimeout):
+            singleflight.SingleFlight(web_app.STATE_FOLDER, wait_timeout=0).join(key)
+        downloads.append(video_path)
+        with open(video_path, 'wb') as f:
+            f.write(b'video')
+        return web_app.spool_manager.pin(video_path)
+
+    monkeypatch.setattr(web_app, 'download_video', download_video)
+    video_path, lease = web_app.fetch_video(url)
+    lease.release()
+    assert downloads == [video_path]
+    assert web_app.single_flight.join(key).result == {'size': os.path.getsize(video_path)}
+    os.remove(video_path)
+
+
+def test_waiters_past_cap_fail_fast(tmp_path):
+    group = singleflight.SingleFlight(str(tmp_path), wait_timeout=5, max_waiters=1, max_waiters_total=1)
+    leader = group.join('key')
+    entered = threading.Event()
+    results = []
+
+    def wait():
+        entered.set()
+        results.append(group.join('key').result)
+
+    follower = threading.Thread(target=wait)
+    follower.start()
+    entered.wait()
+    deadline = time.monotonic() + 2
+    while not group._waiters and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # 同一个键已有一个等待者，立即返回而不是占用线程等待
+    started = time.monotonic()
+    with pytest.raises(singleflight.FlightBusy):
+        group.join('key')
+    assert time.monotonic() - started < 0.5
+    # 其他键可以成为leader，但等待者受所有键合计的上限限制
+    other = group.join('other')
+    assert other.leader
+    with pytest.raises(singleflight.FlightBusy):
+        group.join('other')
+    leader.publish({'ok': True})
+    follower.join()
+    assert results == [{'ok': True}]
+    assert group._waiters == {}
+    other.abandon()
+
+
+def test_busy_flight_returns_503(client, monkeypatch):
+    def join(key):
+        raise singleflight.FlightBusy(key)
+
+    monkeypatch.setattr(web_app.single_flight, 'join', join)
+    r = client.post('/api/extract-frames', json={'videoUrl': 'http://example.com/busy.mp4'})
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] == str(web_app.FLIGHT_RETRY_AFTER)
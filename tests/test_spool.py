@@ -0,0 +1,87 @@
+import os
+import json
+import multiprocessing
+
+import spool
+
+
+def manager(tmp_path, quota=10 ** 9):
+    root = tmp_path / 'frames'
+    root.mkdir(exist_ok=True)
+    return spool.SpoolManager([str(root)], quota, str(tmp_path / 'state')), root
+
+
+def test_usage_counts_reservations_and_released_sizes(tmp_path, monkeypatch):
+    spool_manager, root = manager(tmp_path)
+    (root / 'old.mp4').write_bytes(b'x' * 50)
+    spool_manager.recover_orphans()
+
+    walks = []
+    path_size = spool.path_size
+    monkeypatch.setattr(spool, 'path_size', lambda path: walks.append(path) or path_size(path))
+    lease = spool_manager.reserve(str(root / 'job'), 100)
+    # 预留空间时不遍历磁盘
+    assert walks == []
+    assert spool_manager.usage() == 150
+
+    os.makedirs(root / 'job')
+    (root / 'job' / 'frame_000000.jpg').write_bytes(b'x' * 30)
+    lease.release()
+    assert walks == [str(root / 'job')]
+    assert spool_manager.usage() == 80
+
+    spool_manager.reserve(str(root / 'job'), 0).release(delete=True)
+    assert spool_manager.usage() == 50
+
+
+def test_over_quota_evicts_least_recently_used(tmp_path):
+    spool_manager, root = manager(tmp_path, quota=100)
+    (root / 'a.mp4').write_bytes(b'x' * 60)
+    os.utime(root / 'a.mp4', (1, 1))
+    (root / 'b.mp4').write_bytes(b'x' * 30)
+    with spool_manager.reserve(str(root / 'job'), 50):
+        assert not (root / 'a.mp4').exists()
+        assert (root / 'b.mp4').exists()
+
+
+def _hold_lease(state, root, ready, done):
+    spool_manager = spool.SpoolManager([root], 10 ** 9, state)
+    spool_manager.reserve(os.path.join(root, 'live'), 10)
+    ready.set()
+    done.wait(10)
+
+
+def _crash_with_lease(state, root):
+    spool_manager = spool.SpoolManager([root], 10 ** 9, state)
+    os.makedirs(os.path.join(root, 'crashed'))
+    spool_manager.reserve(os.path.join(root, 'crashed'), 10)
+    os._exit(1)
+
+
+def test_recover_orphans_uses_owner_locks(tmp_path):
+    spool_manager, root = manager(tmp_path)
+    context = multiprocessing.get_context('fork')
+    ready, done = context.Event(), context.Event()
+    holder = context.Process(target=_hold_lease, args=(str(tmp_path / 'state'), str(root), ready, done))
+    holder.start()
+    crashed = context.Process(target=_crash_with_lease, args=(str(tmp_path / 'state'), str(root)))
+    crashed.start()
+    crashed.join()
+    lease_folder = tmp_path / 'state' / 'spool'
+    for name in os.listdir(lease_folder):
+        if name.endswith('.lease'):
+            lease = json.loads((lease_folder / name).read_text())
+            if lease['path'].endswith('crashed'):
+                # 模拟进程号被复用: 崩溃进程的进程号现在属于一个存活的进程
+                (lease_folder / name).write_text(json.dumps(dict(lease, pid=os.getpid())))
+    try:
+        assert ready.wait(10)
+        # 属主文件没有被锁定就视为已退出，与进程号无关
+        assert spool_manager.recover_orphans() == 1
+        assert not (root / 'crashed').exists()
+        assert spool_manager.recover_orphans() == 0
+        assert len([n for n in os.listdir(lease_folder) if n.endswith('.lease')]) == 1
+    finally:
+        done.set()
+        holder.join()
+    assert spool_manager.recover_orphans() == 1
@@ -0,0 +1,86 @@
+import json
+import time
+
+import cancellation
+import sandbox
+import web_app
+
+
+class FakeChannel:
+    """前几次读取超时(没有消息)，之后返回一帧和结束消息"""
+
+    def __init__(self, idle_reads):
+        self.messages = [None] * idle_reads + [
+            {'type': 'item', 'value': [0, 0.0, '/tmp/frame_000000.jpg', {}]},
+            {'type': 'done', 'result': None}
+        ]
+
+    def read(self, timeout):
+        message = self.messages.pop(0)
+        if message is None:
+            time.sleep(timeout)
+        return message
+
+
+class FakeWorker:
+    pid = 0
+
+    def __init__(self, idle_reads):
+        self.channel = FakeChannel(idle_reads)
+
+
+class FakePool:
+    def _release(self, worker, reuse=True):
+        pass
+
+
+def run_job(heartbeat, idle_reads=6):
+    job = sandbox.SandboxJob(FakePool(), FakeWorker(idle_reads), 'write_frames', {}, None, 60)
+    job.POLL_INTERVAL = 0.01
+    job.heartbeat = heartbeat
+    return list(job)
+
+
+def test_sandbox_job_yields_heartbeats_while_idle():
+    items = run_job(heartbeat=0.02)
+    assert items[-1][0] == 0
+    assert 2 <= items.count(None) <= 3
+    # 未设置时不产生心跳
+    assert None not in run_job(heartbeat=None)
+
+
+class Summary:
+    def set(self, **kwargs):
+        pass
+
+    def add(self, name):
+        pass
+
+    def emit(self, logger, status, timings=None):
+        pass
+
+
+def test_stream_sends_progress_without_new_frames(monkeypatch):
+    monkeypatch.setattr(web_app, 'STREAM_PROGRESS_INTERVAL', 0.02)
+
+    def extract_and_upload(job):
+        assert job['heartbeat'] == 0.02
+        for _ in range(3):
+            time.sleep(0.03)
+            yield None, False
+        yield {'index': 0, 'filename': 'frame_000000.jpg'}, True
+
+    monkeypatch.setattr(web_app, 'extract_and_upload', extract_and_upload)
+    job = {
+        'id': 'heartbeat-1', 'frames_url_path': 'frames/x', 'base_url': 'http://test', 'estimated_frames': 1,
+        'cancel': cancellation.CancelToken(), 'cancel_token': 'secret', 'summary': Summary(), 'target_kb': None
+    }
+    with web_app.app.app_context():
+        events = [json.loads(line) for line in
+                  web_app.stream_extraction(job, 'application/x-ndjson', lambda: None)]
+    kinds = [e['type'] for e in events]
+    assert kinds[0] == 'start' and kinds[-1] == 'done'
+    assert kinds[1:4] == ['progress'] * 3
+    assert all(e['extracted'] == 0 for e in events[1:4])
+    assert kinds.count('frame') == 1
+    assert events[-1]['count'] == 1
@@ -0,0 +1,170 @@
+import os
+import hmac
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 当前请求的计时记录，按线程/上下文隔离
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """记录单次请求中各阶段(下载、解码、编码、上传等)的耗时"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, count=1, nbytes=0):
+        """累加某个阶段的耗时(秒)、次数和传输的字节数"""
+        with self._lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                self.stages[name] = [seconds, count, nbytes]
+            else:
+                entry[0] += seconds
+                entry[1] += count
+                entry[2] += nbytes
+
+    @contextmanager
+    def stage(self, name):
+        """计时上下文，退出时把耗时累加到对应阶段"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        """转换为JSON响应中的timings结构，单位毫秒；记录了字节数的阶段同时给出吞吐量(MB/s)"""
+        with self._lock:
+            timings = {}
+            for name, (total, count, nbytes) in self.stages.items():
+                timings[name] = {'ms': round(total * 1000, 2), 'count': count}
+                if nbytes:
+                    timings[name]['bytes'] = nbytes
+                    timings[name]['MBps'] = round(nbytes / total / 1e6, 2) if total > 0 else None
+        timings['total'] = {'ms': round(self.elapsed() * 1000, 2), 'count': 1}
+        return timings
+
+    def server_timing(self):
+        """生成Server-Timing响应头的值"""
+        parts = []
+        for name, item in self.as_dict().items():
+            parts.append(f"{name};dur={item['ms']:.1f}")
+        return ', '.join(parts)
+
+
+def start_trace():
+    """为当前上下文创建新的计时记录，返回(trace, token)"""
+    trace = Trace()
+    token = _current_trace.set(trace)
+    return trace, token
+
+
+def end_trace(token):
+    """恢复进入请求前的上下文，避免线程复用时串到下一个请求"""
+    _current_trace.reset(token)
+
+
+def current_trace():
+    """获取当前上下文的计时记录，未开启时返回None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name):
+    """对当前请求的某个阶段计时，未开启计时时不做任何事"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+
+class Profiler:
+    """
+    按需采集cProfile数据并保存到本地目录，供之后下载
+
+    只保留最近max_files个、不超过max_age秒的采集文件，每次保存后清理更早的文件
+    """
+
+    def __init__(self, folder, token=None, sample_rate=0.0, max_files=100, max_age=86400):
+        self.folder = folder
+        self.token = token
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.max_age = max_age
+
+    def authorized(self, header_value):
+        """请求头携带正确的令牌(未设置令牌时总是拒绝)"""
+        return bool(self.token and header_value and hmac.compare_digest(header_value, self.token))
+
+    def should_profile(self, header_value):
+        """请求头携带正确的令牌，或命中随机采样时开启采集"""
+        if self.authorized(header_value):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        """停止采集并写入文件，返回采集ID"""
+        profile.disable()
+        profile_id = uuid.uuid4().hex
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path_for(profile_id)
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.error(f"保存性能采集数据失败: {str(e)}")
+            return None
+        self.prune()
+        return profile_id
+
+    def prune(self):
+        """删除超过max_age秒或超出max_files个的旧采集文件，返回删除的文件数"""
+        files = []
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.name.endswith('.prof'):
+                        try:
+                            files.append((entry.stat().st_mtime, entry.path))
+                        except OSError:
+                            continue
+        except OSError:
+            return 0
+        files.sort(reverse=True)
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for i, (mtime, path) in enumerate(files):
+            if i < self.max_files and mtime >= cutoff:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def path_for(self, profile_id):
+        # 只接受十六进制ID，防止路径穿越
+        if not profile_id or not all(c in '0123456789abcdef' for c in profile_id):
+            return None
+        return os.path.join(self.folder, f"{profile_id}.prof")
@@ -1,21 +1,33 @@
 import os
+import math
 import time
 import json
-import requests
+import uuid
+import hashlib
+import mimetypes
 import logging
 from functools import wraps
-from flask import Flask, request, jsonify, send_file, redirect
+from flask import Flask, request, jsonify, send_file, redirect, g, Response, stream_with_context
 from werkzeug.utils import secure_filename
-from extract_frames import extract_frames
-from r2_storage import R2Storage
+from storage import create_storage
+from r2_lifecycle import partition_prefix
+import tracing
+import admission
+import spool
+import frame_server
+import singleflight
+import cancellation
+import structured_log
+import checkpoint
+import sandbox
+import similarity
+import downloader
 
 app = Flask(__name__)
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# 配置日志: 请求线程只把记录放入队列，由后台线程格式化为JSON并输出
+from config import LOG_LEVEL, LOG_FORMAT
+structured_log.setup_logging(LOG_LEVEL, LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 # 从config模块导入配置
@@ -43,6 +55,20 @@ except ImportError as e:
     CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*').split(',')
     WORKER_URL = os.environ.get('WORKER_URL', '')
 
+from config import PROFILE_TOKEN, PROFILE_SAMPLE_RATE, PROFILES_FOLDER, PROFILE_MAX_FILES, PROFILE_MAX_AGE_HOURS
+from config import ADMISSION_DB, ADMISSION_CAPACITY, ADMISSION_REFILL_RATE, ADMISSION_MAX_WAIT
+from config import ADMISSION_API_KEYS, TRUSTED_PROXIES
+from config import STATE_FOLDER, SPOOL_QUOTA_BYTES, SPOOL_DEFAULT_VIDEO_BYTES
+from config import FRAME_POOL_SIZE, FRAME_POOL_IDLE_SECONDS, FRAME_CACHE_BYTES
+from config import SINGLEFLIGHT_RESULT_TTL, SINGLEFLIGHT_WAIT_TIMEOUT
+from config import SINGLEFLIGHT_MAX_WAITERS, SINGLEFLIGHT_MAX_WAITERS_TOTAL
+from config import EXTRACT_TIME_BUDGET, EXTRACT_STREAM_TIME_BUDGET, EXTRACT_CHECKPOINT_TTL
+from config import STORAGE_BACKEND, LOCAL_STORAGE_ACCEL_PREFIX, CACHE_CONTROL, UNVERSIONED_CACHE_CONTROL
+from config import EXTRACT_POOL_SIZE, EXTRACT_MEMORY_LIMIT_MB, EXTRACT_CPU_SECONDS, EXTRACT_NICE
+from config import EXTRACT_WALL_SECONDS, EXTRACT_POOL_MAX_JOBS
+from config import LIFECYCLE_EXPIRATION_HOURS
+from config import DOWNLOAD_SEGMENTS, DOWNLOAD_MIN_SEGMENT_BYTES, DOWNLOAD_CHUNK_BYTES, DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT
+
 # 设置Flask应用配置
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -51,28 +77,150 @@ app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 app.config['FRAMES_BASE_URL'] = FRAMES_BASE_URL
 app.config['WORKER_URL'] = WORKER_URL
 
-# 初始化R2存储
-r2_storage = R2Storage()
+# 初始化存储后端(R2客户端在首次使用时创建)
+# 注意: cv2、boto3、requests 都在首次使用时才导入，以加快worker启动
+storage = create_storage(STORAGE_BACKEND)
+
+# 按任务成本限流，令牌桶保存在SQLite中由所有worker共享
+admission_controller = admission.AdmissionController(
+    admission.TokenBucketStore(ADMISSION_DB, ADMISSION_CAPACITY, ADMISSION_REFILL_RATE),
+    max_wait=ADMISSION_MAX_WAIT,
+    api_keys=ADMISSION_API_KEYS,
+    trusted_proxies=TRUSTED_PROXIES
+)
+
+# 流式返回时发送进度事件的间隔(秒)
+STREAM_PROGRESS_INTERVAL = 1.0
+
+# 客户端自己生成的取消令牌的最短长度
+CANCEL_TOKEN_MIN_LENGTH = 16
+
+# 帧地址中内容哈希(md5)的长度
+CONTENT_VERSION_LENGTH = 16
+
+# 相似帧查询一次最多返回的帧数
+SIMILAR_MAX_K = 100
+
+# 按需性能采集
+profiler = tracing.Profiler(PROFILES_FOLDER, token=PROFILE_TOKEN, sample_rate=PROFILE_SAMPLE_RATE,
+                            max_files=PROFILE_MAX_FILES, max_age=PROFILE_MAX_AGE_HOURS * 3600)
 
 # 确保上传和帧目录存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(FRAMES_FOLDER, exist_ok=True)
 
+# 本地磁盘缓冲区: 按配额预留空间，LRU清理已完成的文件，启动时回收崩溃遗留
+spool_manager = spool.SpoolManager([UPLOAD_FOLDER, FRAMES_FOLDER], SPOOL_QUOTA_BYTES, STATE_FOLDER)
+spool_manager.recover_orphans()
+
+# 单帧接口使用的解码器池和编码帧缓存
+frame_service = frame_server.FrameServer(
+    frame_server.DecoderPool(FRAME_POOL_SIZE, FRAME_POOL_IDLE_SECONDS),
+    frame_server.FrameCache(FRAME_CACHE_BYTES)
+)
+
+# 打包输出的帧通过清单定位后用Range读取
+bundle_index = frame_server.BundleIndex(storage)
+
+# 正在执行的提取任务，可通过 DELETE /api/jobs/<id> 取消
+job_registry = cancellation.JobRegistry(STATE_FOLDER)
+job_registry.prune()
+
+# 逐帧上传任务的进度日志，worker被杀死后重试相同任务时从中断的位置继续
+checkpoint_store = checkpoint.CheckpointStore(STATE_FOLDER, ttl=EXTRACT_CHECKPOINT_TTL)
+checkpoint_store.prune()
+
+# 计算了感知哈希的任务，按任务ID查询相似帧；帧被生命周期清理删除后登记随之过期
+frame_hashes = similarity.FrameHashIndex(STATE_FOLDER, storage, ttl=LIFECYCLE_EXPIRATION_HOURS * 3600)
+frame_hashes.prune()
+
+# 解码和编码在有资源限制的子进程中执行，异常的视频只会终止子进程
+extraction_pool = sandbox.ExtractionPool(
+    EXTRACT_POOL_SIZE,
+    memory_mb=EXTRACT_MEMORY_LIMIT_MB,
+    cpu_seconds=EXTRACT_CPU_SECONDS,
+    nice=EXTRACT_NICE,
+    wall_seconds=EXTRACT_WALL_SECONDS,
+    max_jobs=EXTRACT_POOL_MAX_JOBS
+)
+
+@app.before_first_request
+def start_extraction_pool():
+    # 在worker进程(而不是--preload的主进程)中预先启动子进程
+    extraction_pool.start()
+
+# videoUrl的视频按Range分段并行下载，连接在各段和各次下载之间复用
+video_downloader = downloader.SegmentedDownloader(
+    segments=DOWNLOAD_SEGMENTS,
+    min_segment_bytes=DOWNLOAD_MIN_SEGMENT_BYTES,
+    chunk_size=DOWNLOAD_CHUNK_BYTES,
+    retries=DOWNLOAD_RETRIES,
+    timeout=DOWNLOAD_TIMEOUT
+)
+
+# 合并并发的相同下载和提取任务，通过状态目录中的文件锁在worker之间协调；
+# 等待超时或等待的请求已达上限时返回503，客户端在Retry-After秒后重试
+FLIGHT_RETRY_AFTER = 10
+single_flight = singleflight.SingleFlight(
+    STATE_FOLDER, result_ttl=SINGLEFLIGHT_RESULT_TTL, wait_timeout=SINGLEFLIGHT_WAIT_TIMEOUT,
+    max_waiters=SINGLEFLIGHT_MAX_WAITERS, max_waiters_total=SINGLEFLIGHT_MAX_WAITERS_TOTAL
+)
+
 # CORS支持
-@app.after_request
-def add_cors_headers(response):
-    origin = request.headers.get('Origin')
-    
+def cors_headers(origin):
+    """按请求的Origin头生成CORS响应头，asgi_app中的异步接口也使用"""
+    headers = []
     # 如果没有Origin头或CORS_ORIGINS为*，则允许所有
     if CORS_ORIGINS == ['*']:
-        response.headers.add('Access-Control-Allow-Origin', '*')
+        headers.append(('Access-Control-Allow-Origin', '*'))
     elif origin and origin in CORS_ORIGINS:
-        response.headers.add('Access-Control-Allow-Origin', origin)
+        headers.append(('Access-Control-Allow-Origin', origin))
     
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    headers.append(('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Profile,X-Cancel-Token'))
+    headers.append(('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'))
+    headers.append(('Access-Control-Expose-Headers', 'Server-Timing,X-Profile-Id,X-Job-Id,X-Cancel-Token'))
+    return headers
+
+@app.after_request
+def add_cors_headers(response):
+    for name, value in cors_headers(request.headers.get('Origin')):
+        response.headers.add(name, value)
+    return response
+
+# 请求计时和按需性能采集
+@app.before_request
+def start_request_trace():
+    g.trace, g.trace_token = tracing.start_trace()
+    g.profile = None
+    if profiler.should_profile(request.headers.get('X-Profile')):
+        g.profile = profiler.start()
+
+@app.after_request
+def add_timing_headers(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile_id = profiler.stop(profile)
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    # 提取任务的汇总日志(流式任务在流结束时输出)
+    summary = g.pop('job_summary', None)
+    if summary is not None:
+        summary.emit(logger, response.status_code, trace.as_dict() if trace is not None else None)
+    job_id = g.get('job_id')
+    if job_id:
+        response.headers['X-Job-Id'] = job_id
+        response.headers['X-Cancel-Token'] = g.cancel_token
     return response
 
+@app.teardown_request
+def end_request_trace(exc):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        tracing.end_trace(token)
+
 # 检查文件扩展名是否允许
 def allowed_file(filename):
     return '.' in filename and \
@@ -87,14 +235,17 @@ def index():
         'endpoints': [
             '/api/extract-frames',
             '/api/upload-video',
-            '/frames/<folder_name>',
-            '/download/<folder_name>/<filename>',
-            '/api/get-frame-image'
+            '/frames/<path:folder_name>',
+            '/download/<path:folder_name>/<filename>',
+            '/api/get-frame-image',
+            '/api/frame',
+            '/api/jobs/<job_id>'
         ]
     })
 
 # 上传视频
 @app.route('/api/upload-video', methods=['POST'])
+@admission_controller.limit()
 def upload_video():
     """处理视频上传请求"""
     try:
@@ -113,7 +264,8 @@ def upload_video():
             filename = f"{timestamp}_{filename}"
             
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            with spool_manager.reserve(filepath, request.content_length or 0):
+                file.save(filepath)
             
             return jsonify({
                 'success': True,
@@ -123,21 +275,479 @@ def upload_video():
             })
         else:
             return jsonify({'error': '不支持的文件类型'}), 400
+    except spool.SpoolFullError as e:
+        logger.error(f"上传视频时磁盘空间不足: {str(e)}")
+        return jsonify({'error': '服务器存储空间不足，请稍后再试'}), 503
     except Exception as e:
         logger.error(f"上传视频时出错: {str(e)}", exc_info=True)
         return jsonify({'error': f'上传视频失败: {str(e)}'}), 500
 
+def frames_base_url():
+    """
+    帧的公开访问地址: FRAMES_BASE_URL > WORKER_URL > 当前请求的地址
+
+    本地存储后端没有Worker，默认由本服务的 /storage/ 路由返回文件
+    """
+    base_url = app.config.get('FRAMES_BASE_URL', '')
+    if not base_url and storage.is_local:
+        base_url = f"{request.url_root.rstrip('/')}/storage"
+    if not base_url:
+        # 如果没有设置基础URL，使用Worker URL
+        base_url = app.config.get('WORKER_URL', '')
+        if not base_url:
+            # 如果没有设置Worker URL，则使用当前请求的URL
+            base_url = request.url_root.rstrip('/')
+    return base_url
+
+def versioned_url(url, md5):
+    """在帧地址后加上内容哈希(?v=)，内容不同的帧地址一定不同，可以永久缓存"""
+    if not md5:
+        return url
+    return f"{url}{'&' if '?' in url else '?'}v={md5[:CONTENT_VERSION_LENGTH]}"
+
+def immutable_response(response, etag, immutable=True):
+    """
+    设置内容寻址响应的ETag和1年immutable缓存
+
+    immutable为False(地址不带?v=内容哈希)时只短期缓存，对象被生命周期清理删除后缓存随之失效。
+    If-None-Match匹配时转为304，不返回内容
+    """
+    if etag:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL if immutable else UNVERSIONED_CACHE_CONTROL
+    return response.make_conditional(request)
+
+def not_modified(version):
+    """
+    地址带有内容哈希且浏览器缓存的ETag与之相同时返回304响应，否则返回None
+
+    同一个版本号的内容不会变化，不需要读取存储就能确认缓存有效
+    """
+    if version and request.if_none_match.contains(version):
+        return immutable_response(Response(status=304), version)
+    return None
+
+def serve_object(object_name, as_attachment=False, download_name=None, etag=None):
+    """
+    直接返回本地存储中的对象，不存在或不是本地存储时返回None
+
+    配置了LOCAL_STORAGE_ACCEL_PREFIX时只返回X-Accel-Redirect头，由nginx零拷贝发送文件；
+    否则用send_file返回文件对象(支持Range和条件请求)，asgi_app通过wsgi.file_wrapper拿到文件，
+    在事件循环中发送(服务器支持http.response.pathsend时由服务器发送)，不占用Flask线程。
+    etag为地址中的内容哈希，带有时永久缓存；
+    为空时按文件的修改时间和大小生成，只短期缓存。
+    """
+    path = storage.local_path(object_name)
+    if not path:
+        return None
+    if LOCAL_STORAGE_ACCEL_PREFIX:
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{LOCAL_STORAGE_ACCEL_PREFIX.rstrip('/')}/{object_name}"
+        if as_attachment:
+            response.headers['Content-Disposition'] = f'attachment; filename="{download_name or os.path.basename(path)}"'
+        if etag:
+            response.set_etag(etag)
+    else:
+        response = send_file(path, as_attachment=as_attachment, download_name=download_name, conditional=True,
+                             etag=etag or True)
+    response.headers['Cache-Control'] = CACHE_CONTROL if etag else UNVERSIONED_CACHE_CONTROL
+    return response
+
+def requested_stream_type():
+    """客户端通过Accept头要求流式返回时，返回对应的内容类型，否则返回None"""
+    best = request.accept_mimetypes.best_match(
+        ['application/json', 'text/event-stream', 'application/x-ndjson'],
+        default='application/json'
+    )
+    return None if best == 'application/json' else best
+
+def download_video(video_url, video_path, cancel=None):
+    """
+    下载视频到video_path
+    
+    先写入临时文件再改名，正在读取同名旧文件的请求不受影响。
+    服务器支持Range时分段并行下载，timings的download阶段给出字节数和吞吐量。
+    返回: 视频文件的租约
+    """
+    logger.info(f"从URL下载视频: {video_url}")
+    t0 = time.perf_counter()
+    size, ranges, content_type, response = video_downloader.probe(video_url)
+    try:
+        # 检查是否是视频类型
+        logger.info(f"视频内容类型: {content_type}")
+        
+        if content_type and not ('video' in content_type or 'octet-stream' in content_type):
+            logger.warning(f"非预期的内容类型: {content_type}，尝试继续处理")
+        
+        # 按文件大小为临时文件预留磁盘空间
+        # 每次下载使用自己的临时文件(同一进程中的多个线程可能同时下载)
+        tmp_path = f"{video_path}.{uuid.uuid4().hex}.part"
+        with spool_manager.reserve(tmp_path, size or SPOOL_DEFAULT_VIDEO_BYTES):
+            try:
+                stats = video_downloader.download(video_url, tmp_path, cancel, size, ranges, response)
+            except BaseException:
+                # 分段下载预先分配了完整大小，失败时不留下未写完的文件
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            lease = spool_manager.pin(video_path)
+            os.replace(tmp_path, video_path)
+    finally:
+        if response is not None:
+            response.close()
+    
+    seconds = time.perf_counter() - t0
+    trace = tracing.current_trace()
+    if trace is not None:
+        trace.add('download', seconds, nbytes=stats['bytes'])
+    logger.info(
+        f"视频下载成功: {video_path}, {stats['bytes'] / 1e6:.1f}MB, {seconds:.2f}秒, "
+        f"{stats['bytes'] / max(seconds, 1e-6) / 1e6:.1f}MB/s, 方式={stats['mode']}, "
+        f"分段={stats['segments']}, 重试={stats['retries']}"
+    )
+    return lease
+
+def fetch_video(video_url, cancel=None):
+    """
+    下载URL对应的视频，并发请求同一个URL时只下载一次
+    
+    返回: (视频路径, 视频文件的租约)
+    """
+    url_key = singleflight.job_key('download', singleflight.normalize_url(video_url))
+    # 文件名由URL决定，同一秒内的不同请求不会再相互覆盖
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], f"url_video_{url_key[:16]}.mp4")
+    
+    while True:
+        flight = single_flight.join(url_key)
+        if flight.leader:
+            break
+        lease = spool_manager.pin(video_path)
+        if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+            logger.info(f"使用其他请求已下载的视频: {video_path}")
+            return video_path, lease
+        # 已下载的文件被磁盘配额清理: 删除结果后重新加入，成为leader(持锁)后再下载
+        lease.release()
+        single_flight.forget(url_key)
+    
+    try:
+        lease = download_video(video_url, video_path, cancel)
+    except BaseException:
+        flight.abandon()
+        raise
+    flight.publish({'size': os.path.getsize(video_path)})
+    return video_path, lease
+
+def quality_summary(frames, target_kb):
+    """按目标大小编码的任务中选定的质量和实际大小的统计，放在任务结果中"""
+    chosen = [f for f in frames if 'quality' in f]
+    if not chosen:
+        return None
+    qualities = [f['quality'] for f in chosen]
+    sizes = [f['size'] for f in chosen]
+    target_bytes = target_kb * 1024
+    return {
+        'targetKB': target_kb,
+        'minQuality': min(qualities),
+        'maxQuality': max(qualities),
+        'meanQuality': round(sum(qualities) / len(qualities), 1),
+        'meanKB': round(sum(sizes) / len(sizes) / 1024, 2),
+        'maxKB': round(max(sizes) / 1024, 2),
+        'totalKB': round(sum(sizes) / 1024, 2),
+        'overTarget': sum(1 for size in sizes if size > target_bytes)
+    }
+
+def publish_hashes(job_id, local_path, frames_url_path, ext, base_url, versions=None):
+    """
+    上传任务的帧哈希数组并登记任务ID，之后可以通过 /api/jobs/<id>/similar 查询
+    
+    ext: 帧文件的扩展名(jpg/png)，查询结果按它拼出帧的文件名
+    versions: {帧序号: md5}，查询结果的帧地址带上内容哈希
+    
+    返回: 哈希数组的地址，上传失败时返回None
+    """
+    object_name = f"{frames_url_path}/{similarity.HASHES_FILE}"
+    if not storage.upload_file(local_path, object_name, 'application/octet-stream'):
+        logger.warning(f"上传帧哈希失败: {object_name}")
+        return None
+    frame_hashes.register(job_id, frames_url_path, ext, versions)
+    return f"{base_url}/{object_name}"
+
+def extract_and_upload(job):
+    """
+    逐帧提取并立即上传到R2存储
+    
+    每上传完一帧记录到任务的进度日志中。重试被中断的任务时，上次连续上传完成的帧
+    直接返回不再解码；之后重新编码的帧与已上传对象的md5(ETag)一致时跳过上传。
+    任务要求计算感知哈希时，全部帧完成后上传哈希数组，地址保存在job['hashes']中。
+    按目标大小编码时每帧带有选定的质量和大小，恢复的任务从最后一个已上传帧的质量继续搜索。
+    job['heartbeat']为秒数时，子进程超过该时间没有写完新帧则产生 (None, False)，供流式响应发送心跳。
+    
+    返回: 生成器 - (帧信息, 是否上传成功)，每上传完一帧产生一个结果
+    """
+    content_type = f"image/{job['format']}"
+    progress = job['checkpoint']
+    
+    def frame_info(object_name, index, timestamp, md5, size, quality=None):
+        # 构建完整URL，使用Worker URL直接访问；地址带内容哈希，浏览器和CDN可以永久缓存
+        info = {
+            'url': versioned_url(f"{job['base_url']}/{object_name}", md5),
+            'filename': os.path.basename(object_name),
+            'index': index,
+            'timestamp': timestamp,
+            'format': job['format'],
+            'etag': md5
+        }
+        if quality is not None:
+            info['quality'] = quality
+            info['size'] = size
+        return info
+    
+    first_index = progress.resume_index()
+    if first_index:
+        logger.info(f"恢复中断的任务，跳过已上传的 {first_index} 帧: {job['frames_url_path']}")
+    hashes = {}
+    versions = {}
+    quality = job['quality']
+    for entry in progress.completed_before(first_index):
+        job['summary'].add('resumed')
+        if entry.get('phash') is not None:
+            hashes[entry['index']] = entry['phash']
+            versions[entry['index']] = entry['md5']
+        quality = entry.get('quality', quality)
+        yield frame_info(f"{job['frames_url_path']}/{entry['name']}", entry['index'], entry['timestamp'],
+                         entry['md5'], entry['size'], entry.get('quality')), True
+    
+    uploaded_count = first_index
+    # 子进程解码和编码，每写完一帧通过管道返回文件路径
+    extraction = extraction_pool.submit(
+        'write_frames',
+        cancel=job['cancel'],
+        video_path=job['video_path'],
+        output_dir=job['output_dir'],
+        fps=job['fps'],
+        start_time=job['start_time'],
+        end_time=job['end_time'],
+        format=job['format'],
+        quality=quality,
+        first_index=first_index,
+        phash=job['phash'],
+        target_kb=job['target_kb']
+    )
+    extraction.heartbeat = job.get('heartbeat')
+    written = iter(extraction)
+    try:
+        for item in written:
+            if item is None:
+                yield None, False
+                continue
+            index, timestamp, local_file_path, extra = item
+            frame_file = os.path.basename(local_file_path)
+            object_name = f"{job['frames_url_path']}/{frame_file}"
+            
+            # 上传文件到R2存储，任务已取消时不再上传
+            cancellation.check(job['cancel'])
+            md5 = checkpoint.file_md5(local_file_path)
+            size = os.path.getsize(local_file_path)
+            if progress.uploaded(frame_file, md5, size):
+                uploaded = True
+                job['summary'].add('skipped')
+            else:
+                uploaded = storage.upload_file(local_file_path, object_name, content_type)
+                if uploaded:
+                    progress.record(frame_file, index, timestamp, md5, size, **extra)
+                    job['summary'].add('uploaded')
+                    logger.debug("成功上传到R2: %s", object_name)
+                else:
+                    job['summary'].add('upload_failed')
+                    logger.warning("上传帧到R2失败: %s", object_name)
+            if uploaded:
+                uploaded_count += 1
+            
+            # 每上传100个文件记录一次进度，任务结束时另有汇总记录
+            if (index + 1) % 100 == 0:
+                logger.debug("已上传 %d/%d 个文件", uploaded_count, index + 1)
+            
+            if 'phash' in extra:
+                hashes[index] = extra['phash']
+                versions[index] = md5
+            
+            yield frame_info(object_name, index, timestamp, md5, size, extra.get('quality')), uploaded
+        
+        if job['phash']:
+            hashes_path = os.path.join(job['output_dir'], similarity.HASHES_FILE)
+            similarity.save_hashes(hashes_path, hashes)
+            ext = 'jpg' if job['format'].lower() == 'jpg' else 'png'
+            job['hashes'] = publish_hashes(job['id'], hashes_path, job['frames_url_path'], ext, job['base_url'],
+                                           versions)
+    except cancellation.Cancelled as e:
+        # 显式取消的任务删除已上传的部分，进度日志一并删除；
+        # 超时和客户端断开时保留，重试的请求从中断处继续
+        if not keeps_partial(e.reason):
+            progress.discard()
+        raise
+    finally:
+        # 提前结束时终止子进程
+        written.close()
+        job['summary'].set(sandbox=extraction.usage)
+        progress.close()
+
+def keeps_partial(reason):
+    """
+    被取消的任务是否保留进度日志和已上传的帧
+    
+    只有 DELETE /api/jobs/<id> 显式取消的任务删除部分结果；超时(时间预算略小于worker超时)
+    和客户端断开的任务通常会被重试，保留后重试从中断处继续，不必从第0帧开始
+    """
+    return reason != cancellation.CancelToken.REQUESTED
+
+def discard_uploaded(frames_url_path):
+    """删除已取消任务上传到R2的部分结果"""
+    keys = [obj['Key'] for obj in storage.list_files(f"{frames_url_path}/")]
+    if keys:
+        deleted = storage.delete_files(keys)
+        logger.info(f"已删除取消任务上传的 {deleted} 个文件: {frames_url_path}")
+
+# 取消原因对应的错误信息和状态码
+CANCEL_RESPONSES = {
+    cancellation.CancelToken.DEADLINE: ('处理超时，任务已取消', 408),
+    cancellation.CancelToken.REQUESTED: ('任务已被取消', 409),
+    cancellation.CancelToken.DISCONNECTED: ('客户端已断开，任务已取消', 499)
+}
+
+def stream_event(stream_type, kind, payload):
+    """按流的类型格式化一个事件"""
+    if stream_type == 'text/event-stream':
+        data = json.dumps(payload, ensure_ascii=False)
+        return f"event: {kind}\ndata: {data}\n\n"
+    return json.dumps(dict(payload, type=kind), ensure_ascii=False) + "\n"
+
+def stream_extraction(job, stream_type, cleanup, flight=None):
+    """
+    流式返回提取结果 (text/event-stream 或 application/x-ndjson)
+    
+    事件: start - 开始处理; frame - 一帧上传完成; progress - 定期进度; done/error - 结束
+    没有新帧时(例如解码跳过很长的片段)也按间隔发送progress，避免代理断开空闲的连接。
+    全部帧上传成功时把结果发布给合并到同一任务的其他请求。
+    """
+    def event(kind, payload):
+        return stream_event(stream_type, kind, payload)
+    
+    started = time.monotonic()
+    last_progress = started
+    frames = []
+    uploaded_count = 0
+    # 汇总日志的状态，与非流式请求的状态码对应
+    status = 500
+    job['heartbeat'] = STREAM_PROGRESS_INTERVAL
+    try:
+        yield event('start', {
+            'jobId': job['id'],
+            'cancelToken': job['cancel_token'],
+            'framesPath': job['frames_url_path'],
+            'baseUrl': job['base_url'],
+            'estimatedFrames': job['estimated_frames']
+        })
+        for frame, uploaded in extract_and_upload(job):
+            if frame is not None:
+                frames.append(frame)
+                if uploaded:
+                    uploaded_count += 1
+                yield event('frame', frame)
+            
+            now = time.monotonic()
+            if now - last_progress >= STREAM_PROGRESS_INTERVAL:
+                last_progress = now
+                yield event('progress', {
+                    'extracted': len(frames),
+                    'uploaded': uploaded_count,
+                    'estimatedFrames': job['estimated_frames'],
+                    'elapsedMs': round((now - started) * 1000)
+                })
+        
+        count = len(frames)
+        status = 200
+        job['summary'].set(frames=count)
+        logger.info(f"流式返回完成，成功上传 {uploaded_count}/{count} 个文件到R2存储")
+        # 哈希数组地址和按目标大小编码的统计
+        extras = {'hashes': job['hashes']} if job.get('hashes') else {}
+        quality_stats = quality_summary(frames, job['target_kb']) if job['target_kb'] else None
+        if quality_stats:
+            extras['quality'] = quality_stats
+        if flight is not None and uploaded_count == count:
+            flight.publish(dict({
+                'frames': frames,
+                'message': f'成功提取 {count} 帧',
+                'count': count,
+                'baseUrl': job['base_url'],
+                'framesPath': job['frames_url_path']
+            }, **extras))
+        trace = tracing.current_trace()
+        yield event('done', dict({
+            'message': f'成功提取 {count} 帧',
+            'count': count,
+            'uploaded': uploaded_count,
+            'baseUrl': job['base_url'],
+            'framesPath': job['frames_url_path'],
+            'timings': trace.as_dict() if trace else {}
+        }, **extras))
+    except GeneratorExit:
+        # 客户端断开连接，服务器关闭了响应生成器
+        job['cancel'].cancel(cancellation.CancelToken.DISCONNECTED)
+        status = CANCEL_RESPONSES[cancellation.CancelToken.DISCONNECTED][1]
+        logger.info(f"客户端已断开，取消任务: {job['id']}")
+        raise
+    except cancellation.Cancelled as e:
+        status = CANCEL_RESPONSES[e.reason][1]
+        logger.info(f"任务已取消({e.reason}): {job['id']}")
+        if not keeps_partial(e.reason):
+            discard_uploaded(job['frames_url_path'])
+        yield event('error', {'error': CANCEL_RESPONSES[e.reason][0], 'cancelled': e.reason})
+    except Exception as e:
+        logger.error(f"提取帧时出错: {str(e)}", exc_info=True)
+        yield event('error', {'error': f'提取帧时出错: {str(e)}'})
+    finally:
+        trace = tracing.current_trace()
+        job['summary'].emit(logger, status, trace.as_dict() if trace else None)
+        cleanup()
+
+def shared_extraction_response(result, stream_type):
+    """返回其他请求已完成的相同提取任务的结果，流式请求按事件重放"""
+    trace = tracing.current_trace()
+    timings = trace.as_dict() if trace else {}
+    if not stream_type:
+        return jsonify(dict(result, shared=True, timings=timings))
+    
+    def replay():
+        yield stream_event(stream_type, 'start', {
+            'framesPath': result['framesPath'],
+            'baseUrl': result['baseUrl'],
+            'estimatedFrames': result['count']
+        })
+        for frame in result['frames']:
+            yield stream_event(stream_type, 'frame', frame)
+        yield stream_event(stream_type, 'done', dict(
+            {k: v for k, v in result.items() if k != 'frames'},
+            uploaded=result['count'], shared=True, timings=timings
+        ))
+    return Response(replay(), mimetype=stream_type, headers={'Cache-Control': 'no-cache'})
+
 # 提取帧
 @app.route('/api/extract-frames', methods=['POST'])
+@admission_controller.limit()
 def extract_frames_api():
     """处理视频帧提取请求"""
+    # 本次请求使用中的本地文件，结束时释放租约(流式返回时由流负责释放)
+    leases = []
+    streaming = False
+    flight = None
+    job_id = None
     try:
         logger.info(f"接收到提取帧请求，内容类型: {request.content_type}")
         
         # 处理JSON请求
         if request.is_json:
             data = request.get_json()
-            logger.info(f"提取帧JSON请求数据: {data}")
+            logger.debug("提取帧JSON请求数据: %s", data)
             
             # 获取参数
             video_path = data.get('videoPath')
@@ -147,157 +757,382 @@ def extract_frames_api():
             format_type = data.get('format', 'jpg')
             start_time = data.get('startTime')
             end_time = data.get('endTime')
+            # 仅npy格式: 灰度输出和缩放宽度
+            gray = bool(data.get('gray', False))
+            width = data.get('width')
+            # jpg/png格式: 所有帧打包为一个对象，单帧按偏移读取
+            bundle = bool(data.get('bundle', False)) and format_type != 'npy'
+            # jpg/png格式: 计算每帧的感知哈希，用于查询相似帧
+            phash = bool(data.get('phash', False)) and format_type != 'npy'
+            # jpg格式: 每帧的目标大小(KB)，按帧选择质量，quality只作为初始质量
+            target_kb = data.get('targetKB')
+            if target_kb is not None and format_type != 'npy':
+                try:
+                    target_kb = float(target_kb)
+                except (TypeError, ValueError):
+                    target_kb = 0
+                if target_kb <= 0:
+                    return jsonify({'error': 'targetKB必须是大于0的数字'}), 400
+            else:
+                target_kb = None
             
-            logger.info(f"解析的参数: video_path={video_path}, video_url={video_url}, fps={fps}, quality={quality}, format={format_type}, start_time={start_time}, end_time={end_time}")
+            logger.debug(
+                "解析的参数: video_path=%s, video_url=%s, fps=%s, quality=%s, format=%s, start_time=%s, end_time=%s",
+                video_path, video_url, fps, quality, format_type, start_time, end_time
+            )
             
             if not video_path and not video_url:
                 logger.error("未提供视频路径或URL")
                 return jsonify({'error': '未提供视频路径或URL'}), 400
+            
+            # 登记任务: 超过时间预算、客户端断开或收到DELETE请求时取消
+            requested_id = str(data.get('jobId') or uuid.uuid4().hex)
+            if not cancellation.JOB_ID_RE.match(requested_id):
+                return jsonify({'error': 'jobId只能包含字母、数字、下划线和连字符'}), 400
+            stream_requested = requested_stream_type() is not None
+            time_budget = EXTRACT_STREAM_TIME_BUDGET if stream_requested else EXTRACT_TIME_BUDGET
+            if data.get('timeout'):
+                try:
+                    timeout = float(data['timeout'])
+                except (TypeError, ValueError):
+                    timeout = 0
+                if not timeout > 0:
+                    return jsonify({'error': 'timeout必须是大于0的秒数'}), 400
+                time_budget = min(time_budget, timeout)
+            # 取消任务需要的令牌: 默认由服务器生成，通过流的start事件和X-Cancel-Token头返回；
+            # 非流式请求要在返回前取消时，可以自己生成一个随机的cancelToken一起提交
+            cancel_token = data.get('cancelToken')
+            if cancel_token is not None and not (isinstance(cancel_token, str)
+                                                 and CANCEL_TOKEN_MIN_LENGTH <= len(cancel_token) <= 256):
+                return jsonify({'error': f'cancelToken必须是{CANCEL_TOKEN_MIN_LENGTH}到256个字符的随机字符串'}), 400
+            try:
+                cancel, cancel_token = job_registry.register(requested_id, time_budget, cancel_token)
+            except cancellation.JobExists:
+                return jsonify({'error': '任务ID已被正在执行的任务使用', 'jobId': requested_id}), 409
+            # 登记成功后才设置，结束时只注销自己的登记
+            job_id = requested_id
+            g.job_id = job_id
+            g.cancel_token = cancel_token
+            summary = structured_log.JobSummary(job_id, format=format_type, bundle=bundle, stream=stream_requested)
+            g.job_summary = summary
+                
+            # 相同视频(规范化的URL或上传文件的内容哈希)和相同参数的并发请求只提取一次
+            if video_url and not video_path:
+                # 验证URL是否有效
+                if not video_url.startswith(('http://', 'https://')):
+                    logger.error(f"无效的视频URL格式: {video_url}")
+                    return jsonify({'error': '请提供有效的视频URL (http或https)'}), 400
+                source = singleflight.normalize_url(video_url)
+            else:
+                # 确保使用相对路径或完整路径
+                if not os.path.isabs(video_path):
+                    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_path)
+                
+                # 检查视频文件是否存在
+                if not os.path.exists(video_path):
+                    logger.error(f"视频文件不存在: {video_path}")
+                    return jsonify({'error': f'视频文件不存在: {video_path}'}), 404
                 
+                # 提取期间保护视频文件不被清理
+                leases.append(spool_manager.pin(video_path))
+                with tracing.stage('hash'):
+                    source = 'sha256:' + singleflight.file_digest(video_path)
+            
+            job_params = {
+                'fps': float(fps),
+                'quality': int(quality),
+                'format': format_type,
+                'startTime': start_time,
+                'endTime': end_time,
+                'gray': gray,
+                'width': width,
+                'bundle': bundle,
+                'phash': phash,
+                'targetKB': target_kb
+            }
+            job_key = singleflight.job_key('extract', source, job_params)
+            summary.set(job_key=job_key[:16])
+            stream_type = requested_stream_type() if format_type != 'npy' and not bundle else None
+            with tracing.stage('wait'):
+                flight = single_flight.join(job_key)
+            if not flight.leader:
+                logger.info(f"返回相同任务的结果: {job_key[:16]}")
+                summary.set(shared=True, frames=flight.result.get('count'))
+                if flight.result.get('hashes'):
+                    frame_hashes.register(job_id, flight.result['framesPath'],
+                                          'jpg' if format_type.lower() == 'jpg' else 'png',
+                                          {frame['index']: frame['etag'] for frame in flight.result['frames']})
+                return shared_extraction_response(dict(flight.result, jobId=job_id), stream_type)
+            
             # 如果提供了URL但没有路径，先下载视频
+            prepaid = 0
             if video_url and not video_path:
+                import requests
+                # 下载前按视频大小预先扣除成本的下限，额度不足的客户端不会先占用下载带宽和磁盘
+                with tracing.stage('head'):
+                    prepaid = admission.estimate_download_cost(video_downloader.content_length(video_url))
+                allowed, retry_after = admission_controller.admit(admission_controller.client_key(request), prepaid)
+                if not allowed:
+                    logger.warning(f"下载前的预估成本超出额度: 成本={prepaid:.1f}, Retry-After={retry_after}")
+                    return admission.too_many_requests(retry_after, '处理额度不足，请稍后再试')
                 try:
-                    # 验证URL是否有效
-                    if not video_url.startswith(('http://', 'https://')):
-                        logger.error(f"无效的视频URL格式: {video_url}")
-                        return jsonify({'error': '请提供有效的视频URL (http或https)'}), 400
-                    
-                    # 生成唯一文件名
-                    video_filename = f"url_video_{int(time.time())}.mp4"
-                    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_filename)
-                    
-                    # 确保上传目录存在
-                    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                        os.makedirs(app.config['UPLOAD_FOLDER'])
-                    
-                    # 下载视频
-                    logger.info(f"从URL下载视频: {video_url}")
-                    response = requests.get(video_url, stream=True, timeout=60)
-                    response.raise_for_status()
-                    
-                    # 检查是否是视频类型
-                    content_type = response.headers.get('Content-Type', '')
-                    logger.info(f"视频内容类型: {content_type}")
-                    
-                    if content_type and not ('video' in content_type or 'octet-stream' in content_type):
-                        logger.warning(f"非预期的内容类型: {content_type}，尝试继续处理")
-                    
-                    with open(video_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192): 
-                            f.write(chunk)
-                            
-                    logger.info(f"视频下载成功: {video_path}")
+                    video_path, video_lease = fetch_video(video_url, cancel)
+                    leases.append(video_lease)
                     
                     # 验证下载的文件是否是有效的视频文件
-                    if not os.path.exists(video_path) or os.path.getsize(video_path) == 0:
+                    if os.path.getsize(video_path) == 0:
                         logger.error(f"下载的文件无效或为空: {video_path}")
                         return jsonify({'error': '无法下载有效的视频文件'}), 400
-                except requests.exceptions.RequestException as e:
+                except (requests.exceptions.RequestException, downloader.DownloadError) as e:
                     logger.error(f"请求视频URL时出错: {str(e)}", exc_info=True)
                     return jsonify({'error': f'无法从URL获取视频: {str(e)}'}), 500
+                except spool.SpoolFullError as e:
+                    logger.error(f"下载视频时磁盘空间不足: {str(e)}")
+                    return jsonify({'error': '服务器存储空间不足，请稍后再试'}), 503
+                except cancellation.Cancelled:
+                    raise
                 except Exception as e:
                     logger.error(f"下载视频时出错: {str(e)}", exc_info=True)
                     return jsonify({'error': f'下载视频失败: {str(e)}'}), 500
-            else:
-                # 确保使用相对路径或完整路径
-                if not os.path.isabs(video_path):
-                    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_path)
             
-            # 检查视频文件是否存在
-            if not os.path.exists(video_path):
-                logger.error(f"视频文件不存在: {video_path}")
-                return jsonify({'error': f'视频文件不存在: {video_path}'}), 404
+            # 按解码帧数、分辨率和上传帧数估算任务成本，扣除下载前已预扣部分后申请额度
+            with tracing.stage('probe'):
+                meta = admission.probe_video(video_path)
+            if meta:
+                cost = admission.estimate_cost(meta, fps=float(fps), start_time=start_time, end_time=end_time)
+                allowed, retry_after = True, 0
+                if cost > prepaid:
+                    allowed, retry_after = admission_controller.admit(
+                        admission_controller.client_key(request), cost - prepaid
+                    )
+                if not allowed:
+                    logger.warning(f"任务成本超出额度: 成本={cost:.1f}, Retry-After={retry_after}")
+                    return admission.too_many_requests(retry_after, '处理额度不足，请稍后再试')
             
             logger.info(f"开始提取帧，视频路径: {video_path}")
             
+            # 按估算的输出大小为帧目录预留空间，上传完成后立即删除本地帧
+            # 目录名包含任务键，同一视频不同参数的任务互不覆盖
+            base_name = os.path.basename(video_path)
+            output_dir_name = f"{os.path.splitext(base_name)[0]}_{job_key[:12]}"
+            output_dir = os.path.join(app.config['FRAMES_FOLDER'], output_dir_name)
+            estimated_bytes = 0
+            frame_total = None
+            if meta:
+                _, frame_total = admission.estimate_frames(meta, fps=float(fps), start_time=start_time, end_time=end_time)
+                estimated_bytes = spool.estimate_frames_bytes(meta, frame_total, format_type)
+            try:
+                frames_lease = spool_manager.reserve(output_dir, estimated_bytes)
+            except spool.SpoolFullError as e:
+                logger.error(f"提取帧时磁盘空间不足: {str(e)}")
+                return jsonify({'error': '服务器存储空间不足，请稍后再试'}), 503
+            
+            # 确定帧的访问地址
+            base_url = frames_base_url()
+            # 写入当前小时分区，过期后生命周期清理按分区整体删除
+            frames_url_path = f"{partition_prefix('frames/')}/{output_dir_name}"
+            logger.info(f"使用基础URL: {base_url}")
+            
+            # 逐帧上传的任务: 有上次中断留下的进度时沿用上次的帧前缀，并核对已上传的对象
+            progress = None
+            if format_type != 'npy' and not bundle:
+                progress = checkpoint_store.open(job_key, frames_url_path)
+                frames_url_path = progress.frames_path
+                if progress.resumed:
+                    verified = progress.verify(storage.list_files(f"{frames_url_path}/"))
+                    summary.set(resumed_from=verified)
+                    logger.info(f"找到任务的上传进度，已核对 {verified} 帧: {frames_url_path}")
+            
+            job = {
+                'video_path': video_path,
+                'output_dir': output_dir,
+                'frames_url_path': frames_url_path,
+                'base_url': base_url,
+                'fps': float(fps),
+                'start_time': start_time,
+                'end_time': end_time,
+                'format': format_type,
+                'quality': int(quality),
+                'estimated_frames': frame_total,
+                'id': job_id,
+                'cancel': cancel,
+                'cancel_token': cancel_token,
+                'summary': summary,
+                'checkpoint': progress,
+                'phash': phash,
+                'target_kb': target_kb
+            }
+            
+            # 流式返回: 每上传完一帧立即推送，本地文件在流结束时清理
+            if stream_type:
+                def cleanup():
+                    frames_lease.release(delete=True)
+                    for lease in leases:
+                        lease.release()
+                    flight.abandon()
+                    job_registry.unregister(job_id)
+                streaming = True
+                # 流式任务的汇总日志在流结束时输出
+                g.pop('job_summary', None)
+                return Response(
+                    stream_with_context(stream_extraction(job, stream_type, cleanup, flight)),
+                    mimetype=stream_type,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+            
             # 提取帧
             try:
                 # 确保输出目录存在
-                base_name = os.path.basename(video_path)
-                output_dir_name = os.path.splitext(base_name)[0]
-                output_dir = os.path.join(app.config['FRAMES_FOLDER'], output_dir_name)
                 os.makedirs(output_dir, exist_ok=True)
                 
                 logger.info(f"输出目录: {output_dir}")
                 
-                # 执行帧提取
-                frame_count = extract_frames(
-                    video_path, 
-                    output_dir, 
-                    fps=float(fps), 
-                    start_time=start_time,
-                    end_time=end_time,
-                    format=format_type,
-                    quality=int(quality)
-                )
-                
-                logger.info(f"成功提取 {frame_count} 帧，准备上传到R2存储")
-                
-                # 将帧上传到R2存储
-                base_url = app.config.get('FRAMES_BASE_URL', '')
-                if not base_url:
-                    # 如果没有设置基础URL，使用Worker URL
-                    base_url = app.config.get('WORKER_URL', '')
-                    if not base_url:
-                        # 如果没有设置Worker URL，则使用当前请求的URL
-                        base_url = request.url_root.rstrip('/')
-                
-                logger.info(f"使用基础URL: {base_url}")
+                # npy格式: 整个任务只上传帧数组和时间戳两个对象
+                if format_type == 'npy':
+                    from extract_frames import NPY_FRAMES_FILE, NPY_TIMESTAMPS_FILE
+                    extraction = extraction_pool.submit(
+                        'extract_frames',
+                        cancel=cancel,
+                        video_path=video_path,
+                        output_dir=output_dir,
+                        fps=float(fps),
+                        start_time=start_time,
+                        end_time=end_time,
+                        format=format_type,
+                        gray=gray,
+                        width=int(width) if width else None
+                    )
+                    try:
+                        frame_count = extraction.wait()
+                    finally:
+                        summary.set(sandbox=extraction.usage)
+                    
+                    arrays = {}
+                    for array_file in (NPY_FRAMES_FILE, NPY_TIMESTAMPS_FILE):
+                        object_name = f"{frames_url_path}/{array_file}"
+                        if not storage.upload_file(os.path.join(output_dir, array_file), object_name, 'application/octet-stream'):
+                            return jsonify({'error': f'上传帧数组到R2失败: {object_name}'}), 500
+                        arrays[os.path.splitext(array_file)[0]] = f"{base_url}/{object_name}"
                     
-                # 调整为相对路径
-                frames_url_path = f"frames/{output_dir_name}"
-                # 列出所有帧文件
-                frame_files = sorted([f for f in os.listdir(output_dir) if f.endswith(f'.{format_type}')])
+                    summary.set(frames=frame_count)
+                    result = {
+                        'frames': [],
+                        'arrays': arrays,
+                        'message': f'成功提取 {frame_count} 帧',
+                        'count': frame_count,
+                        'baseUrl': base_url,
+                        'framesPath': frames_url_path
+                    }
+                    flight.publish(result)
+                    return jsonify(dict(result, jobId=job_id, timings=g.trace.as_dict()))
                 
-                logger.info(f"准备上传 {len(frame_files)} 个文件到R2存储")
+                # 打包格式: 整个任务只上传打包文件和清单两个对象
+                if bundle:
+                    from extract_frames import BUNDLE_FILE, BUNDLE_MANIFEST_FILE
+                    extraction = extraction_pool.submit(
+                        'extract_frames_bundle',
+                        cancel=cancel,
+                        video_path=video_path,
+                        output_dir=output_dir,
+                        fps=float(fps),
+                        start_time=start_time,
+                        end_time=end_time,
+                        format=format_type,
+                        quality=int(quality),
+                        phash=phash,
+                        target_kb=target_kb
+                    )
+                    try:
+                        manifest = extraction.wait()
+                    finally:
+                        summary.set(sandbox=extraction.usage)
+                    
+                    for bundle_file, content_type in ((BUNDLE_FILE, 'application/octet-stream'),
+                                                      (BUNDLE_MANIFEST_FILE, 'application/json')):
+                        object_name = f"{frames_url_path}/{bundle_file}"
+                        if not storage.upload_file(os.path.join(output_dir, bundle_file), object_name, content_type):
+                            return jsonify({'error': f'上传打包文件到R2失败: {object_name}'}), 500
+                    
+                    # 帧地址带上偏移和长度，Worker可以直接按范围读取打包文件
+                    frames = [{
+                        'url': versioned_url(
+                            f"{base_url}/{frames_url_path}/{entry['name']}?offset={entry['offset']}&length={entry['length']}",
+                            entry['md5']
+                        ),
+                        'filename': entry['name'],
+                        'index': entry['index'],
+                        'timestamp': entry['timestamp'],
+                        'format': manifest['format'],
+                        'offset': entry['offset'],
+                        'length': entry['length'],
+                        'etag': entry['md5']
+                    } for entry in manifest['frames']]
+                    for frame, entry in zip(frames, manifest['frames']):
+                        if 'quality' in entry:
+                            frame['quality'] = entry['quality']
+                            frame['size'] = entry['length']
+                    
+                    summary.set(frames=len(frames), bundle_bytes=manifest['size'])
+                    result = {
+                        'frames': frames,
+                        'bundle': f"{base_url}/{frames_url_path}/{BUNDLE_FILE}",
+                        'manifest': f"{base_url}/{frames_url_path}/{BUNDLE_MANIFEST_FILE}",
+                        'message': f'成功提取 {len(frames)} 帧',
+                        'count': len(frames),
+                        'baseUrl': base_url,
+                        'framesPath': frames_url_path
+                    }
+                    quality_stats = quality_summary(frames, target_kb) if target_kb else None
+                    if quality_stats:
+                        result['quality'] = quality_stats
+                    if manifest.get('phash'):
+                        hashes_url = publish_hashes(job_id, os.path.join(output_dir, manifest['phash']),
+                                                    frames_url_path, manifest['format'], base_url,
+                                                    {entry['index']: entry['md5'] for entry in manifest['frames']})
+                        if hashes_url:
+                            result['hashes'] = hashes_url
+                    flight.publish(result)
+                    return jsonify(dict(result, jobId=job_id, timings=g.trace.as_dict()))
                 
+                # 边提取边上传到R2存储
                 frames = []
                 upload_success_count = 0
-                
-                for i, frame_file in enumerate(frame_files):
-                    # 构建本地文件路径和对象存储路径
-                    local_file_path = os.path.join(output_dir, frame_file)
-                    object_name = f"{frames_url_path}/{frame_file}"
-                    
-                    # 确定内容类型
-                    content_type = f"image/{format_type}"
-                    
-                    # 上传文件到R2存储
-                    uploaded = r2_storage.upload_file(local_file_path, object_name, content_type)
+                for frame, uploaded in extract_and_upload(job):
+                    frames.append(frame)
                     if uploaded:
                         upload_success_count += 1
-                        logger.info(f"成功上传到R2: {object_name}")
-                    else:
-                        logger.warning(f"上传帧到R2失败: {object_name}")
-                    
-                    # 构建完整URL，使用Worker URL直接访问
-                    frame_url = f"{base_url}/{object_name}"
-                    frames.append({
-                        'url': frame_url,
-                        'filename': frame_file,
-                        'index': i,
-                        'format': format_type
-                    })
-                    
-                    # 每上传10个文件记录一次日志
-                    if (i+1) % 10 == 0 or i == len(frame_files)-1:
-                        logger.info(f"已上传 {i+1}/{len(frame_files)} 个文件")
+                frame_count = len(frames)
+                summary.set(frames=frame_count)
                 
-                logger.info(f"成功上传 {upload_success_count}/{len(frame_files)} 个文件到R2存储")
-                logger.info(f"返回 {len(frames)} 个帧URL")
+                logger.info(f"成功上传 {upload_success_count}/{frame_count} 个文件到R2存储")
                 
-                # 返回结果
-                return jsonify({
+                # 返回结果，全部上传成功时共享给合并到同一任务的请求
+                result = {
                     'frames': frames,
                     'message': f'成功提取 {frame_count} 帧',
                     'count': frame_count,
                     'baseUrl': base_url,
                     'framesPath': frames_url_path
-                })
+                }
+                if job.get('hashes'):
+                    result['hashes'] = job['hashes']
+                quality_stats = quality_summary(frames, target_kb) if target_kb else None
+                if quality_stats:
+                    result['quality'] = quality_stats
+                if upload_success_count == frame_count:
+                    flight.publish(result)
+                return jsonify(dict(result, jobId=job_id, timings=g.trace.as_dict()))
                 
+            except cancellation.Cancelled as e:
+                # 显式取消时删除已上传的部分结果，本地帧目录在finally中删除
+                if not keeps_partial(e.reason):
+                    discard_uploaded(frames_url_path)
+                raise
             except Exception as e:
                 logger.error(f"提取帧时出错: {str(e)}", exc_info=True)
                 return jsonify({'error': f'提取帧时出错: {str(e)}'}), 500
+            finally:
+                frames_lease.release(delete=True)
         
         # 处理表单数据请求 (兼容旧格式)
         else:
@@ -309,18 +1144,141 @@ def extract_frames_api():
             # ...
             return jsonify({'error': '请使用JSON格式请求'}), 400
                 
+    except cancellation.Cancelled as e:
+        message, status = CANCEL_RESPONSES[e.reason]
+        logger.info(f"任务已取消({e.reason}): {job_id}")
+        return jsonify({'error': message, 'jobId': job_id, 'cancelled': e.reason}), status
+    except singleflight.FlightTimeout:
+        response = jsonify({'error': '相同的任务仍在执行，请稍后再试', 'jobId': job_id})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(FLIGHT_RETRY_AFTER)
+        return response
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
         return jsonify({'error': f'处理请求时出错: {str(e)}'}), 500
+    finally:
+        if not streaming:
+            for lease in leases:
+                lease.release()
+            # 任务失败或未发布结果时释放锁，等待中的请求会接手执行
+            if flight is not None:
+                flight.abandon()
+            if job_id is not None:
+                job_registry.unregister(job_id)
 
-@app.route('/frames/<folder_name>')
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@admission_controller.limit()
+def cancel_job(job_id):
+    """
+    取消正在执行的提取任务，任务会在处理下一帧前停止并清理已生成的文件
+
+    需要携带提取请求返回的取消令牌(请求头 X-Cancel-Token 或参数 token)，
+    任务ID由客户端指定、可能被猜到或看到，只凭ID不能取消别人的任务
+    """
+    if not cancellation.JOB_ID_RE.match(job_id):
+        return jsonify({'error': '无效的任务ID'}), 400
+    try:
+        cancelled = job_registry.cancel(job_id, request.headers.get('X-Cancel-Token') or request.args.get('token'))
+    except cancellation.CancelDenied:
+        return jsonify({'error': '取消令牌无效'}), 403
+    if not cancelled:
+        return jsonify({'error': '任务不存在或已结束'}), 404
+    return jsonify({'success': True, 'jobId': job_id}), 202
+
+@app.route('/api/jobs/<job_id>/similar')
+@admission_controller.limit()
+def similar_frames(job_id):
+    """
+    查找与任务中某一帧相似的帧
+    
+    参数: frame - 帧序号; k - 返回的帧数(默认10); maxDistance - 最大汉明距离(0-64);
+    jobs - 同时在这些任务(逗号分隔的任务ID)中查找
+    只比较提取时计算的感知哈希(提取请求带 phash: true)，不读取任何图片
+    """
+    job_ids = [job_id] + [j for j in request.args.get('jobs', '').split(',') if j and j != job_id]
+    if not all(cancellation.JOB_ID_RE.match(j) for j in job_ids):
+        return jsonify({'error': '无效的任务ID'}), 400
+    frame = request.args.get('frame', type=int)
+    if frame is None:
+        return jsonify({'error': '缺少frame参数'}), 400
+    k = min(SIMILAR_MAX_K, max(1, request.args.get('k', 10, type=int)))
+    max_distance = request.args.get('maxDistance', type=int)
+    if max_distance is not None and not 0 <= max_distance <= similarity.HASH_SIZE * similarity.HASH_SIZE:
+        return jsonify({'error': f'maxDistance必须在0到{similarity.HASH_SIZE * similarity.HASH_SIZE}之间'}), 400
+    
+    with tracing.stage('similar'):
+        candidates = []
+        records = {}
+        for j in job_ids:
+            record = frame_hashes.lookup(j)
+            entry = frame_hashes.hashes(record['framesPath']) if record else None
+            if entry is None:
+                return jsonify({'error': f'任务不存在、已过期或提取时没有计算感知哈希: {j}'}), 404
+            records[j] = record
+            hashes, valid = entry
+            candidates.append((j, hashes, frame if j == job_id else None, valid))
+        
+        _, query, _, query_valid = candidates[0]
+        if not 0 <= frame < len(query):
+            return jsonify({'error': f'帧序号超出范围(共 {len(query)} 帧)'}), 404
+        if not query_valid[frame]:
+            return jsonify({'error': f'第 {frame} 帧没有感知哈希'}), 404
+        value = int(query[frame])
+        matches = similarity.nearest(candidates, value, k, max_distance)
+    
+    base_url = frames_base_url()
+    results = []
+    for j, index, distance in matches:
+        record = records[j]
+        filename = f"frame_{index:06d}.{record['format']}"
+        versions = record.get('versions') or []
+        results.append({
+            'jobId': j,
+            'index': index,
+            'filename': filename,
+            'distance': distance,
+            'url': versioned_url(f"{base_url}/{record['framesPath']}/{filename}",
+                                 versions[index] if index < len(versions) else None)
+        })
+    return jsonify({
+        'jobId': job_id,
+        'frame': frame,
+        'hash': f"{value:016x}",
+        'matches': results,
+        'timings': g.trace.as_dict()
+    })
+
+@app.route('/frames/<path:folder_name>')
+@admission_controller.limit()
 def get_frames(folder_name):
     try:
         # 列出指定文件夹中的所有帧
         frames = []
-        for obj in r2_storage.list_files(f"frames/{folder_name}/"):
+        objects = storage.list_files(f"frames/{folder_name}/")
+        
+        # 打包输出的目录按清单列出帧，通过单帧接口按范围读取
+        if any(os.path.basename(obj['Key']) == bundle_index.manifest_name for obj in objects):
+            index = bundle_index.manifest(f"frames/{folder_name}", listed=True)
+            if index:
+                for name, entry in index['frames'].items():
+                    frames.append({
+                        'url': versioned_url(
+                            f"{request.url_root.rstrip('/')}/api/get-frame-image?filepath=frames/{folder_name}/{name}"
+                            f"&offset={entry['offset']}&length={entry['length']}",
+                            entry.get('md5')
+                        ),
+                        'filename': name
+                    })
+                return jsonify({
+                    'success': True,
+                    'frames': frames
+                })
+        
+        for obj in objects:
             object_name = obj['Key']
-            url = r2_storage.get_presigned_url(object_name)
+            url = storage.get_presigned_url(object_name)
+            if not url and storage.is_local:
+                url = f"{request.url_root.rstrip('/')}/storage/{object_name}"
             if url:
                 frames.append({
                     'url': url,
@@ -335,11 +1293,30 @@ def get_frames(folder_name):
         logger.error(f"获取帧列表时出错: {str(e)}")
         return jsonify({'error': f'获取帧列表时出错: {str(e)}'}), 500
 
-@app.route('/download/<folder_name>/<filename>')
+@app.route('/download/<path:folder_name>/<filename>')
+@admission_controller.limit()
 def download_frame(folder_name, filename):
+    version = request.args.get('v')
     try:
         object_name = f"frames/{folder_name}/{filename}"
-        url = r2_storage.get_presigned_url(object_name)
+        cached = not_modified(version)
+        if cached is not None:
+            return cached
+        
+        # 本地存储直接返回文件(X-Accel-Redirect或send_file)
+        response = serve_object(object_name, as_attachment=True, download_name=filename, etag=version)
+        if response is not None:
+            return response
+        
+        # 打包的帧没有独立对象，按范围读取后直接返回(目录中有清单时才读取清单)
+        bundled = bundle_index.read(object_name)
+        if bundled:
+            data, content_type = bundled
+            response = Response(data, mimetype=content_type)
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return immutable_response(response, version or hashlib.md5(data).hexdigest(), bool(version))
+        
+        url = storage.get_presigned_url(object_name)
         if url:
             return redirect(url)
         else:
@@ -348,13 +1325,48 @@ def download_frame(folder_name, filename):
         logger.error(f"获取下载链接时出错: {str(e)}")
         return jsonify({'error': f'获取下载链接时出错: {str(e)}'}), 500
 
+@app.route('/storage/<path:object_name>')
+@admission_controller.limit()
+def get_storage_object(object_name):
+    """本地存储后端的对象访问地址，相当于R2前面的Worker"""
+    if not storage.is_local:
+        return jsonify({'error': '当前存储后端不支持直接访问'}), 404
+    
+    version = request.args.get('v')
+    cached = not_modified(version)
+    if cached is not None:
+        return cached
+    
+    # 打包的帧: 地址中带偏移和长度时按范围读取打包文件
+    offset = request.args.get('offset', type=int)
+    length = request.args.get('length', type=int)
+    if offset is not None and length:
+        bundle_object = f"{os.path.dirname(object_name)}/{bundle_index.bundle_name}"
+        data = storage.get_range(bundle_object, offset, length)
+        if not data:
+            return jsonify({'error': '文件不存在'}), 404
+        response = Response(data, mimetype=mimetypes.guess_type(object_name)[0] or 'application/octet-stream')
+        return immutable_response(response, version or hashlib.md5(data).hexdigest(), bool(version))
+    
+    response = serve_object(object_name, etag=version)
+    if response is None:
+        bundled = bundle_index.read(object_name)
+        if not bundled:
+            return jsonify({'error': '文件不存在'}), 404
+        data, content_type = bundled
+        response = immutable_response(Response(data, mimetype=content_type), version or hashlib.md5(data).hexdigest(),
+                                      bool(version))
+    return response
+
 @app.route('/api/proxy-image')
+@admission_controller.limit()
 def proxy_image():
     """代理图片请求，解决CORS问题"""
     url = request.args.get('url')
     if not url:
         return jsonify({"error": "Missing URL parameter"}), 400
     
+    import requests
     try:
         response = requests.get(url, stream=True)
         if response.status_code != 200:
@@ -371,36 +1383,106 @@ def proxy_image():
         return jsonify({"error": f"Failed to proxy image: {str(e)}"}), 500
 
 @app.route('/api/get-frame-image')
+@admission_controller.limit()
 def get_frame_image():
     """获取帧图片，通过R2存储直接获取"""
     filepath = request.args.get('filepath')
     if not filepath:
         return jsonify({"error": "Missing filepath parameter"}), 400
     
+    offset = request.args.get('offset', type=int)
+    length = request.args.get('length', type=int)
+    # 地址中的内容哈希，带有时用作ETag
+    version = request.args.get('v')
+    
     try:
         logger.info(f"请求帧图片: {filepath}")
-        
-        # 从R2存储获取文件内容
-        file_content = r2_storage.get_file(filepath)
-        if not file_content:
-            logger.warning(f"未找到帧图片: {filepath}")
-            return jsonify({"error": "Frame image not found"}), 404
+        cached = not_modified(version)
+        if cached is not None:
+            return cached
         
         # 确定内容类型
         content_type = 'image/jpeg'  # 默认
         if filepath.endswith('.png'):
             content_type = 'image/png'
-            
-        return send_file(
-            file_content,
-            mimetype=content_type,
-            as_attachment=False,
-            download_name=os.path.basename(filepath)
+        
+        if offset is not None and length:
+            # 打包的帧: 地址中已带偏移和长度，直接按范围读取打包文件
+            bundle_object = f"{os.path.dirname(filepath)}/{bundle_index.bundle_name}"
+            file_content = storage.get_range(bundle_object, offset, length)
+        else:
+            # 本地存储直接返回文件(X-Accel-Redirect或send_file)，不读入内存
+            response = serve_object(filepath, etag=version)
+            if response is not None:
+                return response
+            # 从存储获取文件内容，不存在时尝试从打包文件中读取
+            file_content = storage.get_file(filepath)
+            if not file_content:
+                bundled = bundle_index.read(filepath)
+                if bundled:
+                    file_content, content_type = bundled
+        if not file_content:
+            logger.warning(f"未找到帧图片: {filepath}")
+            return jsonify({"error": "Frame image not found"}), 404
+        
+        # 带内容哈希的地址内容不会变化: 带ETag并允许永久缓存
+        return immutable_response(
+            Response(file_content, mimetype=content_type),
+            version or hashlib.md5(file_content).hexdigest(),
+            bool(version)
         )
     except Exception as e:
         logger.error(f"获取帧图片失败: {str(e)}", exc_info=True)
         return jsonify({"error": f"Failed to get frame image: {str(e)}"}), 500
 
+@app.route('/api/frame')
+@admission_controller.limit()
+def get_single_frame():
+    """只解码指定时间点的一帧并返回图片，不运行完整的帧提取"""
+    video = request.args.get('video')
+    if not video:
+        return jsonify({"error": "Missing video parameter"}), 400
+    try:
+        t = float(request.args.get('t', 0))
+        width = request.args.get('w', type=int)
+        quality = min(100, max(1, request.args.get('q', 80, type=int)))
+    except ValueError:
+        return jsonify({"error": "Invalid t parameter"}), 400
+    # float()接受nan和inf，换算帧序号时会出错
+    if not math.isfinite(t):
+        return jsonify({"error": "Invalid t parameter"}), 400
+    
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(video))
+    if not os.path.exists(video_path):
+        return jsonify({"error": "Video not found"}), 404
+    
+    try:
+        with tracing.stage('frame'):
+            data = frame_service.get_frame(video_path, t, width=width, quality=quality)
+        if data is None:
+            return jsonify({"error": "Timestamp out of range"}), 404
+        response = Response(data, mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+        return response
+    except Exception as e:
+        logger.error(f"获取单帧失败: {str(e)}", exc_info=True)
+        return jsonify({"error": f"Failed to get frame: {str(e)}"}), 500
+
+@app.route('/api/profiles/<profile_id>')
+def download_profile(profile_id):
+    """下载之前采集的cProfile数据，请求头 X-Profile 需要携带PROFILE_TOKEN"""
+    if not profiler.authorized(request.headers.get('X-Profile')):
+        return jsonify({"error": "Forbidden"}), 403
+    path = profiler.path_for(profile_id)
+    if not path or not os.path.exists(path):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(
+        os.path.abspath(path),
+        mimetype='application/octet-stream',
+        as_attachment=True,
+        download_name=f"{profile_id}.prof"
+    )
+
 # 启动服务器
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
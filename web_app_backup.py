@@ -6,19 +6,20 @@ import uuid
 from extract_frames import extract_frames
 import logging
 from r2_storage import R2Storage
-from r2_lifecycle import R2Lifecycle
+from r2_lifecycle import partition_prefix
+from admission import AdmissionController, TokenBucketStore
 from config import (
     ALLOWED_EXTENSIONS,
     MAX_CONTENT_LENGTH,
     CORS_ORIGINS,
     DEFAULT_QUALITY,
     DEFAULT_FPS,
-    DEFAULT_FORMAT
+    DEFAULT_FORMAT,
+    STATE_FOLDER
 )
 import mimetypes
 from functools import wraps
 import time
-import threading
 import requests
 import tempfile
 import json
@@ -43,44 +44,20 @@ CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['FRAMES_FOLDER'], exist_ok=True)
 
-# 初始化 R2 存储和生命周期管理
+# 初始化 R2 存储
+# 过期文件由单独的清理进程处理 (python r2_lifecycle.py，见Procfile中的sweeper)，
+# 不再在每个worker中启动清理线程
 r2_storage = R2Storage()
-r2_lifecycle = R2Lifecycle(r2_storage)
 
-def cleanup_task():
-    """定时清理任务"""
-    while True:
-        try:
-            deleted_count = r2_lifecycle.cleanup_expired_files()
-            if deleted_count > 0:
-                logger.info(f"已清理 {deleted_count} 个过期文件")
-            time.sleep(3600)  # 每1小时检查一次
-        except Exception as e:
-            logger.error(f"清理任务出错: {str(e)}")
-            time.sleep(60)  # 出错后等待1分钟再试
-
-# 启动清理线程
-cleanup_thread = threading.Thread(target=cleanup_task, daemon=True)
-cleanup_thread.start()
-
-# 速率限制装饰器
+# 速率限制装饰器 - 令牌桶保存在SQLite中，所有worker共享
 def rate_limit(limit=10, per=60):
     def decorator(f):
-        requests = {}
-        @wraps(f)
-        def wrapped(*args, **kwargs):
-            now = time.time()
-            ip = request.remote_addr
-            
-            # 清理过期的请求记录
-            requests[ip] = [t for t in requests.get(ip, []) if now - t < per]
-            
-            if len(requests.get(ip, [])) >= limit:
-                return jsonify({'error': '请求过于频繁，请稍后再试'}), 429
-            
-            requests.setdefault(ip, []).append(now)
-            return f(*args, **kwargs)
-        return wrapped
+        store = TokenBucketStore(
+            os.path.join(STATE_FOLDER, f'rate_limit_{f.__name__}.sqlite3'),
+            capacity=limit,
+            refill_rate=limit / per
+        )
+        return AdmissionController(store).limit()(f)
     return decorator
 
 def allowed_file(filename):
@@ -238,7 +215,7 @@ def extract_frames_api():
                 logger.info(f"使用基础URL: {base_url}")
                     
                 # 调整为相对路径
-                frames_url_path = f"frames/{output_dir_name}"
+                frames_url_path = f"{partition_prefix('frames/')}/{output_dir_name}"
                 # 列出所有帧文件
                 frame_files = sorted([f for f in os.listdir(output_dir) if f.endswith(f'.{format_type}')])
                 
@@ -327,7 +304,7 @@ def get_frames(folder_name):
         logger.error(f"获取帧列表时出错: {str(e)}")
         return jsonify({'error': f'获取帧列表时出错: {str(e)}'}), 500
 
-@app.route('/download/<folder_name>/<filename>')
+@app.route('/download/<path:folder_name>/<filename>')
 def download_frame(folder_name, filename):
     try:
         object_name = f"frames/{folder_name}/{filename}"
@@ -1,44 +1,186 @@
+// 打包输出: 所有帧写入同一个对象，清单记录每帧的偏移和长度
+const BUNDLE_FILE = 'frames.bundle';
+const MANIFEST_FILE = 'manifest.json';
+
+// 已读取的清单(清单生成后不再变化)，同一个isolate内的请求共享
+const manifests = new Map();
+const MAX_MANIFESTS = 100;
+
+// 帧的地址带有内容哈希(?v=)，同一地址的内容不会变化
+const IMMUTABLE = 'public, max-age=31536000, immutable';
+// 不带内容哈希的地址只短期缓存: 对象会被生命周期清理删除，与web_app.py的UNVERSIONED_CACHE_CONTROL相同
+const SHORT_LIVED = 'public, max-age=300';
+// 帧地址中内容哈希的长度，与web_app.py的CONTENT_VERSION_LENGTH相同
+const CONTENT_VERSION_LENGTH = 16;
+
 export default {
-  async fetch(request, env) {
-    const url = new URL(request.url);
-    const key = url.pathname.slice(1);
+  async fetch(request, env, ctx) {
+    // 帧的完整GET请求先查边缘缓存，命中时不访问R2；
+    // 视频(videos/)只在提取时读取一次，不占用边缘缓存
+    const key = new URL(request.url).pathname.slice(1);
+    const cacheable = request.method === 'GET' && !request.headers.has('Range') && key.startsWith('frames/');
+    if (cacheable) {
+      const cached = await caches.default.match(request);
+      if (cached) {
+        return cached;
+      }
+    }
 
-    // 处理CORS预检请求
-    if (request.method === 'OPTIONS') {
-      return handleCORS();
+    const response = await handleRequest(request, env);
+    if (cacheable && response.status === 200) {
+      ctx.waitUntil(caches.default.put(request, response.clone()));
     }
+    return response;
+  }
+}
+
+async function handleRequest(request, env) {
+  const url = new URL(request.url);
+  const version = url.searchParams.get('v');
+  const key = url.pathname.slice(1);
+
+  // 处理CORS预检请求
+  if (request.method === 'OPTIONS') {
+    return handleCORS();
+  }
+
+  if (!key) {
+    return new Response('Not Found', { status: 404 });
+  }
+
+  // 允许的文件前缀
+  const allowedPrefixes = ['videos/', 'frames/'];
+  if (!allowedPrefixes.some(prefix => key.startsWith(prefix))) {
+    return new Response('Forbidden', { status: 403 });
+  }
+
+  // 打包的帧: 地址带有偏移和长度时直接按范围读取打包文件
+  const offset = url.searchParams.get('offset');
+  const length = url.searchParams.get('length');
+  if (offset !== null && length !== null) {
+    const bundleKey = key.slice(0, key.lastIndexOf('/') + 1) + BUNDLE_FILE;
+    return serveRange(request, env, bundleKey, Number(offset), Number(length), contentTypeFor(key), version);
+  }
 
-    if (!key) {
-      return new Response('Not Found', { status: 404 });
+  // 获取 R2 对象，支持客户端的 Range 请求和 If-None-Match 条件请求
+  const object = await env.BUCKET.get(key, { range: request.headers, onlyIf: request.headers });
+  if (!object) {
+    // 不是独立对象时，在所在目录的清单中查找
+    const entry = await findBundledFrame(env, key);
+    if (entry) {
+      return serveRange(request, env, entry.bundle, entry.offset, entry.length, entry.contentType, version || entry.md5);
     }
+    return new Response('Not Found', { status: 404 });
+  }
+
+  // 设置响应头，只有带内容哈希的地址永久缓存
+  const headers = new Headers();
+  headers.set('Content-Type', object.httpMetadata.contentType || 'application/octet-stream');
+  headers.set('Cache-Control', version ? IMMUTABLE : SHORT_LIVED);
+  headers.set('ETag', object.httpEtag);
+  headers.set('Accept-Ranges', 'bytes');
+  addCORSHeaders(headers);
 
-    // 允许的文件前缀
-    const allowedPrefixes = ['videos/', 'frames/'];
-    if (!allowedPrefixes.some(prefix => key.startsWith(prefix))) {
-      return new Response('Forbidden', { status: 403 });
+  // 条件请求命中时R2只返回元数据
+  if (!('body' in object)) {
+    return new Response(null, { status: 304, headers });
+  }
+
+  let status = 200;
+  if (object.range && request.headers.has('Range')) {
+    const start = object.range.offset ?? object.size - object.range.suffix;
+    const end = object.range.length !== undefined ? start + object.range.length - 1 : object.size - 1;
+    headers.set('Content-Range', `bytes ${start}-${end}/${object.size}`);
+    status = 206;
+  }
+
+  return new Response(object.body, {
+    status,
+    headers
+  });
+}
+
+// 按范围读取打包文件中的一帧，version为帧内容的哈希(用作ETag)
+async function serveRange(request, env, bundleKey, offset, length, contentType, version) {
+  if (!Number.isInteger(offset) || !Number.isInteger(length) || offset < 0 || length <= 0) {
+    return new Response('Bad Request', { status: 400 });
+  }
+  const headers = new Headers();
+  headers.set('Content-Type', contentType);
+  // version可能来自清单中的md5，只有地址本身带?v=时才永久缓存
+  headers.set('Cache-Control', new URL(request.url).searchParams.has('v') ? IMMUTABLE : SHORT_LIVED);
+  addCORSHeaders(headers);
+
+  // 带内容哈希的地址: 浏览器缓存的ETag相同时不需要读取R2
+  const etag = version ? `"${version}"` : null;
+  if (etag) {
+    headers.set('ETag', etag);
+    if ((request.headers.get('If-None-Match') || '').split(',').some(tag => tag.trim() === etag)) {
+      return new Response(null, { status: 304, headers });
     }
+  }
+
+  const object = await env.BUCKET.get(bundleKey, { range: { offset, length } });
+  if (!object) {
+    return new Response('Not Found', { status: 404 });
+  }
+  if (!etag) {
+    headers.set('ETag', `"${object.etag}-${offset}-${length}"`);
+  }
+  headers.set('Content-Length', String(length));
 
-    // 获取 R2 对象
-    const object = await env.BUCKET.get(key);
-    if (!object) {
-      return new Response('Not Found', { status: 404 });
+  return new Response(object.body, { headers });
+}
+
+// 在清单中查找帧，返回 {bundle, offset, length, contentType}，找不到时返回null
+async function findBundledFrame(env, key) {
+  const slash = key.lastIndexOf('/');
+  const prefix = key.slice(0, slash);
+  const name = key.slice(slash + 1);
+
+  let index = manifests.get(prefix);
+  if (index === undefined) {
+    index = null;
+    const object = await env.BUCKET.get(`${prefix}/${MANIFEST_FILE}`);
+    if (object) {
+      const manifest = await object.json();
+      index = {
+        bundle: `${prefix}/${manifest.bundle}`,
+        contentType: manifest.contentType || 'image/jpeg',
+        frames: new Map(manifest.frames.map(entry => [entry.name, entry]))
+      };
+      if (manifests.size >= MAX_MANIFESTS) {
+        manifests.delete(manifests.keys().next().value);
+      }
+      manifests.set(prefix, index);
     }
+  }
+  if (!index) {
+    return null;
+  }
 
-    // 设置响应头
-    const headers = new Headers();
-    headers.set('Content-Type', object.httpMetadata.contentType || 'application/octet-stream');
-    headers.set('Cache-Control', 'public, max-age=3600');
-    
-    // 添加CORS头部
-    headers.set('Access-Control-Allow-Origin', '*');
-    headers.set('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS');
-    headers.set('Access-Control-Allow-Headers', 'Content-Type, Range');
-    headers.set('Access-Control-Expose-Headers', 'Content-Length, Content-Range');
-
-    return new Response(object.body, {
-      headers
-    });
+  const entry = index.frames.get(name);
+  if (!entry) {
+    return null;
   }
+  return {
+    bundle: index.bundle,
+    offset: entry.offset,
+    length: entry.length,
+    contentType: index.contentType,
+    md5: entry.md5 && entry.md5.slice(0, CONTENT_VERSION_LENGTH)
+  };
+}
+
+function contentTypeFor(key) {
+  return key.endsWith('.png') ? 'image/png' : 'image/jpeg';
+}
+
+function addCORSHeaders(headers) {
+  headers.set('Access-Control-Allow-Origin', '*');
+  headers.set('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS');
+  headers.set('Access-Control-Allow-Headers', 'Content-Type, Range');
+  headers.set('Access-Control-Expose-Headers', 'Content-Length, Content-Range, ETag');
 }
 
 // 处理CORS预检请求的函数
@@ -51,4 +193,4 @@ function handleCORS() {
       'Access-Control-Max-Age': '86400',
     }
   });
-} 
\ No newline at end of file
+}
\ No newline at end of file